@@ -6,7 +6,8 @@ December 12, 2014.
 from pytadbit.utils.extraviews      import plot_compartments
 from pytadbit.utils.extraviews      import plot_compartments_summary
 from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
-from pytadbit.utils.normalize_hic   import iterative, expected
+from pytadbit.utils.normalize_hic   import iterative, iterative_sparse, expected
+from pytadbit.utils.normalize_hic   import diagonal_sums
 from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.parsers.bed_parser    import parse_bed
 from pytadbit.utils.file_handling   import mkdir
@@ -15,16 +16,26 @@ from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
-from numpy                          import nanmax
+from numpy                          import nanmax, zeros, ones, arange
+from numpy                          import repeat, diff, in1d, concatenate
+from numpy                          import searchsorted, int64, int32
+from numpy                          import fromiter, cumsum
+from numpy                          import empty, float32, float64, bincount
+from numpy                          import sqrt as npsqrt, outer, flatnonzero
+from numpy                          import clip, save as npsave
+from numpy                          import load as npload
+from numpy.lib.format               import open_memmap
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
-from scipy.sparse.linalg            import eigsh
+from scipy.sparse.linalg            import eigsh, LinearOperator
 from pytadbit.utils.tadmaths        import calinski_harabasz
 from scipy.stats                    import ttest_ind
 from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
-from scipy.sparse                   import csr_matrix
+from scipy.sparse                   import csr_matrix, isspmatrix
+from itertools                      import izip, imap
+import multiprocessing as mu
 import os
 
 class HiC_data(dict):
@@ -36,6 +47,9 @@ class HiC_data(dict):
         super(HiC_data, self).__init__(items)
         self.__size = size
         self._size2 = size**2
+        self._version = 0
+        self._diagonal_sums = {}
+        self._sums_version = 0
         self.bias = None
         self.bads = masked or {}
         self.chromosomes = chromosomes
@@ -55,9 +69,85 @@ class HiC_data(dict):
             self.sections = dict([((None, i), i)
                                   for i in xrange(0, self.__size)])
 
+    def __setstate__(self, state):
+        # objects pickled before bias, bads and expected became properties
+        for key in ('bias', 'bads', 'expected'):
+            if key in state:
+                state['_' + key] = state.pop(key)
+        state.setdefault('_expected_key', None)
+        state.setdefault('_diagonal_sums', {})
+        state.setdefault('_version', 0)
+        state.setdefault('_sums_version', 0)
+        self.__dict__.update(state)
+
+    @property
+    def bias(self):
+        return self._bias
+
+    @bias.setter
+    def bias(self, bias):
+        self._bias = bias
+        self._version += 1
+
+    @property
+    def bads(self):
+        return self._bads
+
+    @bads.setter
+    def bads(self, bads):
+        self._bads = bads
+        self._version += 1
+
+    @property
+    def expected(self):
+        """
+        expected interactions by distance (see
+        :func:`pytadbit.utils.normalize_hic.expected`), None if not computed or
+        if the filtered columns, the biases or the interactions changed since
+        """
+        if self._expected_key != (frozenset(self._bads), self._version):
+            return None
+        return self._expected
+
+    @expected.setter
+    def expected(self, expc):
+        self._expected = expc
+        self._expected_key = (frozenset(self._bads), self._version)
+
+    def diagonal_sums(self, bads=None, normalized=False):
+        """
+        Sums of the interactions by distance to the diagonal for each
+        chromosome, and of the inter-chromosomal interactions (see
+        :func:`pytadbit.utils.normalize_hic.diagonal_sums`). Results are kept
+        until the biases, the filtered columns or the interactions change.
+
+        :param None bads: dictionary of columns not to be considered (by
+           default the filtered columns)
+        :param False normalized: also sums interactions normalized by the biases
+
+        :returns: the sums by chromosome, and the inter-chromosomal sums
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        if bads is None:
+            bads = self.bads
+        if self._sums_version != self._version:
+            self._diagonal_sums = {}
+            self._sums_version = self._version
+        key = (frozenset(bads), normalized)
+        try:
+            return self._diagonal_sums[key]
+        except KeyError:
+            pass
+        sums = diagonal_sums(self, bads=bads,
+                             bias=self.bias if normalized else None)
+        self._diagonal_sums[key] = sums
+        return sums
+
     def _update_size(self, size):
         self.__size +=  size
         self._size2 = self.__size**2
+        self._version += 1
         
     def __len__(self):
         return self.__size
@@ -99,6 +189,7 @@ class HiC_data(dict):
                     'ERROR: position %d larger than %s^2' % (row_col,
                                                              self.__size))
             super(HiC_data, self).__setitem__(row_col, val)
+        self._version += 1
     
     def get_hic_data_as_csr(self):
         """
@@ -211,7 +302,6 @@ class HiC_data(dict):
             exclude = []
         if equals == None:
             equals = lambda x, y: x == y
-        intra = 0
         if not self.chromosomes:
             return float('nan')
         # define chromosomes to be merged
@@ -228,6 +318,18 @@ class HiC_data(dict):
         bads = set(self.bads.keys())
         for c in exclude:
             bads.update(i for i in xrange(*self.section_pos[c]))
+        # compute ratio
+        intra = self._intra_sum(sections, bads, diagonal, normalized)
+        try:
+            return float(intra) / self.sum(bias=self.bias if normalized else None, bads=bads)
+        except ZeroDivisionError:
+            return 0.
+
+    def _intra_sum(self, sections, bads, diagonal, normalized):
+        """
+        sums interactions falling inside a same group of sections (used to
+        compute cis/trans ratio)
+        """
         # diagonal
         if diagonal:
             valid = lambda x, y: True
@@ -238,7 +340,7 @@ class HiC_data(dict):
             transform = lambda x, y, z: x / self.bias[y] / self.bias[z]
         else:
             transform = lambda x, y, z: x
-        # compute ratio
+        intra = 0
         for k, v in self.iteritems():
             i, j = divmod(k, self.__size)
             if bisect(sections, i) != bisect(sections, j):
@@ -247,10 +349,7 @@ class HiC_data(dict):
                 continue
             if valid(i, j): # diagonal thing
                 intra += transform(v, i, j)
-        try:
-            return float(intra) / self.sum(bias=self.bias if normalized else None, bads=bads)
-        except ZeroDivisionError:
-            return 0.
+        return intra
 
     def filter_columns(self, draw_hist=False, savefig=None, perc_zero=75,
                        by_mean=True, min_count=None, silent=False):
@@ -313,7 +412,8 @@ class HiC_data(dict):
                 norm_sum += v
         return norm_sum
 
-    def normalize_hic(self, iterations=0, max_dev=0.1, silent=False, factor=1):
+    def normalize_hic(self, iterations=0, max_dev=0.1, silent=False, factor=1,
+                      sparse=None, n_cpus=1, log=None):
         """
         Normalize the Hi-C data.
 
@@ -326,10 +426,23 @@ class HiC_data(dict):
         :param False silent: does not warn when overwriting weights
         :param 1 factor: final mean number of normalized interactions wanted
            per cell (excludes filtered, or bad, out columns)
+        :param None sparse: use the vectorized implementation of ICE
+           (:func:`pytadbit.utils.normalize_hic.iterative_sparse`), by default
+           only used with SparseHiC_data objects
+        :param 1 n_cpus: number of threads used by the vectorized ICE
+        :param None log: path to a file where to write the convergence log of
+           the vectorized ICE
         """
-        bias = iterative(self, iterations=iterations,
-                         max_dev=max_dev, bads=self.bads,
-                         verbose=not silent)
+        if sparse is None:
+            sparse = isinstance(self, SparseHiC_data)
+        if sparse:
+            bias = iterative_sparse(self, iterations=iterations,
+                                    max_dev=max_dev, bads=self.bads,
+                                    verbose=not silent, n_cpus=n_cpus, log=log)
+        else:
+            bias = iterative(self, iterations=iterations,
+                             max_dev=max_dev, bads=self.bads,
+                             verbose=not silent)
         if factor:
             if not silent:
                 print 'rescaling to factor %d' % factor
@@ -345,6 +458,34 @@ class HiC_data(dict):
                       for j in xrange(len(self))
                       for i in xrange(len(self))])
 
+    def get_as_band(self, width, remove=None):
+        """
+        Diagonals of the matrix, as used by the banded segmentation of
+        :func:`pytadbit.tadbit.tadbit`.
+
+        :param width: number of diagonals to get, above the main one
+        :param None remove: list of 0/1 (one per column) marking the columns
+           to skip, rows and columns being renumbered without them
+
+        :returns: a NumPy array of int32 with the main diagonal followed by the
+           width next ones, each of the size of the matrix without removed
+           columns (padded with zeroes), and a NumPy array of int32 with the
+           row, column and value of each non-zero cell further than width from
+           the diagonal (upper triangle, same renumbering)
+        """
+        rows, cols, vals = self._coo()
+        return _band_cells(rows, cols, vals, len(self), width, remove)
+
+    def _coo(self):
+        """
+        :returns: row indexes, column indexes and values of the non-zero cells
+        """
+        ncells = dict.__len__(self)
+        keys = fromiter(self.iterkeys(), dtype=int64, count=ncells)
+        vals = fromiter(self.itervalues(), dtype=float, count=ncells)
+        rows, cols = divmod(keys, len(self))
+        return rows, cols, vals
+
     def write_matrix(self, fname, focus=None, diagonal=True, normalized=False):
         """
         writes the matrix to a file.
@@ -464,7 +605,8 @@ class HiC_data(dict):
     def find_compartments(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', how='',
                           label_compartments='hmm', log=None, max_mean_size=10000,
-                          ev_index=None, rich_in_A=None, **kwargs):
+                          ev_index=None, rich_in_A=None, saveev=None,
+                          binary=False, n_cpus=1, **kwargs):
         """
         Search for A/B copartments in each chromsome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -489,6 +631,12 @@ class HiC_data(dict):
            predictions, one file only.
         :param None savecorr: path to a directory where to save correlation
            matrices of each chromosome
+        :param None saveev: path to a directory where to save the two first
+           eigenvectors of each chromosome
+        :param False binary: save correlation matrices and eigenvectors as
+           NumPy binary arrays (.npy files, in float32), instead of text files
+        :param 1 n_cpus: number of chromosomes processed in parallel (0 or
+           'max' to use all available cores)
         :param -1 vmin: for the color scale of the plotted map (use vmin='auto',
            and vmax='auto' to color according to the absolute maximum found).
         :param 1 vmax: for the color scale of the plotted map (use vmin='auto',
@@ -514,7 +662,10 @@ class HiC_data(dict):
            compartment, diagonal only uses diagonal
            
 
-        TODO: this is really slow...
+        The observed/expected matrix of each chromosome is stored in a float32
+        sparse matrix, and its correlation matrix is only computed (by blocks
+        of rows) if needed to save or plot it, or to label compartments by
+        clustering. Eigenvectors are obtained from a matrix-free operator.
 
         Notes: building the distance matrix using the amount of interactions
                instead of the mean correlation, gives generally worse results.
@@ -531,19 +682,21 @@ class HiC_data(dict):
                 self.bads = {}
                 warn('WARNING: all columns would have been filtered out, '
                      'filtering disabled')
-        if not self.expected:
-            if kwargs.get('verbose', False):
-                print 'Normalizing by expected values'
-            self.expected = expected(self, bads=self.bads, **kwargs)
         if not self.bias:
             if kwargs.get('verbose', False):
                 print 'Normalizing by ICE (1 round)'
             self.normalize_hic(iterations=0,
                                silent=not kwargs.get('verbose', False))
+        if not self.expected:
+            if kwargs.get('verbose', False):
+                print 'Normalizing by expected values'
+            self.expected = expected(self, bads=self.bads, **kwargs)
         if savefig:
             mkdir(savefig)
         if savecorr:
             mkdir(savecorr)
+        if saveev:
+            mkdir(saveev)
         if suffix != '':
             suffix = '_' + suffix
         # parse bed file
@@ -553,78 +706,58 @@ class HiC_data(dict):
         cmprts = {}
         firsts = {}
         ev_nums = {}
-        count = 0
 
-        for sec in self.section_pos:
-            if crms and sec not in crms:
-                continue
+        secs = [sec for sec in self.section_pos if not crms or sec in crms]
+        # the correlation matrix is only needed to save, plot or cluster it
+        need_corr = (savefig or show or label_compartments == 'cluster'
+                     or (savecorr and not binary))
+        jobs = self._compartment_jobs(secs, ev_index, need_corr,
+                                      savecorr if binary else None)
+        if n_cpus in [0, 'max']:
+            n_cpus = mu.cpu_count()
+        if n_cpus > 1:
+            pool = mu.Pool(n_cpus)
+            results = pool.imap(_compartment_eigenvectors, jobs)
+        else:
+            results = imap(_compartment_eigenvectors, jobs)
+
+        for count, (sec, (status, evect, matrix)) in enumerate(izip(secs,
+                                                                   results)):
             if kwargs.get('verbose', False):
                 print 'Processing chromosome', sec
-            matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                       / self.bias[i] / self.bias[j])
-                      for i in xrange(*self.section_pos[sec])
-                       if not i in self.bads]
-                     for j in xrange(*self.section_pos[sec])
-                      if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
+            if status == 'empty': # MT chromosome will fall there
                 warn('Chromosome %s is probably MT :)' % (sec))
                 cmprts[sec] = []
-                count += 1
                 continue
-            for i in xrange(len(matrix)):
-                for j in xrange(i+1, len(matrix)):
-                    matrix[i][j] = matrix[j][i]
-            try:
-                matrix = [list(m) for m in corrcoef(matrix)]
-            except TypeError:
-                # very small chromosome?
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
+            if status == 'small':
+                warn('Chromosome %s too small to compute PC1' % (sec))
+                cmprts[sec] = [] # Y chromosome, or so...
                 continue
-            # write correlation matrix to file. replaces filtered row/columns by NaN
-            if savecorr:
+            if need_corr and matrix is None:
+                matrix = npload(os.path.join(savecorr, '%s_corr-matrix.npy'
+                                             % (sec)), mmap_mode='r')
+            beg, end = self.section_pos[sec]
+            kept = array([i not in self.bads for i in xrange(beg, end)])
+            # write correlation matrix to file. filtered row/columns are NaN
+            if savecorr and not binary:
                 out = open(os.path.join(savecorr, '%s_corr-matrix.tsv' % (sec)),
                            'w')
-                start1, end1 = self.section_pos[sec]
-                out.write('# MASKED %s\n' % (' '.join([str(k - start1)
-                                                       for k in self.bads.keys()
-                                                       if start1 <= k <= end1])))
+                out.write('# MASKED %s\n' % (' '.join([
+                    str(k) for k in flatnonzero(~kept)])))
                 rownam = ['%s\t%d-%d' % (k[0],
                                          k[1] * self.resolution,
                                          (k[1] + 1) * self.resolution)
                           for k in sorted(self.sections,
                                           key=lambda x: self.sections[x])
                           if k[0] == sec]
-                length = self.section_pos[sec][1] - self.section_pos[sec][0]
-                empty = 'NaN\t' * (length - 1) + 'NaN\n'
-                badrows = 0
-                for row in xrange(length):
-                    if row in self.bads:
-                        out.write(rownam.pop(0) + '\t' +empty)
-                        badrows += 1
-                        continue
-                    vals = []
-                    badcols = 0
-                    for col in xrange(length):
-                        if col in self.bads:
-                            vals.append('NaN')
-                            badcols += 1
-                            continue
-                        vals.append(str(matrix[row-badrows][col-badcols]))
-                    out.write(rownam.pop(0) + '\t' +'\t'.join(vals) + '\n')
+                for row in xrange(len(matrix)):
+                    out.write(rownam[row] + '\t' + '\t'.join(
+                        str(v) if v == v else 'NaN'
+                        for v in matrix[row]) + '\n')
                 out.close()
 
-            try:
-                # This eighs is very very fast, only ask for one eigvector
-                _, evect = eigsh(array(matrix), k=ev_index[count] if ev_index else 2)
-            except (LinAlgError, ValueError):
-                warn('Chromosome %s too small to compute PC1' % (sec))
-                cmprts[sec] = [] # Y chromosome, or so...
-                count += 1
-                continue
             index = ev_index[count] if ev_index else 1
-            two_first = [list(evect[:, -1]), list(evect[:, -2])]
+            two_first = [evect[:, -1], evect[:, -2]]
             for ev_num in range(index, 3):
                 first = list(evect[:, -ev_num])
                 breaks = [i for i, (a, b) in
@@ -632,29 +765,34 @@ class HiC_data(dict):
                           if a * b < 0] + [len(first) - 1]
                 breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
                           for i, b in enumerate(breaks)]
-                if (self.resolution * (len(breaks) - 1.0) / len(matrix)
+                if (self.resolution * (len(breaks) - 1.0) / len(first)
                     > max_mean_size):
                     warn('WARNING: number of compartments found with the '
                          'EigenVector number %d is too low (%d compartments '
                          'in %d rows), for chromosome %s' % (
-                             ev_num, len(breaks), len(matrix), sec))
+                             ev_num, len(breaks), len(first), sec))
                 else:
                     break
-            if (self.resolution * (len(breaks) - 1.0) / len(matrix)
+            if (self.resolution * (len(breaks) - 1.0) / len(first)
                 > max_mean_size):
                 warn('WARNING: keeping first eigenvector, for chromosome %s' % (
                     sec))
                 ev_num = 1
             ev_nums[sec] = ev_num
-            beg, end = self.section_pos[sec]
-            bads = [k - beg for k in self.bads if beg <= k <= end]
-            for evect in two_first:
-                _ = [evect.insert(b, float('nan')) for b in bads]
-            _ = [first.insert(b, 0) for b in bads]
-            _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
-                 for b in bads]
-            _ = [matrix[i].insert(b, float('nan'))
-                 for b in bads for i in xrange(len(first))]
+            # filtered columns are NaN in the eigenvectors, zero in the one
+            # used to find compartments
+            for num, vect in enumerate(two_first):
+                two_first[num] = empty(len(kept))
+                two_first[num].fill(float('nan'))
+                two_first[num][kept] = vect
+            first = zeros(len(kept))
+            first[kept] = evect[:, -ev_num]
+            first = first.tolist()
+            two_first = [vect.tolist() for vect in two_first]
+            if saveev:
+                self._write_eigenvectors(
+                    os.path.join(saveev, '%s_EigVect%s' % (sec, suffix)),
+                    two_first, binary)
             breaks = [i for i, (a, b) in
                       enumerate(zip(first[1:], first[:-1]))
                       if a * b < 0] + [len(first) - 1]
@@ -709,7 +847,9 @@ class HiC_data(dict):
                 plot_compartments_summary(
                     sec, cmprts, show,
                     savefig + '/chr' + sec + suffix + '_summ.pdf' if savefig else None)
-            count += 1
+        if n_cpus > 1:
+            pool.close()
+            pool.join()
 
         if label_compartments == 'hmm':
             x = {}
@@ -796,11 +936,61 @@ class HiC_data(dict):
                                     ev_nums=ev_nums)
         return firsts
 
+    def _compartment_jobs(self, secs, ev_index, need_corr, savecorr):
+        """
+        Yields, for each chromosome, the arguments of
+        :func:`_compartment_eigenvectors`, with the observed/expected
+        interactions of the chromosome (upper triangle, in float32)
+        """
+        rows, cols, vals = self._coo()
+        size = len(self)
+        bad = zeros(size, dtype=bool)
+        bad[[b for b in self.bads if b < size]] = True
+        keep = (rows <= cols) & ~(bad[rows] | bad[cols])
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+        # sort cells by chromosome
+        ends = array(sorted(self.section_pos[sec][1] for sec in secs))
+        crm = searchsorted(ends, rows, side='right')
+        order = crm.argsort(kind='mergesort')
+        rows, cols, vals, crm = rows[order], cols[order], vals[order], crm[order]
+        bias = array([self.bias.get(i, 1.) for i in xrange(size)])
+        expct = self.expected
+        for count, sec in enumerate(secs):
+            beg, end = self.section_pos[sec]
+            num = searchsorted(ends, end)
+            first, last = searchsorted(crm, [num, num + 1])
+            srows, scols = rows[first:last], cols[first:last]
+            inside = (srows >= beg) & (scols < end)
+            srows, scols = srows[inside], scols[inside]
+            expc = array([expct[d] for d in xrange(end - beg)])
+            oe = (vals[first:last][inside].astype(float64) / expc[scols - srows]
+                  / bias[srows] / bias[scols]).astype(float32)
+            corr_file = (os.path.join(savecorr, '%s_corr-matrix.npy' % (sec))
+                         if savecorr else None)
+            yield (srows - beg, scols - beg, oe, ~bad[beg:end],
+                   ev_index[count] if ev_index else 2, need_corr, corr_file)
+
+    @staticmethod
+    def _write_eigenvectors(fname, two_first, binary):
+        """
+        writes the two first eigenvectors of a chromosome, one per column, in
+        a text file, or in a NumPy binary file
+        """
+        if binary:
+            npsave(fname + '.npy', array(two_first, dtype=float32).T)
+            return
+        out = open(fname + '.tsv', 'w')
+        out.write('# first EV\tsecond EV\n')
+        out.write('\n'.join(['\t'.join([str(v) for v in vs])
+                             for vs in zip(*two_first)]))
+        out.close()
+
     def _apply_metric(self, cmprts, sec, rich_in_A, how='ratio'):
         """
         calculate compartment internal density if no rich_in_A, otherwise
         sum this list
         """
+        expc = self.expected
         for cmprt in cmprts[sec]:
             if rich_in_A:
                 beg1, end1 = cmprt['start'], cmprt['end'] + 1
@@ -815,20 +1005,20 @@ class HiC_data(dict):
                 beg, end = self.section_pos[sec]
                 beg1, end1 = cmprt['start'] + beg, cmprt['end'] + beg + 1
                 if 'diagonal' in how:
-                    sec_matrix = [(self[i,i] / self.expected[0] / self.bias[i]**2)
+                    sec_matrix = [(self[i,i] / expc[0] / self.bias[i]**2)
                                   for i in xrange(beg1, end1) if not i in self.bads]
                 else: #if 'compartment' in how:
-                    sec_matrix = [(self[i,j] / self.expected[abs(j-i)]
+                    sec_matrix = [(self[i,j] / expc[abs(j-i)]
                                    / self.bias[i] / self.bias[j])
                                   for i in xrange(beg1, end1) if not i in self.bads
                                   for j in xrange(beg1, end1) if not j in self.bads]
                 if '/compartment' in how: # diagonal / compartment
-                    sec_column = [(self[i,j] / self.expected[abs(j-i)]
+                    sec_column = [(self[i,j] / expc[abs(j-i)]
                                    / self.bias[i] / self.bias[j])
                                   for i in xrange(beg1, end1) if not i in self.bads
                                   for j in xrange(beg1, end1) if not j in self.bads]
                 elif '/column' in how:
-                    sec_column = [(self[i,j] / self.expected[abs(j-i)]
+                    sec_column = [(self[i,j] / expc[abs(j-i)]
                                    / self.bias[i] / self.bias[j])
                                   for i in xrange(beg1, end1) if not i in self.bads
                                   for j in range(beg, end)
@@ -966,6 +1156,325 @@ class HiC_data(dict):
                            [0] + 
                            [self[i, j] for j in xrange(i + 1, end1)])
 
+class SparseHiC_data(HiC_data):
+    """
+    Same as :class:`HiC_data`, but interactions are stored in NumPy arrays
+    (Compressed Sparse Row format) instead of in a dictionary. Memory usage is
+    much lower (about 12 bytes per non-zero cell), and sums over the matrix are
+    vectorized.
+
+    Cells are accessed exactly as in :class:`HiC_data`, through their flat
+    index (row * size + col) or through (row, col) tuples.
+    """
+    def __init__(self, items, size, chromosomes=None, dict_sec=None,
+                 resolution=1, masked=None, symmetricized=False):
+        super(SparseHiC_data, self).__init__(
+            (), size, chromosomes=chromosomes, dict_sec=dict_sec,
+            resolution=resolution, masked=masked, symmetricized=symmetricized)
+        self._pending = {}
+        if isspmatrix(items):
+            self._csr = csr_matrix(items)
+            self._csr.sort_indices()
+            return
+        if isinstance(items, dict):
+            items = items.iteritems()
+        items = list(items)
+        if items:
+            keys, vals = zip(*items)
+            rows, cols = divmod(array(keys, dtype=int64), size)
+            vals = array(vals)
+        else:
+            rows = cols = vals = array([], dtype=int64)
+        self._csr = csr_matrix((vals, (rows, cols)), shape=(size, size))
+        self._csr.sort_indices()
+
+    def __reduce__(self):
+        self._consolidate()
+        return (self.__class__, ((), len(self)), self.__dict__)
+
+    def _consolidate(self):
+        """
+        merges cells set one by one (through __setitem__) into the sparse
+        arrays, and adjusts the shape of these arrays to the size of the matrix
+        """
+        size = len(self)
+        if not self._pending and self._csr.shape == (size, size):
+            return
+        csr = self._csr
+        rows = repeat(arange(csr.shape[0], dtype=int64), diff(csr.indptr))
+        cols = csr.indices.astype(int64)
+        vals = csr.data
+        if self._pending:
+            keys = array(self._pending.keys(), dtype=int64)
+            news = array(self._pending.values())
+            keep = ~in1d(rows * size + cols, keys)
+            prows, pcols = divmod(keys, size)
+            rows = concatenate((rows[keep], prows))
+            cols = concatenate((cols[keep], pcols))
+            vals = concatenate((vals[keep], news))
+        inside = (rows < size) & (cols < size)
+        self._csr = csr_matrix((vals[inside], (rows[inside], cols[inside])),
+                               shape=(size, size))
+        self._csr.eliminate_zeros()
+        self._csr.sort_indices()
+        self._pending = {}
+
+    def _coo(self):
+        """
+        :returns: row indexes, column indexes and values of the non-zero cells
+        """
+        self._consolidate()
+        csr = self._csr
+        return (repeat(arange(csr.shape[0], dtype=int64), diff(csr.indptr)),
+                csr.indices.astype(int64), csr.data)
+
+    def _bads_mask(self, bads):
+        mask = zeros(len(self), dtype=bool)
+        bads = [b for b in bads if b < len(self)] if bads else []
+        mask[bads] = True
+        return mask
+
+    def _bias_array(self, bias):
+        return array([bias.get(i, 1.) for i in xrange(len(self))], dtype=float)
+
+    def get(self, pos, default=None):
+        try:
+            return self._pending[pos]
+        except KeyError:
+            pass
+        size = len(self)
+        if self._csr.shape[0] != size:
+            self._consolidate()
+        row, col = divmod(pos, size)
+        if not 0 <= row < size:
+            return default
+        csr = self._csr
+        beg, end = csr.indptr[row], csr.indptr[row + 1]
+        idx = beg + csr.indices[beg:end].searchsorted(col)
+        if idx < end and csr.indices[idx] == col:
+            return csr.data[idx].item()
+        return default
+
+    def __setitem__(self, row_col, val):
+        size = len(self)
+        try:
+            row, col = row_col
+            pos = row * size + col
+        except TypeError:
+            pos = row_col
+        if pos > self._size2:
+            raise IndexError(
+                'ERROR: position %d larger than %s^2' % (pos, size))
+        self._pending[pos] = val
+        self._version += 1
+
+    def __contains__(self, pos):
+        return self.get(pos) is not None
+
+    has_key = __contains__
+
+    def __eq__(self, other):
+        if isinstance(other, SparseHiC_data):
+            other = dict(other.iteritems())
+        return dict(self.iteritems()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def iteritems(self, chunk=1000000):
+        rows, cols, vals = self._coo()
+        size = len(self)
+        for beg in xrange(0, len(vals), chunk):
+            end = beg + chunk
+            for item in izip((rows[beg:end] * size + cols[beg:end]).tolist(),
+                             vals[beg:end].tolist()):
+                yield item
+
+    def iterkeys(self):
+        for k, _ in self.iteritems():
+            yield k
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        for _, v in self.iteritems():
+            yield v
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def add_counts(self, rows, cols, counts=None):
+        """
+        Adds interaction counts to a list of cells at once (duplicated cells
+        are summed).
+
+        :param rows: list or array of row indexes
+        :param cols: list or array of column indexes
+        :param None counts: list or array of values to add (by default one per
+           cell)
+        """
+        self._consolidate()
+        size = len(self)
+        rows = asarray(rows)
+        if counts is None:
+            counts = ones(len(rows), dtype=int64)
+        self._csr = self._csr + csr_matrix((counts, (rows, asarray(cols))),
+                                           shape=(size, size))
+        self._csr.sort_indices()
+
+    def get_hic_data_as_csr(self):
+        """
+        Returns a scipy sparse matrix in Compressed Sparse Row format of the HiC
+        data
+
+        :returns: scipy sparse matrix in Compressed Sparse Row format
+        """
+        self._consolidate()
+        return self._csr.astype(float)
+
+    def get_as_tuple(self):
+        self._consolidate()
+        return tuple(self._csr.toarray().T.ravel().tolist())
+
+    def get_as_band(self, width, remove=None):
+        rows, cols, vals = self._coo()
+        return _band_cells(rows, cols, vals, len(self), width, remove)
+
+    def sum(self, bias=None, bads=None):
+        """
+        Sum Hi-C data matrix
+        WARNING: parameters are not meant to be used by external users
+
+        :params None bias: expects a dictionary of biases to use normalized matrix
+        :params None bads: extends computed bad columns
+
+        :returns: the sum of the Hi-C matrix skipping bad columns
+        """
+        bads = bads or self.bads
+        rows, cols, vals = self._coo()
+        bad = self._bads_mask(bads)
+        keep = ~(bad[rows] | bad[cols])
+        vals = vals[keep]
+        if bias:
+            bias = self._bias_array(bias)
+            vals = vals / (bias[rows[keep]] * bias[cols[keep]])
+        return vals.sum().item()
+
+    def _intra_sum(self, sections, bads, diagonal, normalized):
+        rows, cols, vals = self._coo()
+        bad = self._bads_mask(bads)
+        keep = (searchsorted(sections, rows, side='right') ==
+                searchsorted(sections, cols, side='right'))
+        keep &= ~(bad[rows] | bad[cols])
+        if not diagonal:
+            keep &= rows != cols
+        vals = vals[keep]
+        if normalized:
+            bias = self._bias_array(self.bias)
+            vals = vals / bias[rows[keep]] / bias[cols[keep]]
+        return vals.sum().item()
+
+def _band_cells(rows, cols, vals, size, width, remove=None):
+    """
+    Diagonals of a matrix given by its non-zero cells, and cells out of these
+    diagonals (see :func:`HiC_data.get_as_band`). Only cells of the upper
+    triangle are used.
+    """
+    kept = ones(size, dtype=bool)
+    if remove:
+        kept[array(remove, dtype=bool)] = False
+    renum = cumsum(kept) - 1
+    nkept = int(kept.sum())
+    inside = (rows < size) & (cols < size)
+    rows, cols, vals = rows[inside], cols[inside], vals[inside]
+    keep = kept[rows] & kept[cols]
+    rows, cols, vals = renum[rows[keep]], renum[cols[keep]], vals[keep]
+    dist = cols - rows
+    keep = (dist >= 0) & (dist <= width)
+    band = zeros((width + 1) * nkept, dtype=int32)
+    band[rows[keep] + dist[keep] * nkept] = vals[keep]
+    out = (dist > width) & (vals != 0)
+    off = array([rows[out], cols[out], vals[out]], dtype=int32).T.flatten()
+    return band, off
+
+
+def _compartment_eigenvectors(args):
+    """
+    Computes the leading eigenvectors of the correlation matrix of the
+    observed/expected matrix of a chromosome, without building the correlation
+    matrix (the product by a vector is computed from the sparse matrix), and
+    the correlation matrix itself, by blocks of rows, if needed.
+
+    :param args: row and column indexes (in the chromosome) and
+       observed/expected values of the upper triangle, boolean array of the
+       valid columns of the chromosome, number of eigenvectors, whether to
+       return the correlation matrix, and path to a NumPy binary file where to
+       write it (or None)
+
+    :returns: a status ('empty', 'small' or 'ok'), the eigenvectors (one per
+       valid column) and the correlation matrix (with NaN for filtered
+       columns), or None if not asked or written to a file
+    """
+    rows, cols, vals, kept, nev, need_corr, corr_file = args
+    size = int(kept.sum())
+    if size < 2:
+        return 'empty', None, None
+    renum = cumsum(kept) - 1
+    rows, cols = renum[rows], renum[cols]
+    # symmetric matrix
+    offd = rows != cols
+    rows, cols = concatenate((rows, cols[offd])), concatenate((cols, rows[offd]))
+    vals = concatenate((vals, vals[offd]))
+    oe_mat = csr_matrix((vals, (rows, cols)), shape=(size, size), dtype=float32)
+    # each row is centered and scaled, as in numpy.corrcoef
+    vals = vals.astype(float64)
+    means = bincount(rows, weights=vals, minlength=size) / size
+    scale = npsqrt(clip(bincount(rows, weights=vals**2, minlength=size)
+                        - size * means**2, 0, None))
+
+    def matvec(vect):
+        vect = vect.ravel() / scale
+        tmp = oe_mat.dot(vect) - means.dot(vect)
+        return (oe_mat.dot(tmp) - means * tmp.sum()) / scale
+
+    corr = None
+    if need_corr or corr_file or nev >= size - 1:
+        if corr_file:
+            corr = open_memmap(corr_file, mode='w+', dtype=float32,
+                               shape=(len(kept), len(kept)))
+        else:
+            corr = empty((len(kept), len(kept)), dtype=float32)
+        corr.fill(float('nan'))
+        idx = flatnonzero(kept)
+        oe_mat64 = oe_mat.astype(float64)
+        step = max(1, 2**23 / size)
+        for beg in xrange(0, size, step):
+            end = min(beg + step, size)
+            block = oe_mat64.dot(oe_mat64[beg:end].toarray().T).T
+            block -= size * outer(means[beg:end], means)
+            block /= outer(scale[beg:end], scale)
+            corr[idx[beg:end, None], idx] = clip(block, -1, 1)
+    try:
+        if nev >= size - 1:
+            # too small for the iterative solver
+            _, evect = eigsh(array(corr[kept][:, kept], dtype=float64), k=nev)
+        else:
+            _, evect = eigsh(LinearOperator((size, size), matvec=matvec,
+                                            dtype=float64), k=nev)
+    except (LinAlgError, ValueError):
+        return 'small', None, None
+    if corr_file:
+        corr.flush()
+        corr = None
+    return 'ok', evect, corr if need_corr else None
+
+
 def _hmm_refine_compartments(x, sec, models, bads, verbose):
     prevll = float('-inf')
     prevdf = 0
@@ -1040,8 +1549,8 @@ def _cluster_ab_compartments(gamma, matrix, breaks, cmprtsec, rich_in_A, save=Tr
         scores[(k,k)] = dist_matrix[k][k] = -1
         for l in xrange(k + 1, len(cmprtsec)):
             beg2, end2 = cmprtsec[l]['start'], cmprtsec[l]['end'] + 1
-            val = nansum([matrix[i][j] for i in xrange(beg1, end1)
-                          for j in xrange(beg2, end2)]) / (end2 - beg2) / diff1
+            val = float(nansum(matrix[beg1:end1, beg2:end2], dtype=float64)
+                        ) / (end2 - beg2) / diff1
             try:
                 scores[(k,l)] = dist_matrix[k][l] = scores[(l,k)] = dist_matrix[l][k] = func(val)
             except ZeroDivisionError:
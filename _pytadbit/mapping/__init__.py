@@ -1,9 +1,15 @@
 from pytadbit.utils.file_handling         import mkdir
 from pytadbit.mapping.restriction_enzymes import map_re_sites
 from itertools                            import combinations
-from os                                   import path, system
+from os                                   import path, remove, rmdir
 from sys                                  import stdout
-from collections import OrderedDict
+from shutil                               import copyfileobj
+import multiprocessing as mu
+import gzip
+from pytadbit.parsers.pairs_parser        import is_binary_pairs, PairsWriter
+from pytadbit.parsers.pairs_parser        import read_pairs_header
+from pytadbit.parsers.pairs_parser        import iter_pairs_lines
+from pytadbit.parsers.pairs_parser        import index_pairs
 
 def eq_reads(rd1, rd2):
     """
@@ -20,81 +26,69 @@ def gt_reads(rd1, rd2):
 def merge_2d_beds(path1, path2, outpath):
     """
     Merge two result files (file resulting from get_intersection or from
-       the filtering) into one.
+       the filtering) into one. Files can be in text or binary format (see
+       :mod:`pytadbit.parsers.pairs_parser`), the output is written in the
+       format of the first file.
 
     :param path1: path to first file
     :param path2: path to first file
 
     :returns: number of reads processed
     """
-    fh1 = open(path1)
-    fh2 = open(path2)
     # parse header
-    chromosomes = OrderedDict()
-    parsed = 0
-    for line in fh1:
-        if not line.startswith('#'):
-            break
-        parsed += len(line)
-        if not line.startswith('# CRM'):
-            continue
-        _, _, crm, val = line.split()
-        chromosomes[crm] = val
-    fh1.seek(parsed)
-    # check other headers
-    parsed = 0
-    for line in fh2:
-        if not line.startswith('#'):
-            break
-        parsed += len(line)
-        if not line.startswith('# CRM'):
-            continue
-        _, _, crm, val = line.split()
-        if chromosomes[crm] != val:
+    _, chromosomes = read_pairs_header(path1)
+    _, chromosomes2 = read_pairs_header(path2)
+    for crm in chromosomes2:
+        if chromosomes[crm] != chromosomes2[crm]:
             raise Exception('ERROR: files are the result of mapping on '
                             'different reference genomes')
-    fh2.seek(parsed)
+    fh1 = iter_pairs_lines(path1)
+    fh2 = iter_pairs_lines(path2)
     # comparison function
     greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
     # write headers
-    out = open(outpath, 'w')
-    for crm in chromosomes:
-        out.write('# CRM %s\t%s\n' % (crm, chromosomes[crm]))
+    header = ''.join('# CRM %s\t%d\n' % (crm, chromosomes[crm])
+                     for crm in chromosomes)
+    if is_binary_pairs(path1):
+        out = PairsWriter(outpath, header)
+        write = out.write_line
+    else:
+        out = open(outpath, 'w')
+        out.write(header)
+        write = out.write
     # merge sort the two files
     read1 = fh1.next()
     read2 = fh2.next()
     nreads = 0
     while True:
         if greater(read2, read1):
-            out.write(read1)
+            write(read1)
             nreads += 1
             try:
                 read1 = fh1.next()
             except StopIteration:
-                out.write(read2)
+                write(read2)
                 nreads += 1
                 break
         else:
-            out.write(read2)
+            write(read2)
             nreads += 1
             try:
                 read2 = fh2.next()
             except StopIteration:
-                out.write(read1)
+                write(read1)
                 nreads += 1
                 break
     for read in fh1:
-        out.write(read)
+        write(read)
         nreads += 1
     for read in fh2:
-        out.write(read)
+        write(read)
         nreads += 1
-    fh1.close()
-    fh2.close()
     out.close()
     return nreads
     
-def get_intersection(fname1, fname2, out_path, verbose=False):
+def get_intersection(fname1, fname2, out_path, verbose=False, **kwargs):
     """
     Merges the two files corresponding to each reads sides. Reads found in both
        files are merged and written in an output file.
@@ -109,19 +103,38 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
           - otherwise, they are merged into one longer (as if they were mapped
             in the positive strand)
 
+    Pairs of reads are first distributed into temporary files (buckets) by
+    genomic position, then each bucket is sorted and appended to the output.
+    The output is indexed (see :func:`pytadbit.parsers.pairs_parser.index_pairs`)
+    in order to load genomic regions without reading the whole file.
+
     :param fname1: path to a tab separated file generated by the function
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param fname2: path to a tab separated file generated by the function
        :func:`pytadbit.parsers.sam_parser.parse_sam`
     :param out_path: path to an outfile. It will written in a similar format as
        the inputs
+    :param 1 nthreads: number of processes used to sort the buckets
+    :param 1000 max_memory: maximum memory (in Mb) used by all the processes
+       sorting buckets, used to choose the number of buckets
+    :param None nbuckets: number of buckets (by default computed from the
+       size of the input files and max_memory, between 16 and
+       MAX_BUCKETS)
+    :param False compress: compress (gzip, fast) the buckets, to reduce disk
+       usage
+    :param MAX_OPEN_BUCKETS max_files: maximum number of buckets kept open while
+       reads are distributed, the others are reopened (appending) each time
+       reads are written into them
 
     :returns: final number of pair of interacting fragments, and a dictionary with
        the number of multiple contacts (keys of the dictionary being the number of
        fragment cought together, can be 3, 4, 5..)
     """
-    
-    # Get the headers of the two files 
+    nthreads = kwargs.get('nthreads', 1)
+    compress = kwargs.get('compress', False)
+    max_files = kwargs.get('max_files', MAX_OPEN_BUCKETS)
+
+    # Get the headers of the two files
     reads1 = open(fname1)
     line1 = reads1.next()
     header1 = ''
@@ -144,7 +157,6 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
 
     # prepare to write read pairs into different files
     # depending on genomic position
-    nchunks = 1024
     global CHROM_START
     CHROM_START = {}
     cum_pos = 0
@@ -153,13 +165,24 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
             _, _, crm, pos = line.split()
             CHROM_START[crm] = cum_pos
             cum_pos += int(pos)
+    nchunks = kwargs.get('nbuckets', None) or _count_buckets(
+        (path.getsize(fname1) + path.getsize(fname2)),
+        kwargs.get('max_memory', 1000), nthreads)
+    nchunks = max(1, min(nchunks, cum_pos))
     lchunk = cum_pos / nchunks
-    buf = dict([(i, []) for i in xrange(nchunks + 1)])
-    # prepare temporary directories
+    buf = dict([(i, []) for i in xrange(cum_pos / lchunk + 1)])
+    # prepare temporary files, the max_files first are kept open while reads
+    # are distributed, the others are only created here
     tmp_dir = out_path + '_tmp_files'
     mkdir(tmp_dir)
-    for i in xrange(nchunks / int(nchunks**0.5) + 1):
-        mkdir(path.join(tmp_dir, 'rep_%03d' % i))
+    tmp_files = [path.join(tmp_dir, 'tmp_%05d.tsv' % b) +
+                 ('.gz' if compress else '') for b in buf]
+    buckets = []
+    for b, fnam in enumerate(tmp_files):
+        buckets.append(_open_bucket(fnam, 'w'))
+        if b >= max_files:
+            buckets[b].close()
+            buckets[b] = fnam
 
     # iterate over reads in each of the two input files
     # and store them into a dictionary and then into temporary files
@@ -199,11 +222,13 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
                 else:
                     line1 = reads1.next()
                     read1 = line1.split('\t', 1)[0]
-            write_to_files(buf, tmp_dir, nchunks)
+            write_to_files(buf, buckets)
     except StopIteration:
         reads1.close()
         reads2.close()
-    write_to_files(buf, tmp_dir, nchunks)
+    write_to_files(buf, buckets)
+    for out in buckets[:max_files]:
+        out.close()
     if verbose:
         print '\nFound %d pair of reads mapping uniquely' % count
 
@@ -212,26 +237,97 @@ def get_intersection(fname1, fname2, out_path, verbose=False):
     # sort also according to read 2 (to filter duplicates)
     #      and also according to strand
     if verbose:
-        print 'Sorting easch temporary file by genomic coordinate'
+        print 'Sorting each temporary file by genomic coordinate'
 
     out = open(out_path, 'w')
     out.write(header1)
-    for b in buf:
+    if nthreads > 1:
+        # buckets are sorted in parallel into new temporary files, appended
+        # to the output in order as soon as they are ready
+        pool = mu.Pool(nthreads)
+        procs = [pool.apply_async(_sort_bucket, args=(fnam, fnam + '_sorted'))
+                 for fnam in tmp_files]
+        pool.close()
+    for b, fnam in enumerate(tmp_files):
         if verbose:
             stdout.write('\r    %4d/%d sorted files' % (b + 1, len(buf)))
             stdout.flush()
-        out.write(''.join(['\t'.join(l[1:]) for l in sorted(
-            [l.split('\t') for l in open(
-                path.join(tmp_dir, 'rep_%03d' % (b / int(nchunks**0.5)),
-                          'tmp_%05d.tsv' % b))],
-            key=lambda x: (x[0], x[8], x[9], x[6]))]))
+        if nthreads > 1:
+            procs[b].get()
+            sorted_reads = open(fnam + '_sorted')
+            copyfileobj(sorted_reads, out)
+            sorted_reads.close()
+            remove(fnam + '_sorted')
+        else:
+            _sort_bucket(fnam, out)
+    if nthreads > 1:
+        pool.join()
     out.close()
+    # reads are sorted by position of the first read-end
+    index_pairs(out_path)
 
     if verbose:
         print '\nRemoving temporary files...'
-    system('rm -rf ' + tmp_dir)
+    try:
+        rmdir(tmp_dir)
+    except OSError: # not empty, may contain older files
+        pass
     return count, multiples
 
+# maximum number of buckets used to sort pairs of reads
+MAX_BUCKETS = 1024
+
+# maximum number of buckets opened at once (well below the usual limit of
+# 1024 opened files)
+MAX_OPEN_BUCKETS = 256
+
+# approximate memory needed to sort the reads of a bucket, relative to their
+# size on disk
+_SORT_OVERHEAD = 8
+
+def _count_buckets(size, max_memory, nthreads):
+    """
+    Number of buckets needed to sort pairs of reads, each process sorting one
+    bucket at a time within its part of max_memory (in Mb). The size of the
+    pairs of reads is approximated by the size of the two input files.
+    """
+    per_bucket = max_memory * 1024 * 1024 / nthreads / _SORT_OVERHEAD
+    return min(MAX_BUCKETS, max(16, nthreads * 4, size / per_bucket + 1))
+
+def _open_bucket(fnam, mode='r'):
+    if fnam.endswith('.gz'):
+        return gzip.open(fnam, mode + 'b', compresslevel=1)
+    return open(fnam, mode)
+
+def _bucket_key(line):
+    """
+    Sorting key of pairs of reads in buckets: genomic position of the
+    upstream read, chromosome and position of the downstream read, and RE
+    fragment of the upstream read.
+    """
+    elts = line.split('\t', 10)
+    return int(elts[0]), elts[8], elts[9], elts[6]
+
+def _sort_bucket(fnam, out):
+    """
+    Sorts the pairs of reads of a bucket (removing the first column, used to
+    sort them) and removes it.
+
+    :param fnam: path to the bucket
+    :param out: file handler, or path to an output file
+    """
+    fhandler = _open_bucket(fnam)
+    lines = fhandler.readlines()
+    fhandler.close()
+    remove(fnam)
+    lines.sort(key=_bucket_key)
+    if isinstance(out, str):
+        out = open(out, 'w')
+        out.writelines([l[l.index('\t') + 1:] for l in lines])
+        out.close()
+    else:
+        out.writelines([l[l.index('\t') + 1:] for l in lines])
+
 def _loc_reads(r1, r2):
     """
     put upstream read before, get position in buf
@@ -243,14 +339,24 @@ def _loc_reads(r1, r2):
         pos1, pos2 = pos2, pos1
     return r1, r2, pos1
 
-def write_to_files(buf, tmp_dir, nchunks):
+def write_to_files(buf, buckets):
+    """
+    Appends pairs of reads to the files of each bucket, and empties the
+    buffer.
+
+    :param buf: dictionary with bucket numbers as keys, and lists of pairs of
+       reads (as text) as values
+    :param buckets: list of opened files, or of paths to files opened in append
+       mode, one per bucket
+    """
     for b in buf:
-        out = open(path.join(tmp_dir, 'rep_%03d' % (b / int(nchunks**0.5)),
-                             'tmp_%05d.tsv' % b), 'a')
-        out.write('\n'.join(buf[b]))
         if buf[b]: # case the file was empty
-            out.write('\n')
-        out.close()
+            if isinstance(buckets[b], str):
+                out = _open_bucket(buckets[b], 'a')
+                out.write('\n'.join(buf[b]) + '\n')
+                out.close()
+            else:
+                buckets[b].write('\n'.join(buf[b]) + '\n')
         del(buf[b][:])
 
 def _process_lines(line1, line2, buf, multiples, lchunk):
@@ -318,5 +424,15 @@ def _process_lines(line1, line2, buf, multiples, lchunk):
             r1, r2, idx = _loc_reads(elts1.values()[0], elts2.values()[0])
             buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
     else:
-        r1, r2, idx = _loc_reads(line1.strip().split('\t'), line2.strip().split('\t'))
-        buf[idx / lchunk].append('%d\t%s\t%s' % (idx, '\t'.join(r1), '\t'.join(r2[1:])))
+        # only the position of each read is needed to write the pair
+        line1 = line1.strip()
+        line2 = line2.strip()
+        _, crm1, pos1, _ = line1.split('\t', 3)
+        _, crm2, pos2, _ = line2.split('\t', 3)
+        pos1 = CHROM_START[crm1] + int(pos1)
+        pos2 = CHROM_START[crm2] + int(pos2)
+        if pos1 > pos2:
+            line1, line2 = line2, line1
+            pos1 = pos2
+        buf[pos1 / lchunk].append('%d\t%s\t%s' % (
+            pos1, line1, line2[line2.index('\t') + 1:]))
@@ -5,10 +5,14 @@
 from pytadbit                     import HiC_data
 from pytadbit.utils.extraviews    import tadbit_savefig, setup_plot
 from pytadbit.utils.tadmaths      import nozero_log_matrix as nozero_log
-from pytadbit.utils.tadmaths      import right_double_mad as mad
+from pytadbit.utils.tadmaths      import hist_percentile
+from pytadbit.utils.tadmaths      import hist_right_double_mad as hist_mad
 from warnings                     import warn
 from collections                  import OrderedDict
 from pytadbit.parsers.hic_parser  import load_hic_data_from_reads
+from pytadbit.parsers.pairs_parser import is_binary_pairs, read_pairs_header
+from pytadbit.parsers.pairs_parser import iter_pairs_blocks
+from pytadbit.mapping.reads_stats import ReadsStats, reads_stats
 from pytadbit.utils.extraviews    import nicer
 from pytadbit.utils.file_handling import mkdir
 from scipy.stats                  import norm as sc_norm, skew, kurtosis
@@ -73,6 +77,9 @@ def hic_map(data, resolution=None, normalized=False, masked=None,
        Default is equal to resolution of the matrix.
     """
     if isinstance(data, str):
+        # only the chromosome in focus is loaded
+        if isinstance(focus, str) and not 'region' in kwargs:
+            kwargs['region'] = focus
         data = load_hic_data_from_reads(data, resolution=resolution, **kwargs)
         if not kwargs.get('get_sections', True) and decay:
             warn('WARNING: not decay not available when get_sections is off.')
@@ -373,7 +380,11 @@ def plot_distance_vs_interactions(data, min_diff=1, max_diff=1000, show=False,
                                   genome_seq=None, resolution=None, axe=None,
                                   savefig=None, normalized=False):
     """
-    :param data: input file name, or HiC_data object or list of lists
+    :param data: input file name (reads in text or binary format),
+       statistics of the reads (see
+       :func:`pytadbit.mapping.reads_stats.get_reads_stats`, in which case
+       the resolution should be 1 or the resolution of the statistics), or
+       HiC_data object or list of lists
     :param 10 min_diff: lower limit (in number of bins)
     :param 1000 max_diff: upper limit (in number of bins) to look for
     :param 100 resolution: group reads that are closer than this resolution
@@ -388,7 +399,27 @@ def plot_distance_vs_interactions(data, min_diff=1, max_diff=1000, show=False,
     """
     resolution = resolution or 1
     dist_intr = dict([(i, 0) for i in xrange(min_diff, max_diff)])
-    if isinstance(data, str):
+    if isinstance(data, ReadsStats):
+        if resolution == 1 and max_diff <= data.max_diff:
+            counts = data.dist_nts
+        elif resolution == data.resolution:
+            counts = data.dist_bins
+        else:
+            raise ValueError(('ERROR: statistics of the reads computed at '
+                              'resolution %d\n') % data.resolution)
+        for diff in xrange(min_diff, min(max_diff, len(counts))):
+            dist_intr[diff] += int(counts[diff])
+    elif isinstance(data, str) and is_binary_pairs(data):
+        for block in iter_pairs_blocks(data, columns=('crm1', 'pos1',
+                                                      'crm2', 'pos2')):
+            intra = block['crm1'] == block['crm2']
+            diffs = abs(block['pos1'][intra] / resolution -
+                        block['pos2'][intra] / resolution)
+            diffs = diffs[(diffs >= min_diff) & (diffs < max_diff)]
+            for diff, val in enumerate(np.bincount(diffs)):
+                if val:
+                    dist_intr[diff] += int(val)
+    elif isinstance(data, str):
         fhandler = open(data)
         line = fhandler.next()
         while line.startswith('#'):
@@ -407,23 +438,12 @@ def plot_distance_vs_interactions(data, min_diff=1, max_diff=1000, show=False,
             pass
         fhandler.close()
     elif isinstance(data, HiC_data):
-        if normalized:
-            get_data = lambda x, y: data[x, y] / data.bias[x] / data.bias[y]
-        else:
-            get_data = lambda x, y: data[x, y]
         max_diff = min(len(data), max_diff)
-        if data.section_pos:
-            for crm in data.section_pos:
-                for diff in xrange(min_diff, min(
-                    (max_diff, 1 + data.chromosomes[crm]))):
-                    for i in xrange(data.section_pos[crm][0],
-                                    data.section_pos[crm][1] - diff):
-                        dist_intr[diff] += get_data(i, i + diff)
-        else:
-            for diff in xrange(min_diff, max_diff):
-                for i in xrange(len(data) - diff):
-                    if not np.isnan(data[i, i + diff]):
-                        dist_intr[diff] += get_data(i, diff)
+        cis, _ = data.diagonal_sums(bads={}, normalized=normalized)
+        for crm in cis:
+            sums = cis[crm]['norm' if normalized else 'raw']
+            for diff in xrange(min_diff, min(max_diff, len(sums))):
+                dist_intr[diff] += sums[diff]
     else:
         if genome_seq:
             max_diff = min(max(genome_seq.values()), max_diff)
@@ -627,7 +647,9 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
                  show=False, xlog=False, stats=('median', 'perc_max')):
     """
     Plots the distribution of dangling-ends lengths
-    :param fnam: input file name
+    :param fnam: input file name, or statistics of the reads (see
+       :func:`pytadbit.mapping.reads_stats.get_reads_stats`), in which case
+       all the dangling-ends are used
     :param None savefig: path where to store the output images.
     :param 99.9 max_size: top percentage of distances to consider, within the
        top 0.01% are usually found very long outliers.
@@ -645,42 +667,63 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
     :returns: the median value and the percentile inputed as max_size.
     """
     distr = {}
-    genome_seq = OrderedDict()
-    fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        if line.startswith('# CRM '):
-            crm, clen = line[6:].split()
-            genome_seq[crm] = int(clen)
-        line = fhandler.next()
     des = []
     if nreads:
         nreads /= 2
-    try:
-        while True:
-            (crm1, pos1, dir1, _, re1, _,
-             crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
-            if re1==re2 and crm1 == crm2 and dir1 != dir2:
-                pos1, pos2 = int(pos1), int(pos2)
-                if (pos2 > pos1) == int(dir1):
-                    des.append(abs(pos2 - pos1))
-                if len(des) == nreads:
-                    break
+    if isinstance(fnam, ReadsStats):
+        counts = fnam.dangling
+    elif is_binary_pairs(fnam):
+        for block in iter_pairs_blocks(fnam, columns=(
+            'crm1', 'pos1', 'strand1', 'rs1', 'crm2', 'pos2', 'strand2',
+            'rs2')):
+            pos1 = block['pos1']
+            pos2 = block['pos2']
+            dangling = ((block['rs1'] == block['rs2']) &
+                        (block['crm1'] == block['crm2']) &
+                        (block['strand1'] != block['strand2']) &
+                        ((pos2 > pos1) == block['strand1']))
+            des.extend(abs(pos2[dangling] - pos1[dangling]).tolist())
+            if nreads and len(des) >= nreads:
+                del des[nreads:]
+                break
+    else:
+        genome_seq = OrderedDict()
+        fhandler = open(fnam)
+        line = fhandler.next()
+        while line.startswith('#'):
+            if line.startswith('# CRM '):
+                crm, clen = line[6:].split()
+                genome_seq[crm] = int(clen)
             line = fhandler.next()
-    except StopIteration:
-        pass
-    fhandler.close()
-    max_perc = np.percentile(des, max_size)
-    perc99   = np.percentile(des, 99)
-    perc01   = np.percentile(des, 1)
-    perc50   = np.percentile(des, 50)
-    perc95   = np.percentile(des, 95)
-    perc05   = np.percentile(des, 5)
+        try:
+            while True:
+                (crm1, pos1, dir1, _, re1, _,
+                 crm2, pos2, dir2, _, re2) = line.strip().split('\t')[1:12]
+                if re1==re2 and crm1 == crm2 and dir1 != dir2:
+                    pos1, pos2 = int(pos1), int(pos2)
+                    if (pos2 > pos1) == int(dir1):
+                        des.append(abs(pos2 - pos1))
+                    if len(des) == nreads:
+                        break
+                line = fhandler.next()
+        except StopIteration:
+            pass
+        fhandler.close()
+    if not isinstance(fnam, ReadsStats):
+        counts = np.bincount(des)
+    # histogram of dangling-ends lengths
+    sizes = np.arange(len(counts))
+    max_perc = hist_percentile(sizes, counts, max_size)
+    perc99   = hist_percentile(sizes, counts, 99)
+    perc01   = hist_percentile(sizes, counts, 1)
+    perc50   = hist_percentile(sizes, counts, 50)
+    perc95   = hist_percentile(sizes, counts, 95)
+    perc05   = hist_percentile(sizes, counts, 5)
     to_return = {'median': perc50}
-    cutoff = len(des) / 100000.
+    cutoff = counts.sum() / 100000.
     count  = 0
-    for v in xrange(int(perc50), int(max(des))):
-        if des.count(v) < cutoff:
+    for v in xrange(int(perc50), len(counts) - 1):
+        if counts[v] < cutoff:
             count += 1
         else:
             count = 0
@@ -690,7 +733,7 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
     else:
         raise Exception('ERROR: not found')
     to_return['perc_max'] = max_perc
-    to_return['MAD'] = mad(des)
+    to_return['MAD'] = hist_mad(sizes, counts)
     if not savefig and not axe and not show:
         return [to_return[k] for k in stats]
     
@@ -700,7 +743,7 @@ def insert_sizes(fnam, savefig=None, nreads=None, max_size=99.9, axe=None,
     ax.axvspan(perc01, perc05, facecolor='darkolivegreen', alpha=.3)
     desapan = ax.axvspan(perc05, perc95, facecolor='darkseagreen', alpha=.3,
                          label='5-95%% DEs\n(%.0f-%.0f nts)' % (perc05, perc95))
-    deshist = ax.hist(des, bins=100, range=(0, max_perc),
+    deshist = ax.hist(sizes, weights=counts, bins=100, range=(0, max_perc),
                       alpha=.7, color='darkred', label='Dangling-ends')
     ylims   = ax.get_ylim()
     plots   = []
@@ -725,7 +768,11 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
                               axe=None, ylim=None, savefig=None, show=False,
                               savedata=None, chr_names=None, nreads=None):
     """
-    :param fnam: input file name
+    :param fnam: input file name (reads in text or binary format), or
+       statistics of the reads (see
+       :func:`pytadbit.mapping.reads_stats.get_reads_stats`), in which case
+       the resolution should be a multiple of the resolution of the
+       statistics
     :param True first_read: uses first read.
     :param 100 resolution: group reads that are closer than this resolution
        parameter
@@ -742,8 +789,6 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
     distr = {}
     idx1, idx2 = (1, 3) if first_read else (7, 9)
     genome_seq = OrderedDict()
-    fhandler = open(fnam)
-    line = fhandler.next()
     if chr_names:
         chr_names = set(chr_names)
         cond1 = lambda x: x not in chr_names
@@ -755,32 +800,64 @@ def plot_genomic_distribution(fnam, first_read=True, resolution=10000,
         cond2 = lambda x: False
     cond = lambda x, y: cond1(x) and cond2(y)
     count = 0
-    while line.startswith('#'):
-        if line.startswith('# CRM '):
-            crm, clen = line[6:].split('\t')
-            genome_seq[crm] = int(clen)
+    if isinstance(fnam, ReadsStats):
+        genome_seq = fnam.genome_seq
+        for crm, counts in fnam.genomic_distribution(
+            first_read, resolution).iteritems():
+            distr[crm] = dict((pos, int(counts[pos]))
+                              for pos in np.nonzero(counts)[0].tolist())
+    elif is_binary_pairs(fnam):
+        _, genome_seq = read_pairs_header(fnam)
+        crms = genome_seq.keys()
+        col_crm, col_pos = ('crm1', 'pos1') if first_read else ('crm2', 'pos2')
+        for block in iter_pairs_blocks(fnam, columns=(col_crm, col_pos)):
+            block_crms = block[col_crm]
+            bins = block[col_pos] / resolution
+            # same as cond, for all reads of the block
+            stop = np.where(
+                np.array([cond1(c) for c in crms], dtype=bool)[block_crms] &
+                (np.arange(count + 1, count + len(bins) + 1) >=
+                 (nreads or float('inf'))))[0]
+            if len(stop):
+                block_crms = block_crms[:stop[0]]
+                bins = bins[:stop[0]]
+            count += len(bins)
+            for c in np.unique(block_crms):
+                crm_distr = distr.setdefault(crms[c], {})
+                counts = np.bincount(bins[block_crms == c])
+                for pos in np.nonzero(counts)[0].tolist():
+                    crm_distr[pos] = crm_distr.get(pos, 0) + int(counts[pos])
+            if len(stop):
+                break
+    else:
+        fhandler = open(fnam)
         line = fhandler.next()
-    try:
-        while True:
-            crm, pos = line.strip().split('\t')[idx1:idx2]
-            count += 1
-            if cond(crm, count):
-                line = fhandler.next()
-                if cond2(count):
-                    break
-                continue
-            pos = int(pos) / resolution
-            try:
-                distr[crm][pos] += 1
-            except KeyError:
+        while line.startswith('#'):
+            if line.startswith('# CRM '):
+                crm, clen = line[6:].split('\t')
+                genome_seq[crm] = int(clen)
+            line = fhandler.next()
+        try:
+            while True:
+                crm, pos = line.strip().split('\t')[idx1:idx2]
+                count += 1
+                if cond(crm, count):
+                    line = fhandler.next()
+                    if cond2(count):
+                        break
+                    continue
+                pos = int(pos) / resolution
                 try:
-                    distr[crm][pos] = 1
+                    distr[crm][pos] += 1
                 except KeyError:
-                    distr[crm] = {pos: 1}
-            line = fhandler.next()
-    except StopIteration:
-        pass
-    fhandler.close()
+                    try:
+                        distr[crm][pos] = 1
+                    except KeyError:
+                        distr[crm] = {pos: 1}
+                line = fhandler.next()
+        except StopIteration:
+            pass
+        fhandler.close()
     if not axe:
         _ = plt.figure(figsize=(15, 1 + 3 * len(
                               chr_names if chr_names else distr.keys())))
@@ -1026,73 +1103,29 @@ def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False,
 
 def plot_rsite_reads_distribution(reads_file, outprefix, window=20,
         maxdist=1000):
-    de_right={}
-    de_left={}
-    print "process reads"
-    fl=open(reads_file)
-    while True:
-        line=fl.next()
-        if not line.startswith('#'):
-            break
-    nreads=0
-    try:
-        while True:
-            nreads += 1
-            if nreads % 1000000 == 0:
-                print nreads
-            try:
-                _, n1, sb1, sd1, l1, ru1, rd1, n2, sb2, sd2, l2, ru2, rd2\
-                        = line.split()
-                sb1, sd1, l1, ru1, rd1, sb2, sd2, l2, ru2, rd2 = \
-                        map(int, [sb1, sd1, l1, ru1, rd1, sb2, sd2, l2,
-                            ru2, rd2])
-            except ValueError:
-                print line
-                raise ValueError("line is not the right format!")
-            if n1 != n2:
-                line=fl.next()
-                continue
-            #read1 ahead of read2
-            if sb1 > sb2:
-                sb1, sd1, l1, ru1, rd1, sb2, sd2, l2, ru2, rd2 = \
-                    sb2, sd2, l2, ru2, rd2, sb1, sd1, l1, ru1, rd1
-            #direction always -> <-
-            if not (sd1 == 1 and sd2 == 0):
-                line=fl.next()
-                continue
-            #close to the diagonal
-            if sb2-sb1 > maxdist:
-                line=fl.next()
-                continue
-            #close to RE 1
-            if abs(sb1-ru1) < abs(sb1-rd1):
-                rc1=ru1
-            else:
-                rc1=rd1
-            pos=sb1-rc1
-            if abs(pos)<=window:
-                if not pos in de_right:
-                    de_right[pos]=0
-                de_right[pos]+=1
-            #close to RE 2
-            if abs(sb2-ru2) < abs(sb2-rd2):
-                rc2=ru2
-            else:
-                rc2=rd2
-            pos=sb2-rc2
-            if abs(pos)<=window:
-                if not pos in de_left:
-                    de_left[pos]=0
-                de_left[pos]+=1
-            line=fl.next()
-    except StopIteration:
-        pass
-    print "   finished processing {} reads".format(nreads)
+    """
+    :param reads_file: path to a file of pairs of reads (in text or binary
+       format), or statistics of the reads (see
+       :func:`pytadbit.mapping.reads_stats.get_reads_stats`) computed with
+       the same window and maxdist
+    :param outprefix: prefix of the output files (counts and plot)
+    :param 20 window: maximum distance to the RE site
+    :param 1000 maxdist: maximum length of the molecules
+    """
+    if isinstance(reads_file, ReadsStats):
+        stats = reads_file
+        if (stats.window, stats.maxdist) != (window, maxdist):
+            raise ValueError('ERROR: statistics of the reads computed with '
+                             'other window or maxdist\n')
+    else:
+        print "process reads"
+        stats = reads_stats(reads_file, window=window, maxdist=maxdist)
+    print "   finished processing {} reads".format(stats.nreads)
 
     #transform to arrays
     ind = range(-window,window+1)
-    de_r = map(lambda x:de_right.get(x,0), ind)
-    de_l = map(lambda x:de_left.get(x,0), ind)
+    de_r = stats.rsite_right.tolist()
+    de_l = stats.rsite_left.tolist()
 
     #write to files
     print "write to files"
@@ -1124,90 +1157,38 @@ def moving_average(a, n=3):
 
 def plot_diagonal_distributions(reads_file, outprefix, ma_window=20,
         maxdist=800, de_left=[-2,3], de_right=[0,5]):
-    rbreaks={}
-    rejoined={}
-    des={}
-    print "process reads"
-    fl=open(reads_file)
-    while True:
-        line=fl.next()
-        if not line.startswith('#'):
-            break
-    nreads=0
-    try:
-        while True:
-            nreads += 1
-            if nreads % 1000000 == 0:
-                print nreads
-            try:
-                _, n1, sb1, sd1, _, ru1, rd1, n2, sb2, sd2, _, ru2, rd2\
-                        = line.split()
-                sb1, sd1, ru1, rd1, sb2, sd2, ru2, rd2 = \
-                        map(int, [sb1, sd1, ru1, rd1, sb2, sd2, ru2, rd2])
-            except ValueError:
-                print line
-                raise ValueError("line is not the right format!")
-            if n1 != n2:
-                line=fl.next()
-                continue
-            #read1 ahead of read2
-            if sb1 > sb2:
-                sb1, sd1, ru1, rd1, sb2, sd2, ru2, rd2 = \
-                    sb2, sd2, ru2, rd2, sb1, sd1, ru1, rd1
-            #direction always -> <-
-            if not (sd1 == 1 and sd2 == 0):
-                line=fl.next()
-                continue
-            mollen = sb2-sb1
-            if mollen > maxdist:
-                line=fl.next()
-                continue
-            #DE1
-            if abs(sb1-ru1) < abs(sb1-rd1):
-                rc1=ru1
-            else:
-                rc1=rd1
-            pos=sb1-rc1
-            if pos in de_right:
-                if not mollen in des:
-                    des[mollen]=0
-                des[mollen]+=1
-                line=fl.next()
-                continue
-            #DE2
-            if abs(sb2-ru2) < abs(sb2-rd2):
-                rc2=ru2
-            else:
-                rc2=rd2
-            pos=sb2-rc2
-            if pos in de_left:
-                if not mollen in des:
-                    des[mollen]=0
-                des[mollen]+=1
-                line=fl.next()
-                continue
-            #random: map on same fragment
-            if rd1 == rd2:
-                if not mollen in rbreaks:
-                    rbreaks[mollen]=0
-                rbreaks[mollen]+=1
-                line=fl.next()
-                continue
-            #rejoined ends
-            if not mollen in rejoined:
-                rejoined[mollen]=0
-            rejoined[mollen]+=1
-            line=fl.next()
-    except StopIteration:
-        pass
-    print "   finished processing {} reads".format(nreads)
+    """
+    :param reads_file: path to a file of pairs of reads (in text or binary
+       format), or statistics of the reads (see
+       :func:`pytadbit.mapping.reads_stats.get_reads_stats`) computed with
+       the same maxdist (diag_maxdist), de_left and de_right
+    :param outprefix: prefix of the output files (counts and plot)
+    :param 20 ma_window: size of the window of the moving average
+    :param 800 maxdist: maximum length of the molecules
+    :param [-2,3] de_left: distances to the RE site of the second read-end
+       defining a dangling-end
+    :param [0,5] de_right: distances to the RE site of the first read-end
+       defining a dangling-end
+    """
+    if isinstance(reads_file, ReadsStats):
+        stats = reads_file
+        if ((stats.diag_maxdist, stats.de_left, stats.de_right) !=
+            (maxdist, tuple(de_left), tuple(de_right))):
+            raise ValueError('ERROR: statistics of the reads computed with '
+                             'other maxdist, de_left or de_right\n')
+    else:
+        print "process reads"
+        stats = reads_stats(reads_file, diag_maxdist=maxdist,
+                            de_left=de_left, de_right=de_right)
+    print "   finished processing {} reads".format(stats.nreads)
 
     #transform to arrays
-    maxlen = max(max(rejoined),max(des),max(rbreaks))
+    maxlen = int(np.nonzero(stats.diag_des + stats.diag_rbreaks +
+                            stats.diag_rejoined)[0].max())
     ind = range(1,maxlen+1)
-    des = map(lambda x:des.get(x,0), ind)
-    rbreaks = map(lambda x:rbreaks.get(x,0), ind)
-    rejoined = map(lambda x:rejoined.get(x,0), ind)
+    des = stats.diag_des[1:maxlen+1].tolist()
+    rbreaks = stats.diag_rbreaks[1:maxlen+1].tolist()
+    rejoined = stats.diag_rejoined[1:maxlen+1].tolist()
     #reweight corner for rejoined
     rejoined = map(lambda x: x**.5 * rejoined[x-1]/x, ind)
 
@@ -4,15 +4,59 @@
 
 """
 from pytadbit.mapping.restriction_enzymes import count_re_fragments
+from pytadbit.utils.file_handling         import file_chunks, chunk_lines
+from pytadbit.utils.file_handling         import line_start, magic_open
+from pytadbit.utils.file_handling         import bgzip_file
+from array                                import array
+from pytadbit.parsers.pairs_parser        import is_binary_pairs, PairsWriter
+from pytadbit.parsers.pairs_parser        import iter_pairs_blocks
+from pytadbit.parsers.pairs_parser        import read_pairs_header
+from pytadbit.parsers.pairs_parser        import lines_to_block
+from pytadbit.parsers.pairs_parser        import index_pairs, load_pairs_index
+from pytadbit.utils.hyperloglog           import hash_columns, hash_strings
+from pytadbit.utils.hyperloglog           import DUPLICATE_COLUMNS
+from numpy                                import frombuffer, fromiter, uint16
+from numpy                                import zeros, concatenate, unique
+from numpy                                import bincount, in1d, int64, sort
+from numpy                                import arange, cumsum, searchsorted
+from numpy                                import column_stack, argsort, lexsort
+from numpy                                import fromfile, uint64
+from shutil                               import copyfileobj
+from itertools                            import izip, islice
+from tempfile                             import mkdtemp
 import multiprocessing as mu
+import os
 
-def apply_filter(fnam, outfile, masked, filters=None, reverse=False, 
-                 verbose=True):
+# names of the filters, the bit set in the mask of a read filtered by filter k
+# is 1 << (k - 1)
+FILTERS = {1 : 'self-circle',
+           2 : 'dangling-end',
+           3 : 'error',
+           4 : 'extra dangling-end',
+           5 : 'too close from RES',
+           6 : 'too short',
+           7 : 'too large',
+           8 : 'over-represented',
+           9 : 'duplicated',
+           10: 'random breaks'}
+
+def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
+                 verbose=True, nthreads=1):
     """
     Create a new file with reads filtered
 
-    :param fnam: input file path, where non-filtered read are stored
-    :param outfile: output file path, where filtered read will be stored
+    The IDs of the filtered reads are loaded as a sorted array of integers
+    (their hashes, see :func:`pytadbit.utils.hyperloglog.hash_strings`), and
+    input files in text format are split in byte ranges processed in parallel.
+    The IDs of the reads found in the filters are then checked against the IDs
+    in the filter files and, if they do not match (hash collision, or filtered
+    read missing from the input), reads are compared one by one to the IDs in
+    the filter files.
+
+    :param fnam: input file path, where non-filtered read are stored (in text
+       or binary format)
+    :param outfile: output file path, where filtered read will be stored (in
+       the same format as the input)
     :param masked: dictionary given by the
        :func:`pytadbit.mapping.filter.filter_reads`
     :param None filters: list of numbers corresponding to the filters we want
@@ -20,77 +64,249 @@ def apply_filter(fnam, outfile, masked, filters=None, reverse=False,
     :param False reverse: if set, the resulting outfile will only contain the
        reads filtered, not the valid pairs.
     :param False verbose:
+    :param 1 nthreads: number of processes used to write the output
 
     :returns: number of reads kept
     """
     filters = filters or masked.keys()
     filter_names = []
+    fnams = [masked[k]['fnam'] for k in filters]
+    hashes = _filtered_hashes(fnams)
+    if is_binary_pairs(fnam):
+        count, idfnams = _apply_binary(fnam, outfile, hashes, reverse)
+    else:
+        count, idfnams = _apply_text(fnam, outfile, hashes, reverse, nthreads)
+    matching = _check_filtered(idfnams, fnams)
+    for idfnam in idfnams:
+        os.remove(idfnam)
+    if not matching:
+        count = _apply_lockstep(fnam, outfile, fnams, reverse)
+    # filtered reads are kept in the same order
+    if load_pairs_index(fnam) is not None:
+        index_pairs(outfile)
+    if verbose:
+        print '    saving to file %d reads %s %s.' % (
+            count, 'with' if reverse else 'without', ', '.join(filter_names))
+    return count
+
+def _filtered_hashes(fnams, chunk=100000):
+    """
+    :param fnams: list of paths to files with the IDs of filtered reads
+
+    :returns: the sorted hashes of the IDs of the filtered reads
+    """
+    hashes = [zeros(0, dtype=uint64)]
+    for fnam in fnams:
+        fhandler = magic_open(fnam, cpus=1)
+        for lines in iter(lambda: list(islice(fhandler, chunk)), []):
+            hashes.append(hash_strings([l.strip() for l in lines]))
+        fhandler.close()
+    return unique(concatenate(hashes))
+
+def _is_filtered(reads, hashes):
+    """
+    :param reads: list of read IDs
+    :param hashes: sorted hashes of filtered read IDs
+
+    :returns: a boolean array, True for reads whose hash is in hashes
+    """
+    if not len(hashes):
+        return zeros(len(reads), dtype=bool)
+    hashed = hash_strings(reads)
+    pos = searchsorted(hashes, hashed)
+    pos[pos == len(hashes)] = 0
+    return hashes[pos] == hashed
+
+def _apply_binary(fnam, outfile, hashes, reverse):
+    """
+    :returns: the number of reads written and the list of files with the IDs of
+       the reads found in the filters
+    """
+    count = 0
+    out = PairsWriter(outfile, read_pairs_header(fnam)[0])
+    idout = open(outfile + '_ids~', 'w')
+    for block in iter_pairs_blocks(fnam, ids=True):
+        filtered = _is_filtered(block['id'], hashes)
+        idout.writelines(read + '\n' for read, bad in
+                         izip(block['id'], filtered) if bad)
+        keep = filtered == reverse
+        count += int(keep.sum())
+        out.write_block(block, keep)
+    out.close()
+    idout.close()
+    return count, [outfile + '_ids~']
+
+def _apply_text(fnam, outfile, hashes, reverse, nthreads=1):
+    """
+    :returns: the number of reads written and the list of files with the IDs of
+       the reads found in the filters (in the order of the input file)
+    """
+    # get the header
+    header = ''
+    for line in open(fnam):
+        if not line.startswith('#'):
+            break
+        header += line
+    chunks = file_chunks(fnam, nthreads, start=len(header))
+    if len(chunks) == 1:
+        count = _apply_chunk(fnam, chunks[0][0], None, hashes, header, outfile,
+                             outfile + '_ids~', reverse)
+        return count, [outfile + '_ids~']
+    pool = mu.Pool(nthreads)
+    jobs = []
+    for num, (beg, end) in enumerate(chunks):
+        jobs.append(pool.apply_async(_apply_chunk, args=(
+            fnam, beg, end, hashes, '' if num else header,
+            outfile + '_%03d~' % num, outfile + '_%03d_ids~' % num, reverse)))
+    pool.close()
+    jobs = [job.get() for job in jobs]
+    pool.join()
+    # join chunks
+    out = open(outfile, 'w')
+    for num in xrange(len(chunks)):
+        fhandler = open(outfile + '_%03d~' % num)
+        copyfileobj(fhandler, out)
+        fhandler.close()
+        os.remove(outfile + '_%03d~' % num)
+    out.close()
+    return sum(jobs), [outfile + '_%03d_ids~' % num
+                       for num in xrange(len(chunks))]
+
+def _apply_chunk(fnam, beg, end, hashes, header, outfnam, idfnam, reverse,
+                 chunk=100000):
+    """
+    Writes the reads passing the filters for a byte range of the file, and the
+    IDs of the reads found in the filters to idfnam.
+
+    :returns: the number of reads written
+    """
+    out = open(outfnam, 'w')
+    out.write(header)
+    idout = open(idfnam, 'w')
+    count = 0
+    fhandler = chunk_lines(fnam, beg, end)
+    for lines in iter(lambda: list(islice(fhandler, chunk)), []):
+        reads = [l.split('\t', 1)[0] for l in lines]
+        filtered = _is_filtered(reads, hashes)
+        idout.writelines(read + '\n' for read, bad in
+                         izip(reads, filtered) if bad)
+        kept = [l for l, bad in izip(lines, filtered) if bad == reverse]
+        count += len(kept)
+        out.writelines(kept)
+    out.close()
+    idout.close()
+    return count
+
+def _check_filtered(idfnams, fnams):
+    """
+    Checks that the reads found in the filters (by their hashes) are exactly
+    the ones that would be found comparing read IDs one by one (see
+    :func:`_apply_lockstep`).
+
+    :param idfnams: list of files with the IDs of the reads found in the
+       filters, in the order of the input file
+    :param fnams: list of paths to files with the IDs of filtered reads
+
+    :returns: True if all these IDs are the next ones in some filter file, and
+       all the filter files are consumed
+    """
+    is_filtered, filter_handlers = _lockstep_filter(fnams)
+    matching = True
+    for idfnam in idfnams:
+        for read in open(idfnam):
+            if not is_filtered(read.rstrip('\n')):
+                matching = False
+                break
+        if not matching:
+            break
+    for _, fh in filter_handlers.values():
+        fh.close()
+    return matching and not filter_handlers
+
+def _lockstep_filter(fnams):
+    """
+    :param fnams: list of paths to files with the IDs of filtered reads (all
+       files listing reads in the same order)
+
+    :returns: a function telling if a read is filtered, comparing its ID with
+       the next IDs in each filter file (reads being given in the order of the
+       filter files), and the dictionary of the filter files not consumed yet,
+       with their next ID and file handler
+    """
     filter_handlers = {}
-    for k in filters:
+    for k, filter_fnam in enumerate(fnams):
         try:
-            fh = open(masked[k]['fnam'])
+            fh = magic_open(filter_fnam, cpus=1)
             val = fh.next().strip()
             filter_handlers[k] = [val, fh]
         except StopIteration:
             pass
 
-    out = open(outfile, 'w')
-    fhandler = open(fnam)
-    # get the header
-    pos = 0
-    while True:
-        line = next(fhandler)
-        if not line.startswith('#'):
-            break
-        pos += len(line)
-        out.write(line)
-    fhandler.seek(pos)
-
+    # current read ID of each filter, updated as filters are consumed
     current = set([v for v, _ in filter_handlers.values()])
-    count = 0
-    if reverse:
-        for line in fhandler:
-            read = line.split('\t', 1)[0]
-            if read in current:
-                count += 1
-                out.write(line)
-            else:
+    def is_filtered(read):
+        if not read in current:
+            return False
+        # iterate over different filters to update current filters
+        current.remove(read)
+        for k in filter_handlers.keys():
+            if read != filter_handlers[k][0]:
                 continue
-            # iterate over different filters to update current filters
-            for k in filter_handlers.keys():
-                if read != filter_handlers[k][0]:
-                    continue
-                try: # get next line from filter file
-                    filter_handlers[k][0] = filter_handlers[k][1].next().strip()
-                except StopIteration:
-                    del filter_handlers[k]
-            current = set([v for v, _ in filter_handlers.values()])
+            try: # get next line from filter file
+                val = filter_handlers[k][1].next().strip()
+            except StopIteration:
+                filter_handlers[k][1].close()
+                del filter_handlers[k]
+                continue
+            filter_handlers[k][0] = val
+            current.add(val)
+        return True
+
+    return is_filtered, filter_handlers
+
+def _apply_lockstep(fnam, outfile, fnams, reverse):
+    """
+    Compares the ID of each read with the next IDs in each filter file (all
+    files listing reads in the same order).
+
+    :returns: the number of reads written
+    """
+    is_filtered, _ = _lockstep_filter(fnams)
+    count = 0
+    if is_binary_pairs(fnam):
+        out = PairsWriter(outfile, read_pairs_header(fnam)[0])
+        for block in iter_pairs_blocks(fnam, ids=True):
+            keep = fromiter((is_filtered(read) == reverse
+                             for read in block['id']), dtype=bool,
+                            count=len(block['id']))
+            count += int(keep.sum())
+            out.write_block(block, keep)
+        out.close()
     else:
+        out = open(outfile, 'w')
+        fhandler = open(fnam)
+        # get the header
+        pos = 0
+        while True:
+            line = next(fhandler)
+            if not line.startswith('#'):
+                break
+            pos += len(line)
+            out.write(line)
+        fhandler.seek(pos)
         for line in fhandler:
-            read = line.split('\t', 1)[0]
-            if read not in current:
+            if is_filtered(line.split('\t', 1)[0]) == reverse:
                 count += 1
                 out.write(line)
-                continue
-            # iterate over different filters to update current filters
-            for k in filter_handlers.keys():
-                if read != filter_handlers[k][0]:
-                    continue
-                try: # get next line from filter file
-                    filter_handlers[k][0] = filter_handlers[k][1].next().strip()
-                except StopIteration:
-                    del filter_handlers[k]
-            current = set([v for v, _ in filter_handlers.values()])
-    if verbose:
-        print '    saving to file %d reads %s %s.' % (
-            count, 'with' if reverse else 'without', ', '.join(filter_names))
-    out.close()
+        out.close()
     return count
 
 def filter_reads(fnam, output=None, max_molecule_length=500,
                  over_represented=0.005, max_frag_size=100000,
                  min_frag_size=100, re_proximity=5, verbose=True,
-                 savedata=None, min_dist_to_re=750, fast=True):
+                 savedata=None, min_dist_to_re=750, fast=True, outfile=None,
+                 filters=None, reverse=False, nthreads=1, max_memory=1000,
+                 compress=False):
     """
     Filter mapped pair of reads in order to remove experimental artifacts (e.g.
     dangling-ends, self-circle, PCR artifacts...)
@@ -116,14 +332,17 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        8- over-represented   : reads coming from the top 0.5% most frequently
           detected restriction fragments, they may be prone to PCR artifacts or
           represent fragile regions of the genome or genome assembly errors
-       9- duplicated         : the combination of the start positions of the
-          reads is repeated -> PCR artifact (only keep one copy)
+       9- duplicated         : the combination of the start positions (and
+          strands) of the reads is repeated -> PCR artifact (only keep one
+          copy, the first in the file). Duplicates are found whatever the
+          order of the reads in the file
        10- random breaks     : start position of one of the read is too far (
           more than min_dist_to_re) from RE cutting site. Non-canonical
           enzyme activity or random physical breakage of the chromatin.
     
     :param fnam: path to file containing the pair of reads in tsv format, file
-       generated by :func:`pytadbit.mapping.mapper.get_intersection`
+       generated by :func:`pytadbit.mapping.mapper.get_intersection` (or in
+       binary format, see :mod:`pytadbit.parsers.pairs_parser`)
     :param None output: PATH where to write files containing IDs of filtered
        reads. Uses fnam by default.
     :param 500 max_molecule_length: facing reads that are within
@@ -140,10 +359,32 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
        from a RE site (usually 1.5 times the insert size). Applied in filter 10
     :param None savedata: PATH where to write the number of reads retained by
        each filter
-    :param True fast: parallel version, requires 4 CPUs and more RAM memory
+    :param True fast: all filters are computed at once, in a single pass over
+       the reads (one extra lighter pass is needed to write reads filtered as
+       over-represented). If False each group of filters is computed in a
+       separate pass over the reads (mainly for debugging)
+    :param None outfile: PATH where to write the reads passing the filters
+       (as :func:`pytadbit.mapping.filter.apply_filter`), done in the same
+       pass as writing over-represented reads
+    :param None filters: list of numbers corresponding to the filters to apply
+       in order to write outfile (by default all)
+    :param False reverse: if set, the outfile will only contain the reads
+       filtered, not the valid pairs
+    :param 1 nthreads: number of processes used to filter reads, the input
+       file is split in byte ranges processed in parallel (not used with
+       input files in binary format, filtered with NumPy by blocks of reads),
+       and duplicates are searched in partitions of reads processed in
+       parallel
+    :param 1000 max_memory: maximum memory (in Mb) used to search duplicates,
+       used to choose the number of partitions of the reads
+    :param False compress: compress the files with the IDs of the reads
+       filtered (in BGZF format, using nthreads threads, see
+       :class:`pytadbit.utils.file_handling.BgzfWriter`), their paths in the
+       returned dictionary have the extension .gz
 
     :return: dicitonary with, as keys, the kind of filter applied, and as values
-       a set of read IDs to be removed
+       a set of read IDs to be removed. If outfile is given, also returns the
+       number of reads written in outfile
 
     *Note: Filtering is not exclusive, one read can be filtered several times.*
     """
@@ -154,7 +395,8 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
     if not fast: # mainly for debugging
         if verbose:
             print 'filtering duplicates'
-        masked, total = _filter_duplicates(fnam,output)
+        masked, total = _filter_duplicates(fnam, output, nthreads=nthreads,
+                                           max_memory=max_memory)
         if verbose:
             print 'filtering same fragments'
         masked.update(_filter_same_frag(fnam, max_molecule_length, output))
@@ -165,23 +407,35 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         if verbose:
             print 'filtering over representeds'
         masked.update(_filter_over_represented(fnam, over_represented, output))
+        if outfile:
+            count = apply_filter(fnam, outfile, masked, filters=filters,
+                                 reverse=reverse, verbose=False,
+                                 nthreads=nthreads)
+    elif is_binary_pairs(fnam):
+        if verbose:
+            print 'filtering reads'
+        masked, total, count = _filter_binary(
+            fnam, output, max_molecule_length, over_represented,
+            max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+            outfile=outfile, filters=filters, reverse=reverse,
+            nthreads=nthreads, max_memory=max_memory)
     else:
-        pool = mu.Pool(4)
-        a = pool.apply_async(_filter_same_frag,
-                             args=(fnam, max_molecule_length, output))
-        b = pool.apply_async(_filter_from_res,
-                             args=(fnam, max_frag_size, min_dist_to_re,
-                                   re_proximity, min_frag_size, output))
-        c = pool.apply_async(_filter_over_represented,
-                             args=(fnam, over_represented, output))
-        d = pool.apply_async(_filter_duplicates,
-                             args=(fnam,output))
-        pool.close()
-        pool.join()
-        masked, total = d.get()
-        masked.update(b.get())
-        masked.update(c.get())
-        masked.update(a.get())
+        if verbose:
+            print 'filtering reads'
+        masked, total, count = _filter_single_pass(
+            fnam, output, max_molecule_length, over_represented,
+            max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+            outfile=outfile, filters=filters, reverse=reverse,
+            nthreads=nthreads, max_memory=max_memory)
+    # valid reads are kept in the same order (indexed by apply_filter in the
+    # slow mode)
+    if fast and outfile and load_pairs_index(fnam) is not None:
+        index_pairs(outfile)
+    if compress:
+        for k in masked:
+            if os.path.exists(masked[k]['fnam']):
+                masked[k]['fnam'] = bgzip_file(masked[k]['fnam'],
+                                               nthreads=nthreads)
 
     # if savedata or verbose:
     #     bads = len(frozenset().union(*[masked[k]['reads'] for k in masked]))
@@ -203,8 +457,353 @@ def filter_reads(fnam, output=None, max_molecule_length=500,
         # print '\n     %-25s : %12d (%6.2f%%)' %(
         #     'Valid-pairs', total - bads, float(total - bads) / (
         #         total) * 100)
+    if outfile:
+        return masked, count
     return masked
 
+def _filter_single_pass(fnam, output, max_molecule_length, over_represented,
+                        max_frag_size, min_frag_size, re_proximity,
+                        min_dist_to_re, outfile=None, filters=None,
+                        reverse=False, nthreads=1, max_memory=1000):
+    """
+    Computes all filters at once, keeping for each read a mask of the filters
+    it does not pass (filter k sets bit 1 << (k - 1)). The over-represented
+    filter needs the number of reads per RE fragment in the whole file, and is
+    computed when writing outfile. Duplicates are searched before (see
+    :func:`_find_duplicates`).
+
+    :returns: the dictionary of filters, the total number of reads and the
+       number of reads written in outfile
+    """
+    masked = {}
+    for k in FILTERS:
+        masked[k] = {'name': FILTERS[k], 'reads': 0,
+                     'fnam': (output + '_' + FILTERS[k].replace(' ', '_') +
+                              '.tsv')}
+    # get the header
+    header = ''
+    for line in open(fnam):
+        if not line.startswith('#'):
+            break
+        header += line
+    dups = _find_duplicates(fnam, nthreads=nthreads, max_memory=max_memory)
+    chunks = file_chunks(fnam, nthreads, start=len(header))
+    if len(chunks) > 1:
+        pool = mu.Pool(nthreads)
+    # name of the files for each chunk
+    fnams = []
+    for num in xrange(len(chunks)):
+        fnams.append(dict([(k, masked[k]['fnam'] +
+                            ('_%03d~' % num if len(chunks) > 1 else ''))
+                           for k in masked]))
+        fnams[num]['valid'] = (outfile + ('_%03d~' % num if len(chunks) > 1
+                                          else '')) if outfile else None
+
+    # filter reads
+    jobs = []
+    for num, (beg, end) in enumerate(chunks):
+        # duplicated reads starting in the byte range
+        chunk_dups = dups[searchsorted(dups, beg):
+                          searchsorted(dups, end) if end else len(dups)]
+        args = (fnam, beg, end, chunk_dups, fnams[num], max_molecule_length,
+                max_frag_size, min_frag_size, re_proximity, min_dist_to_re)
+        if len(chunks) > 1:
+            jobs.append(pool.apply_async(_filter_chunk, args=args))
+        else:
+            jobs.append(_filter_chunk(*args))
+    if len(chunks) > 1:
+        jobs = [job.get() for job in jobs]
+    masks = [mask for mask, _ in jobs]
+    frag_count = jobs[0][1]
+    for _, other in jobs[1:]:
+        for frag, val in other.iteritems():
+            frag_count[frag] = frag_count.get(frag, 0) + val
+    del(jobs, dups)
+
+    # over-represented fragments
+    num_frags = len(frag_count)
+    cut = int((1 - over_represented) * num_frags + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = sorted(frag_count.itervalues())[cut - 1] if num_frags else 0
+    over_frags = set([frag for frag, val in frag_count.iteritems()
+                      if val > cut])
+    del(frag_count)
+
+    # write over-represented and valid reads
+    filters = filters or masked.keys()
+    bits = sum(1 << (k - 1) for k in set(filters))
+    jobs = []
+    for num, (beg, end) in enumerate(chunks):
+        args = (fnam, beg, end, masks[num], over_frags, bits,
+                '' if num else header, fnams[num], reverse)
+        if len(chunks) > 1:
+            jobs.append(pool.apply_async(_write_chunk, args=args))
+        else:
+            jobs.append(_write_chunk(*args))
+    if len(chunks) > 1:
+        pool.close()
+        jobs = [job.get() for job in jobs]
+        pool.join()
+    count = sum(val for val, _ in jobs)
+    masked[8]['reads'] = sum(val for _, val in jobs)
+
+    # count reads per filter
+    total = 0
+    for mask in masks:
+        mask = frombuffer(mask, dtype=uint16)
+        total += len(mask)
+        for k in masked:
+            if k != 8:
+                masked[k]['reads'] += int(((mask >> (k - 1)) & 1).sum())
+
+    # join chunks
+    if len(chunks) > 1:
+        for k in fnams[0]:
+            if k == 'valid' and not outfile:
+                continue
+            out = open(outfile if k == 'valid' else masked[k]['fnam'], 'w')
+            for num in xrange(len(chunks)):
+                fhandler = open(fnams[num][k])
+                copyfileobj(fhandler, out)
+                fhandler.close()
+                os.remove(fnams[num][k])
+            out.close()
+    return masked, total, count
+
+def _filter_binary(fnam, output, max_molecule_length, over_represented,
+                   max_frag_size, min_frag_size, re_proximity, min_dist_to_re,
+                   outfile=None, filters=None, reverse=False, nthreads=1,
+                   max_memory=1000):
+    """
+    Same as :func:`_filter_single_pass` for files in binary format, all reads
+    of a block being filtered at once.
+
+    :returns: the dictionary of filters, the total number of reads and the
+       number of reads written in outfile
+    """
+    masked = {}
+    for k in FILTERS:
+        masked[k] = {'name': FILTERS[k], 'reads': 0,
+                     'fnam': (output + '_' + FILTERS[k].replace(' ', '_') +
+                              '.tsv')}
+    outfil = {}
+    for k in FILTERS:
+        if k != 8:
+            outfil[k] = open(masked[k]['fnam'], 'w')
+    masks = []
+    frags = []
+    dups = _find_duplicates(fnam, nthreads=nthreads, max_memory=max_memory)
+    nreads = 0
+    for block in iter_pairs_blocks(fnam, ids=True):
+        cr1, ps1, sd1, rs1, re1 = [block[c] for c in (
+            'crm1', 'pos1', 'strand1', 'rs1', 're1')]
+        cr2, ps2, sd2, rs2, re2 = [block[c] for c in (
+            'crm2', 'pos2', 'strand2', 'rs2', 're2')]
+        bad = zeros(len(ps1), dtype=uint16)
+        # duplicated
+        bad[dups[searchsorted(dups, nreads):
+                 searchsorted(dups, nreads + len(ps1))] - nreads] |= 256
+        nreads += len(ps1)
+        # same fragment
+        same_crm = cr1 == cr2
+        same_frag = same_crm & (re1 == re2)
+        bad[same_frag & (sd1 != sd2) & ((ps2 > ps1) == sd2)] |= 1
+        bad[same_frag & (sd1 != sd2) & ((ps2 > ps1) != sd2)] |= 2
+        bad[same_frag & (sd1 == sd2)] |= 4
+        bad[same_crm & (re1 != re2) & (abs(ps1 - ps2) < max_molecule_length) &
+            (sd2 != sd1) & ((ps2 > ps1) != sd2)] |= 8
+        # distance to RE sites
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        close = ((diff11 < re_proximity) | (diff12 < re_proximity) |
+                 (diff21 < re_proximity) | (diff22 < re_proximity))
+        # multicontacts excluded if fragment is internal (not the first)
+        close &= fromiter(('~' not in read for read in block['id']),
+                          dtype=bool, count=len(ps1))
+        bad[close] |= 16
+        bad[((diff11 > min_dist_to_re) & (diff12 > min_dist_to_re)) |
+            ((diff21 > min_dist_to_re) & (diff22 > min_dist_to_re))] |= 512
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        bad[(dif1 < min_frag_size) | (dif2 < min_frag_size)] |= 32
+        bad[(dif1 > max_frag_size) | (dif2 > max_frag_size)] |= 64
+        for k in outfil:
+            filtered = (bad & (1 << (k - 1))).nonzero()[0]
+            masked[k]['reads'] += len(filtered)
+            outfil[k].writelines(block['id'][i] + '\n' for i in filtered)
+        masks.append(bad)
+        # count reads per RE fragment
+        frags.append(unique(concatenate((cr1 << 32 | rs1, cr2 << 32 | rs2)),
+                            return_counts=True))
+    for k in outfil:
+        outfil[k].close()
+    del(dups)
+
+    # over-represented fragments
+    if frags:
+        frags, counts = zip(*frags)
+        frags, idx = unique(concatenate(frags), return_inverse=True)
+        counts = bincount(idx, weights=concatenate(counts)).astype(int64)
+    else:
+        frags = counts = zeros(0, dtype=int64)
+    cut = int((1 - over_represented) * len(counts) + 0.5)
+    # use cut-1 because it represents the length of the list
+    cut = sort(counts)[cut - 1] if len(counts) else 0
+    over_frags = frags[counts > cut]
+
+    # write over-represented and valid reads
+    filters = filters or masked.keys()
+    bits = sum(1 << (k - 1) for k in set(filters))
+    over_fh = open(masked[8]['fnam'], 'w')
+    if outfile:
+        out = PairsWriter(outfile, read_pairs_header(fnam)[0])
+    count = 0
+    total = 0
+    for block, bad in izip(iter_pairs_blocks(fnam, ids=True), masks):
+        over = (in1d(block['crm1'] << 32 | block['rs1'], over_frags) |
+                in1d(block['crm2'] << 32 | block['rs2'], over_frags))
+        bad[over] |= 128
+        over = over.nonzero()[0]
+        masked[8]['reads'] += len(over)
+        over_fh.writelines(block['id'][i] + '\n' for i in over)
+        total += len(bad)
+        if outfile:
+            keep = ((bad & bits) == 0) != reverse
+            count += int(keep.sum())
+            out.write_block(block, keep)
+    del(masks)
+    over_fh.close()
+    if outfile:
+        out.close()
+    return masked, total, count
+
+def _filter_chunk(fnam, beg, end, dups, fnams, max_molecule_length,
+                  max_frag_size, min_frag_size, re_proximity, min_dist_to_re):
+    """
+    Computes all filters (except over-represented) for the reads in a byte
+    range of the file, writing the IDs of filtered reads. Duplicated reads
+    are given by the sorted byte offsets of their lines (dups).
+
+    :returns: the mask of each read (as a string of uint16), and the number of
+       reads per RE fragment
+    """
+    outfil = {}
+    for k in FILTERS:
+        if k != 8:
+            outfil[1 << (k - 1)] = open(fnams[k], 'w')
+    fhandler = open(fnam)
+    pos = line_start(fhandler, beg)
+    fhandler.close()
+    dups = iter(dups.tolist() + [None])
+    next_dup = dups.next()
+    mask = array('H')
+    frag_count = {}
+    for line in chunk_lines(fnam, pos, end):
+        (read,
+         cr1, pos1, sd1, _, rs1, re1,
+         cr2, pos2, sd2, _, rs2, re2) = line.split('\t')
+        # count reads per RE fragment
+        try:
+            frag_count[(cr1, rs1)] += 1
+        except KeyError:
+            frag_count[(cr1, rs1)] = 1
+        try:
+            frag_count[(cr2, rs2)] += 1
+        except KeyError:
+            frag_count[(cr2, rs2)] = 1
+        # duplicated
+        if pos == next_dup:
+            bad = 256
+            next_dup = dups.next()
+        else:
+            bad = 0
+        pos += len(line)
+        ps1, ps2, sd1, sd2, re1, rs1, re2, rs2 = map(
+            int, (pos1, pos2, sd1, sd2, re1, rs1, re2, rs2))
+        # same fragment
+        if cr1 == cr2:
+            if re1 == re2:
+                if sd1 != sd2:
+                    if (ps2 > ps1) == sd2:
+                        # ----<===---===>---                   self-circles
+                        bad |= 1
+                    else:
+                        # ----===>---<===---                   dangling-ends
+                        bad |= 2
+                else:
+                    # --===>--===>-- or --<===--<===-- or same errors
+                    bad |= 4
+            elif (abs(ps1 - ps2) < max_molecule_length
+                  and sd2 != sd1
+                  and (ps2 > ps1) != sd2):
+                # different fragments but facing and very close
+                bad |= 8
+        # distance to RE sites
+        diff11 = re1 - ps1
+        diff12 = ps1 - rs1
+        diff21 = re2 - ps2
+        diff22 = ps2 - rs2
+        if ((diff11 < re_proximity) or
+            (diff12 < re_proximity) or
+            (diff21 < re_proximity) or
+            (diff22 < re_proximity)):
+            # multicontacts excluded if fragment is internal (not the first)
+            if not '~' in read:
+                bad |= 16
+        if (((diff11 > min_dist_to_re) and
+             (diff12 > min_dist_to_re)) or
+            ((diff21 > min_dist_to_re) and
+             (diff22 > min_dist_to_re))):
+            bad |= 512
+        dif1 = re1 - rs1
+        dif2 = re2 - rs2
+        if (dif1 < min_frag_size) or (dif2 < min_frag_size):
+            bad |= 32
+        if (dif1 > max_frag_size) or (dif2 > max_frag_size):
+            bad |= 64
+        if bad:
+            for bit in outfil:
+                if bad & bit:
+                    outfil[bit].write(read + '\n')
+        mask.append(bad)
+    for bit in outfil:
+        outfil[bit].close()
+    return mask.tostring(), frag_count
+
+def _write_chunk(fnam, beg, end, mask, over_frags, bits, header, fnams,
+                 reverse=False):
+    """
+    Writes the IDs of reads in over-represented RE fragments, and the reads
+    passing the filters (in bits), for a byte range of the file.
+
+    :returns: the number of reads written and the number of over-represented
+       reads
+    """
+    masks = array('H')
+    masks.fromstring(mask)
+    over_fh = open(fnams[8], 'w')
+    out = None
+    if fnams['valid']:
+        out = open(fnams['valid'], 'w')
+        out.write(header)
+    count = 0
+    over = 0
+    for line, bad in izip(chunk_lines(fnam, beg, end), masks):
+        read, cr1, _, _, _, rs1, _, cr2, _, _, _, rs2, _ = line.split('\t')
+        if (cr1, rs1) in over_frags or (cr2, rs2) in over_frags:
+            bad |= 128
+            over += 1
+            over_fh.write(read + '\n')
+        if out and (not bad & bits) != reverse:
+            count += 1
+            out.write(line)
+    over_fh.close()
+    if out:
+        out.close()
+    return count, over
+
 def _filter_same_frag(fnam, max_molecule_length, output):
     # t0 = time()
     masked = {1 : {'name': 'self-circle'       , 'reads': 0}, 
@@ -255,37 +854,178 @@ def _filter_same_frag(fnam, max_molecule_length, output):
         outfil[k].close()
     return masked
 
-def _filter_duplicates(fnam, output):
-    total = 0
+def _filter_duplicates(fnam, output, nthreads=1, max_memory=1000):
     masked = {9 : {'name': 'duplicated'        , 'reads': 0}}
     outfil = {}
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k] = open(masked[k]['fnam'], 'w')
-    fhandler = open(fnam)
-    line = fhandler.next()
-    while line.startswith('#'):
-        line = fhandler.next()
-    (read,
-     cr1, pos1, sd1, _ , _, _,
-     cr2, pos2, sd2, _ , _, _) = line.split('\t')
-    prev_elts = cr1, pos1, cr2, pos2, sd1, sd2
-    for line in fhandler:
-        (read,
-         cr1, pos1, sd1, _ , _, _,
-         cr2, pos2, sd2, _ , _, _) = line.split('\t')
-        new_elts = cr1, pos1, cr2, pos2, sd1, sd2
-        if prev_elts == new_elts:
+    dups = iter(_find_duplicates(fnam, nthreads=nthreads,
+                                 max_memory=max_memory).tolist() + [None])
+    next_dup = dups.next()
+    header = read_pairs_header(fnam)[0]
+    pos = len(header)
+    total = 0
+    for line in chunk_lines(fnam, pos, None):
+        if pos == next_dup:
             masked[9]["reads"] += 1
-            outfil[9].write(read + '\n')
+            outfil[9].write(line.split('\t', 1)[0] + '\n')
+            next_dup = dups.next()
         total += 1
-        prev_elts = new_elts
+        pos += len(line)
     # print 'done 4', time() - t0
     for k in masked:
         masked[k]['fnam'] = output + '_' + masked[k]['name'].replace(' ', '_') + '.tsv'
         outfil[k].close()
     return masked, total
 
+# maximum number of partitions of the reads when searching for duplicates
+MAX_PARTITIONS = 256
+
+# approximate memory needed to find duplicates in a partition, relative to the
+# size on disk of its reads
+_DUPS_OVERHEAD = 3
+
+def _duplicate_keys(block):
+    """
+    :returns: two arrays of integers, identifying together the chromosome,
+       position and strand of both ends of each pair of reads
+    """
+    return ((block['crm1'] << 34) | (block['pos1'] << 1) | block['strand1'],
+            (block['crm2'] << 34) | (block['pos2'] << 1) | block['strand2'])
+
+def _key_blocks(fnam, beg, end, first, crm_idx, chunk=100000):
+    """
+    Iterates over the reads of a file (in a byte range if in text format), by
+    blocks.
+
+    :returns: for each block, the keys of the reads (see
+       :func:`_duplicate_keys`) and their position in the file (byte offset of
+       the line in text format, index of the read in binary format)
+    """
+    if crm_idx is None:
+        nreads = 0
+        for block in iter_pairs_blocks(fnam, columns=DUPLICATE_COLUMNS):
+            size = len(block['pos1'])
+            yield _duplicate_keys(block) + (arange(nreads, nreads + size), )
+            nreads += size
+        return
+    fhandler = open(fnam)
+    pos = line_start(fhandler, max(beg, first))
+    for lines in iter(lambda: list(islice(fhandler, chunk)), []):
+        sizes = fromiter((len(l) for l in lines), dtype=int64, count=len(lines))
+        offsets = pos + cumsum(sizes) - sizes
+        pos += int(sizes.sum())
+        if end is not None and offsets[-1] >= end:
+            lines = lines[:searchsorted(offsets, end)]
+            offsets = offsets[:len(lines)]
+        if lines:
+            block = lines_to_block(lines, crm_idx, columns=DUPLICATE_COLUMNS)
+            yield _duplicate_keys(block) + (offsets, )
+        if end is not None and pos >= end:
+            break
+    fhandler.close()
+
+def _partition_reads(fnam, beg, end, first, crm_idx, fnams):
+    """
+    Writes the keys and positions of the reads to the partition files,
+    according to the hash of their keys.
+    """
+    outs = [open(f, 'wb') for f in fnams]
+    for key1, key2, offsets in _key_blocks(fnam, beg, end, first, crm_idx):
+        parts = hash_columns((key1, key2)) % uint64(len(outs))
+        rows = column_stack((key1, key2, offsets))
+        order = argsort(parts, kind='mergesort')
+        bounds = searchsorted(parts[order], arange(len(outs) + 1))
+        for num, out in enumerate(outs):
+            if bounds[num] < bounds[num + 1]:
+                rows[order[bounds[num]:bounds[num + 1]]].tofile(out)
+    for out in outs:
+        out.close()
+
+def _partition_duplicates(fnams, outfnam):
+    """
+    Finds duplicated reads in a partition, all reads with the same keys but
+    the first one (in the file).
+
+    :returns: the number of duplicated reads, their positions are written in
+       outfnam
+    """
+    rows = concatenate([fromfile(f, dtype=int64) for f in fnams]).reshape(-1, 3)
+    for f in fnams:
+        os.remove(f)
+    key1, key2, offsets = rows[:, 0], rows[:, 1], rows[:, 2]
+    order = lexsort((offsets, key2, key1))
+    key1 = key1[order]
+    key2 = key2[order]
+    dups = (key1[1:] == key1[:-1]) & (key2[1:] == key2[:-1])
+    dups = sort(offsets[order][1:][dups])
+    dups.tofile(outfnam)
+    return len(dups)
+
+def _find_duplicates(fnam, nthreads=1, max_memory=1000, tmp_dir=None):
+    """
+    Finds reads with the same chromosome, position and strand for both ends,
+    whatever their order in the file (e.g. merged or unsorted files). Reads
+    are split into partitions, according to the hash of these values, and
+    duplicates are searched in each partition (in parallel), keeping the
+    first read of each group.
+
+    :param fnam: path to a file of pairs of reads (in text or binary format)
+    :param 1 nthreads: number of processes
+    :param 1000 max_memory: maximum memory (in Mb) used by all the processes,
+       used to choose the number of partitions
+    :param None tmp_dir: directory where to write the partitions (by default
+       the directory of fnam)
+
+    :returns: a sorted array with the position of the duplicated reads (byte
+       offset of the line in text format, index of the read in binary format)
+    """
+    tmp_dir = mkdtemp(prefix='dups_', dir=tmp_dir or
+                      os.path.dirname(os.path.abspath(fnam)))
+    header, crm_lengths = read_pairs_header(fnam)
+    if is_binary_pairs(fnam):
+        crm_idx = None
+        chunks = [(0, None)]
+    else:
+        crm_idx = dict((c, i) for i, c in enumerate(crm_lengths))
+        chunks = file_chunks(fnam, nthreads, start=len(header))
+    per_part = max_memory * 1024 * 1024 / nthreads / _DUPS_OVERHEAD
+    nparts = min(MAX_PARTITIONS, max(nthreads,
+                                     os.path.getsize(fnam) / per_part + 1))
+    fnams = [[os.path.join(tmp_dir, 'part_%03d_%03d' % (num, part))
+              for part in xrange(nparts)] for num in xrange(len(chunks))]
+    pool = mu.Pool(nthreads) if nthreads > 1 else None
+    jobs = []
+    for num, (beg, end) in enumerate(chunks):
+        args = (fnam, beg, end, len(header), crm_idx, fnams[num])
+        if pool:
+            jobs.append(pool.apply_async(_partition_reads, args=args))
+        else:
+            _partition_reads(*args)
+    for job in jobs:
+        job.get()
+    jobs = []
+    for part in xrange(nparts):
+        args = ([f[part] for f in fnams],
+                os.path.join(tmp_dir, 'dups_%03d' % part))
+        if pool:
+            jobs.append(pool.apply_async(_partition_duplicates, args=args))
+        else:
+            _partition_duplicates(*args)
+    for job in jobs:
+        job.get()
+    if pool:
+        pool.close()
+        pool.join()
+    dups = []
+    for part in xrange(nparts):
+        dfnam = os.path.join(tmp_dir, 'dups_%03d' % part)
+        dups.append(fromfile(dfnam, dtype=int64))
+        os.remove(dfnam)
+    os.rmdir(tmp_dir)
+    return sort(concatenate(dups))
+
 def _filter_from_res(fnam, max_frag_size, min_dist_to_re,
                      re_proximity, min_frag_size, output):
     # t0 = time()
@@ -6,9 +6,13 @@ import os
 from pytadbit.utils.file_handling import mkdir, which
 from warnings import warn
 from pytadbit.utils.file_handling import magic_open, get_free_space_mb
-from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES, religated
+from pytadbit.mapping.restriction_enzymes import ligation_sites
 from tempfile import gettempdir, mkstemp
 from subprocess import CalledProcessError, PIPE, Popen
+from time import sleep
+from itertools import islice
+from collections import deque
+import multiprocessing as mu
 
 def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
                     min_seq_len=15, fastq=True, verbose=True,
@@ -18,122 +22,43 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
     trim each read according to a start/end positions or split them into
     restriction enzyme fragments
 
+    Reads are processed by blocks, in parallel when splitting them into
+    restriction enzyme fragments.
+
+    :param None r_enz: name of the restriction enzyme, or list of names (reads
+       are then split at any of the ligation sites, including ligations
+       between ends of different enzymes)
     :param True add_site: when splitting the sequence by ligated sites found,
        removes the ligation site, and put back the original RE site.
+    :param 1 nthreads: number of processes used to split reads into
+       restriction enzyme fragments
+    :param 100000 block_size: number of reads processed at once
 
     """
     skip = kwargs.get('skip', False)
-    ## define local funcitons to process reads and sequences
-    def _get_fastq_read_heavy(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = fhandler.next()
-        _   = fhandler.next()  # lose qualities header but not needed
-        qal = fhandler.next()  # lose qualities but not needed
-        # header now also contains original read
-        return (rlines + ' ' + seq.strip() + ' ' + qal.strip(),
-                seq.strip(), qal.strip())
-
-    def _get_fastq_read_light(rlines):
-        """
-        returns header and sequence of 1 FASTQ entry
-        Note: header also contains the sequence
-        """
-        rlines = rlines.rstrip('\n').split()[0][1:]
-        seq = fhandler.next()
-        _   = fhandler.next()  # lose qualities header but not needed
-        qal = fhandler.next()  # lose qualities but not needed
-        return (rlines, seq.strip(), qal.strip())
-
-    def _get_map_read_heavy(line):
-        header = line.split('\t', 1)[0]
-        seq, qal    = header.rsplit(' ', 2)[-2:]
-        return header, seq, qal
-
-    def _get_map_read_light(line):
-        header, seq, qal, _ = line.split('\t', 3)
-        return header, seq, qal
-
-    def _split_read_re(seq, qal, pattern, max_seq_len=None, site='', cnt=0):
-        """
-        Recursive generator that splits reads according to the
-        predefined restriction enzyme.
-        RE fragments yielded are followed and preceded by the RE site if a
-        ligation site was found after the fragment.
-
-        EXAMPLE:
-
-           seq = '-------oGATCo========oGATCGATCo_____________oGATCGATCo~~~~~~~~~~~~'
-           qal = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
-
-        should yield these fragments:
-        
-            -------oGATCo========oGATC
-            xxxxxxxxxxxxxxxxxxxxxxHHHH
-
-            GATCo_____________oGATC
-            HHHHxxxxxxxxxxxxxxxHHHH
-
-            GATCo~~~~~~~~~~~~
-            HHHHxxxxxxxxxxxxx
-        
-        """
-        cnt += 1
-        try:
-            pos = seq.index(pattern)
-        except ValueError:
-            if len(seq) == max_seq_len:
-                raise ValueError
-            if len(seq) > min_seq_len:
-                yield seq, qal, cnt
-            return
-        xqal = ('H' * len(site))
-        if pos < min_seq_len:
-            split_read(site + seq[pos + len_relg:],
-                       xqal + qal[pos + len_relg:],
-                       pattern, max_seq_len, cnt=cnt)
-        else:
-            yield seq[:pos] + site, qal[:pos] + xqal, cnt
-        new_pos = pos + len_relg
-        for sseq, sqal, cnt in split_read(site + seq[new_pos:],
-                                          xqal + qal[new_pos:], pattern,
-                                          max_seq_len, site=site, cnt=cnt):
-            yield sseq, sqal, cnt
-
-    # Define function for stripping lines according to focus
-    if isinstance(trim, tuple):
-        beg, end = trim
-        beg -= 1
-        strip_line = lambda x: x[beg:end]
-    else:
-        strip_line = lambda x: x
-
-    # define function to split reads according to restriction enzyme sites
-    if isinstance(r_enz, str):
-        enzyme = RESTRICTION_ENZYMES[r_enz].replace('|', '')
-        enz_pattern = religated(r_enz)
-        sub_enz_pattern = enz_pattern[:len(enz_pattern) / 2]
-        len_relg = len(enz_pattern)
+    nthreads = kwargs.get('nthreads', 1) or 1
+    block_size = kwargs.get('block_size', 100000)
+
+    # define ligation sites to split reads according to restriction enzymes
+    if r_enz:
+        ligations = ligation_sites(r_enz)
+        # half ligation sites, in case no full ligation site is found
+        sub_ligations = [(lig[:len(lig) / 2], len(lig), '', '')
+                         for lig, _, _ in ligations[:len(r_enz)
+                                                    if isinstance(r_enz, list)
+                                                    else 1]]
+        ligations = [(lig, len(lig), site1 if add_site else '',
+                      site2 if add_site else '')
+                     for lig, site1, site2 in ligations]
         print '  - splitting into restriction enzyme (RE) fragments using ligation sites'
         print '  - ligation sites are replaced by RE sites to match the reference genome'
-        print '    * enzyme: %s, ligation site: %s, RE site: %s' % (r_enz, enz_pattern, enzyme)
-        split_read = _split_read_re
+        for lig, _, site1, site2 in ligations:
+            print '    * ligation site: %s, RE sites: %s, %s' % (
+                lig, site1 or '-', site2 or '-')
     else:
-        enzyme = ''
-        enz_pattern = ''
-        split_read = lambda x, y, z, after_z, after_after_z: (yield x, y , 1)
-
-    # function to yield reads from input file
-    if light_storage:
-        get_seq = _get_fastq_read_light if fastq else _get_map_read_light
-        insert_mark = insert_mark_light
-    else:
-        get_seq = _get_fastq_read_heavy if fastq else _get_map_read_heavy
-        insert_mark = insert_mark_heavy
-        
+        ligations = sub_ligations = None
+        nthreads = 1
+
     ## Start processing the input file
     if verbose:
         print 'Preparing %s file' % ('FASTQ' if fastq else 'MAP')
@@ -155,42 +80,148 @@ def transform_fastq(fastq_path, out_fastq, trim=None, r_enz=None, add_site=True,
     # create output file
     out_name = out_fastq
     out = open(out_fastq, 'w')
-    # iterate over reads and strip them
-    site = enzyme if add_site else ''
-    for header in fhandler:
-        header, seq, qal = get_seq(header)
-        counter += 1
-        # trim on wanted region of the read
-        seq = strip_line(seq)
-        qal = strip_line(qal)
-        # get the generator of restriction enzyme fragments
-        iter_frags = split_read(seq, qal, enz_pattern, len(seq), site)
-        # the first fragment should not be preceded by the RE site
+    settings = (fastq, light_storage, trim if isinstance(trim, tuple) else None,
+                ligations, sub_ligations, min_seq_len)
+    nlines = 4 if fastq else 1
+    blocks = iter(lambda: list(islice(fhandler, block_size * nlines)), [])
+    # processes can not be started from a daemon process (e.g. when the
+    # mapping is streamed)
+    if nthreads > 1 and not mu.current_process().daemon:
+        pool = mu.Pool(nthreads, initializer=_init_transform,
+                       initargs=(settings, ))
+        # a limited number of blocks are queued, in order to keep memory low
+        procs = deque()
+        for block in blocks:
+            counter += len(block) / nlines
+            procs.append(pool.apply_async(_transform_block, args=(block, )))
+            if len(procs) > 2 * nthreads:
+                out.write(procs.popleft().get())
+        while procs:
+            out.write(procs.popleft().get())
+        pool.close()
+        pool.join()
+    else:
+        _init_transform(settings)
+        for block in blocks:
+            counter += len(block) / nlines
+            out.write(_transform_block(block))
+    out.close()
+    return out_name, counter
+
+# parameters used by the processes transforming reads (see _init_transform)
+_TRANSFORM = None
+
+def _init_transform(settings):
+    """
+    Stores the parameters to transform reads in the (worker) process.
+    """
+    global _TRANSFORM
+    _TRANSFORM = settings
+
+def _transform_block(lines):
+    """
+    Trims reads of a block of lines of a FASTQ (or MAP) file, and split them
+    into restriction enzyme fragments.
+
+    :returns: the transformed reads in FASTQ format (as text)
+    """
+    fastq, light_storage, trim, ligations, sub_ligations, min_seq_len = _TRANSFORM
+    # get header and sequence of each entry
+    # Note: in heavy storage header also contains the original sequence
+    if fastq:
+        heads = [l.rstrip('\n').split()[0][1:] for l in lines[0::4]]
+        seqs  = [l.strip() for l in lines[1::4]]
+        qals  = [l.strip() for l in lines[3::4]]
+        if not light_storage:
+            heads = ['%s %s %s' % read for read in zip(heads, seqs, qals)]
+    elif light_storage:
+        heads, seqs, qals = zip(*[l.split('\t', 3)[:3] for l in lines]) or (
+            (), (), ())
+    else:
+        heads = [l.split('\t', 1)[0] for l in lines]
+        seqs, qals = zip(*[h.rsplit(' ', 2)[-2:] for h in heads]) or ((), ())
+    # trim on wanted region of the read
+    if trim:
+        beg, end = trim
+        beg -= 1
+        seqs = [s[beg:end] for s in seqs]
+        qals = [q[beg:end] for q in qals]
+    if not ligations:
+        return ''.join(['@%s\n%s\n+\n%s\n' % read
+                        for read in zip(heads, seqs, qals)])
+    insert_mark = insert_mark_light if light_storage else insert_mark_heavy
+    out = []
+    for header, seq, qal in zip(heads, seqs, qals):
         try:
-            seq, qal, cnt = iter_frags.next()
-        except StopIteration:
-            # read full of ligation events, fragments not reaching minimum
-            continue
+            frags = split_read_re(seq, qal, ligations, min_seq_len)
         except ValueError:
             # or not ligation site found, in which case we try with half
             # ligation site in case there was a sequencing error (half ligation
             # site is a RE site or nearly, and thus should not be found anyway)
-            iter_frags = split_read(seq, qal, sub_enz_pattern, len(seq), '')
             try:
-                seq, qal, cnt = iter_frags.next()
+                frags = split_read_re(seq, qal, sub_ligations, min_seq_len)
             except ValueError:
                 continue
-            except StopIteration:
-                continue
-        out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                        seq, qal, '0', '-\n'))))
-        # the next fragments should be preceded by the RE site
-        # continue
-        for seq, qal, cnt in  iter_frags:
-            out.write(_map2fastq('\t'.join((insert_mark(header, cnt),
-                                            seq, qal, '0', '-\n'))))
-    out.close()
-    return out_name, counter
+        for fseq, fqal, cnt in frags:
+            out.append('@%s\n%s\n+\n%s\n' % (insert_mark(header, cnt),
+                                             fseq, fqal))
+    return ''.join(out)
+
+def split_read_re(seq, qal, ligations, min_seq_len=15):
+    """
+    Splits reads according to the ligation sites of restriction enzymes.
+    RE fragments are followed and preceded by the RE site if a ligation site
+    was found after the fragment.
+
+    EXAMPLE:
+
+       seq = '-------oGATCo========oGATCGATCo_____________oGATCGATCo~~~~~~~~~~~~'
+       qal = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+
+    should return these fragments:
+
+        -------oGATCo========oGATC
+        xxxxxxxxxxxxxxxxxxxxxxHHHH
+
+        GATCo_____________oGATC
+        HHHHxxxxxxxxxxxxxxxHHHH
+
+        GATCo~~~~~~~~~~~~
+        HHHHxxxxxxxxxxxxx
+
+    :param seq: sequence of the read
+    :param qal: qualities of the read
+    :param ligations: list of tuples with the ligation site, its length, the
+       RE site to be put back before the ligation and the RE site to be put
+       back after (empty strings in order to remove the ligation site)
+    :param 15 min_seq_len: minimum size of a fragment
+
+    :raises ValueError: if no ligation site is found
+    :returns: a list of tuples with the sequence, the qualities and the
+       number of each fragment (fragments shorter than min_seq_len are
+       skipped, but counted)
+    """
+    frags = []
+    cnt = 0
+    while True:
+        cnt += 1
+        # first ligation site found
+        pos = -1
+        for lig, len_lig, site1, site2 in ligations:
+            lig_pos = seq.find(lig)
+            if lig_pos != -1 and (pos == -1 or lig_pos < pos):
+                pos, len_relg, xsite1, xsite2 = lig_pos, len_lig, site1, site2
+        if pos == -1:
+            if cnt == 1:
+                raise ValueError
+            if len(seq) > min_seq_len:
+                frags.append((seq, qal, cnt))
+            return frags
+        if pos >= min_seq_len:
+            frags.append((seq[:pos] + xsite1, qal[:pos] + 'H' * len(xsite1),
+                          cnt))
+        seq = xsite2 + seq[pos + len_relg:]
+        qal = 'H' * len(xsite2) + qal[pos + len_relg:]
 
 def insert_mark_heavy(header, num):
     if num == 1 :
@@ -243,6 +274,88 @@ def _gem_filter(fnam, unmap_out, map_out):
             map_out.write(_strip_read_name(line))
     unmap_out.close()
 
+def _stream_mapping(gem_index_path, fastq_path, out_map_dir, base_name,
+                    tmp_dir, r_enz, frag_map, windows, light_storage,
+                    min_seq_len, add_site, clean, **kwargs):
+    """
+    Runs all the rounds of the mapping at the same time (see
+    :func:`full_mapping`), each step (splitting/trimming of reads, mapping,
+    filtering) in a different process, connected through named pipes.
+
+    :returns: a list with the path to each output file and the number of
+       reads processed
+    """
+    suffix = kwargs.get('suffix', '')
+    suffix = ('_' * (suffix != '')) + suffix
+    nthreads = kwargs.get('nthreads', 8)
+    rounds = [('full', win) for win in windows]
+    if frag_map:
+        if not r_enz:
+            raise Exception('ERROR: need enzyme name to fragment.')
+        rounds.append(('frag', windows[-1]))
+    fifos = []
+    def _mkfifo(fnam):
+        os.mkfifo(fnam)
+        fifos.append(fnam)
+        return fnam
+    # each round has 3 steps, all running at the same time
+    pool = mu.Pool(3 * len(rounds))
+    procs = []
+    outfiles = []
+    input_reads = fastq_path
+    for num, (step, win) in enumerate(rounds):
+        beg, end = win if win else (1, 'end')
+        curr_map = mkstemp(prefix=base_name + '_', dir=tmp_dir)[1]
+        os.remove(curr_map)
+        _mkfifo(curr_map)
+        out_map_path = _mkfifo(curr_map + '_%s_%s-%s%s.map' % (
+            step, beg, end, suffix))
+        if step == 'full':
+            unmap_out = curr_map + '_filt_%s-%s%s.map' % (beg, end, suffix)
+        else:
+            unmap_out = curr_map + '_fail%s.map' % (suffix)
+        # unmapped reads of the last round are written to disk
+        if num < len(rounds) - 1:
+            _mkfifo(unmap_out)
+        map_out = os.path.join(out_map_dir, base_name + '_%s_%s-%s%s.map' % (
+            step, beg, end, suffix))
+        if end:
+            print 'Mapping reads in window %s-%s%s...' % (beg, end, suffix)
+        procs.append(pool.apply_async(transform_fastq, args=(
+            input_reads, curr_map), kwds={
+                'fastq': step == 'full' and (
+                    input_reads.endswith('.fastq'   ) or
+                    input_reads.endswith('.fastq.gz') or
+                    input_reads.endswith('.fq.gz'   ) or
+                    input_reads.endswith('.dsrc'    )),
+                'r_enz': r_enz if step == 'frag' else None,
+                'min_seq_len': min_seq_len, 'trim': win, 'add_site': add_site,
+                'nthreads': nthreads, 'light_storage': light_storage}))
+        procs.append(pool.apply_async(gem_mapping, args=(
+            gem_index_path, curr_map, out_map_path), kwds=kwargs))
+        procs.append(pool.apply_async(_gem_filter, args=(
+            out_map_path, unmap_out, map_out)))
+        outfiles.append(map_out)
+        input_reads = unmap_out
+    pool.close()
+    # if one step fails, the others would wait forever for their input
+    while not all(proc.ready() for proc in procs):
+        for proc in procs:
+            if proc.ready() and not proc.successful():
+                pool.terminate()
+                for fnam in fifos:
+                    os.remove(fnam)
+                proc.get()
+        sleep(0.5)
+    pool.join()
+    counters = [proc.get()[1] for proc in procs[::3]]
+    for fnam in fifos:
+        os.remove(fnam)
+    if clean:
+        print '   x removing unmapped reads %s' % (input_reads)
+        os.remove(input_reads)
+    return zip(outfiles, counters)
+
 def gem_mapping(gem_index_path, fastq_path, out_map_path,
                 gem_binary='gem-mapper', **kwargs):
     """
@@ -321,17 +434,23 @@ def gem_mapping(gem_index_path, fastq_path, out_map_path,
                       'mismatch-alphabet', 'E', 'max-extendable-matches',
                       'max-extensions-per-match', 'e', 'paired-end-alignment',
                       'p', 'map-both-ends', 'fast-mapping', 'unique-mapping',
-                      'unique-pairing', 'suffix']:
+                      'unique-pairing', 'suffix', 'stream']:
             warn('WARNING: %s not in usual keywords, misspelled?' % kw)
 
     print ' '.join(gem_cmd)
     try:
         # check_call(gem_cmd, stdout=PIPE, stderr=PIPE)
-        out, err = Popen(gem_cmd, stdout=PIPE, stderr=PIPE).communicate()
+        proc = Popen(gem_cmd, stdout=PIPE, stderr=PIPE)
+        out, err = proc.communicate()
     except CalledProcessError as e:
         print out
         print err
         raise Exception(e.output)
+    if proc.returncode:
+        print out
+        print err
+        raise Exception('ERROR: mapping failed (exit code %d)\n' % (
+            proc.returncode))
 
 def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=True,
                  min_seq_len=15, windows=None, add_site=True, clean=False,
@@ -369,6 +488,13 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
        written there.
     :param False get_nreads: returns a list of lists where each element contains
        a path and the number of reads processed
+    :param False stream: all the mapping rounds run at the same time, reads
+       being passed from one step to the next through named pipes (FIFOs)
+       created in temp_dir: reads are split/trimmed while the mapper works,
+       and unmapped reads are sent to the next round as soon as they are
+       found. Only the uniquely mapped reads are written to disk (the mapper
+       has to read its input sequentially)
+    :param gem-mapper gem_binary: path to the mapper binary
 
     :returns: a list of paths to generated outfiles. To be passed to 
        :func:`pytadbit.parsers.map_parser.parse_map`
@@ -405,6 +531,14 @@ def full_mapping(gem_index_path, fastq_path, out_map_dir, r_enz=None, frag_map=T
         # in this case we will need to keep the information about original
         # sequence at any point, light storage is thus not possible.
         light_storage = False
+    if kwargs.get('stream', False) and not skip:
+        outfiles = _stream_mapping(gem_index_path, fastq_path, out_map_dir,
+                                   base_name, temp_dir, r_enz, frag_map,
+                                   windows, light_storage, min_seq_len,
+                                   add_site, clean, **kwargs)
+        if get_nread:
+            return outfiles
+        return [out for out, _ in outfiles]
     for win in windows:
         # Prepare the FASTQ file and iterate over them
         curr_map, counter = transform_fastq(
@@ -0,0 +1,335 @@
+"""
+17 Oct 2026
+
+Statistics of files of pairs of reads (generated by
+:func:`pytadbit.mapping.get_intersection` or by the filtering), collected in a
+single pass over the reads, and saved next to the file in order to plot them
+without reading the reads again (see :mod:`pytadbit.mapping.analyze`).
+"""
+
+from collections                   import OrderedDict
+from itertools                     import islice
+from os                            import path
+import multiprocessing as mu
+import numpy as np
+from pytadbit.parsers.pairs_parser import is_binary_pairs, iter_pairs_blocks
+from pytadbit.parsers.pairs_parser import read_pairs_header, lines_to_block
+from pytadbit.utils.file_handling  import file_chunks, chunk_lines
+
+# columns needed to compute the statistics
+STATS_COLUMNS = ('crm1', 'pos1', 'strand1', 'rs1', 're1',
+                 'crm2', 'pos2', 'strand2', 'rs2', 're2')
+
+
+def _add(arr1, arr2):
+    """
+    sum of two arrays of counts of different lengths
+    """
+    if len(arr1) < len(arr2):
+        arr1, arr2 = arr2, arr1
+    arr1 = arr1.copy()
+    arr1[:len(arr2)] += arr2
+    return arr1
+
+
+class ReadsStats(object):
+    """
+    Histograms describing a file of pairs of reads:
+
+      - ``dangling``: lengths of dangling-ends (see
+        :func:`pytadbit.mapping.analyze.insert_sizes`)
+      - ``genomic``: number of reads per bin of each chromosome, for the
+        first and for the second read-end (see
+        :func:`pytadbit.mapping.analyze.plot_genomic_distribution`)
+      - ``dist_nts`` and ``dist_bins``: distances between the read-ends of
+        intra-chromosomal pairs, in nucleotides (up to max_diff) and in
+        bins (see :func:`pytadbit.mapping.analyze.plot_distance_vs_interactions`)
+      - ``rsite_right`` and ``rsite_left``: distances of the read-ends to the
+        closest RE site (see
+        :func:`pytadbit.mapping.analyze.plot_rsite_reads_distribution`)
+      - ``diag_des``, ``diag_rbreaks`` and ``diag_rejoined``: lengths of the
+        molecules close to the diagonal (see
+        :func:`pytadbit.mapping.analyze.plot_diagonal_distributions`)
+
+    Statistics computed on different parts of a file can be merged.
+
+    :param genome_seq: dictionary with chromosome names and lengths (ordered
+       as in the header of the file of reads)
+    :param 10000 resolution: size of the bins of the genomic distribution
+       and of the distances in bins
+    :param 1000 max_diff: maximum distance (in nucleotides) between
+       read-ends
+    :param 20 window: maximum distance to the RE site
+    :param 1000 maxdist: maximum length of the molecules to count the
+       distances to RE sites
+    :param 800 diag_maxdist: maximum length of the molecules close to the
+       diagonal
+    :param (-2, 3) de_left: distances to the RE site of the second read-end
+       defining a dangling-end
+    :param (0, 5) de_right: distances to the RE site of the first read-end
+       defining a dangling-end
+    """
+    def __init__(self, genome_seq, resolution=10000, max_diff=1000, window=20,
+                 maxdist=1000, diag_maxdist=800, de_left=(-2, 3),
+                 de_right=(0, 5)):
+        self.genome_seq   = genome_seq
+        self.resolution   = resolution
+        self.max_diff     = max_diff
+        self.window       = window
+        self.maxdist      = maxdist
+        self.diag_maxdist = diag_maxdist
+        self.de_left      = tuple(de_left)
+        self.de_right     = tuple(de_right)
+        self.nreads       = 0
+        empty = lambda: np.zeros(0, dtype=np.int64)
+        self.dangling      = empty()
+        self.genomic       = [[empty() for _ in genome_seq] for _ in (1, 2)]
+        self.dist_nts      = np.zeros(max_diff, dtype=np.int64)
+        self.dist_bins     = empty()
+        self.rsite_right   = np.zeros(2 * window + 1, dtype=np.int64)
+        self.rsite_left    = np.zeros(2 * window + 1, dtype=np.int64)
+        self.diag_des      = np.zeros(diag_maxdist + 1, dtype=np.int64)
+        self.diag_rbreaks  = np.zeros(diag_maxdist + 1, dtype=np.int64)
+        self.diag_rejoined = np.zeros(diag_maxdist + 1, dtype=np.int64)
+
+    @property
+    def params(self):
+        """
+        parameters of the statistics (should be the same to merge them)
+        """
+        return {'resolution'  : self.resolution,
+                'max_diff'    : self.max_diff,
+                'window'      : self.window,
+                'maxdist'     : self.maxdist,
+                'diag_maxdist': self.diag_maxdist,
+                'de_left'     : self.de_left,
+                'de_right'    : self.de_right}
+
+    def add_block(self, block):
+        """
+        :param block: dictionary of columns (at least STATS_COLUMNS), as
+           returned by :func:`pytadbit.parsers.pairs_parser.iter_pairs_blocks`
+        """
+        crm1, pos1, strand1 = block['crm1'], block['pos1'], block['strand1']
+        crm2, pos2, strand2 = block['crm2'], block['pos2'], block['strand2']
+        self.nreads += len(pos1)
+        intra = crm1 == crm2
+        # dangling-ends
+        dangling = (intra & (block['rs1'] == block['rs2']) &
+                    (strand1 != strand2) & ((pos2 > pos1) == strand1))
+        self.dangling = _add(self.dangling, np.bincount(
+            abs(pos2[dangling] - pos1[dangling])))
+        # genomic distribution
+        for num, (crms, bins) in enumerate(((crm1, pos1 / self.resolution),
+                                            (crm2, pos2 / self.resolution))):
+            for crm in np.unique(crms):
+                self.genomic[num][crm] = _add(self.genomic[num][crm],
+                                              np.bincount(bins[crms == crm]))
+        # distances between read-ends
+        pos1, pos2 = pos1[intra], pos2[intra]
+        diffs = abs(pos2 - pos1)
+        self.dist_nts += np.bincount(diffs[diffs < self.max_diff],
+                                     minlength=self.max_diff)
+        self.dist_bins = _add(self.dist_bins, np.bincount(
+            abs(pos2 / self.resolution - pos1 / self.resolution)))
+        # read-ends ordered by position, and facing each other (-> <-)
+        swap = pos1 > pos2
+        order = lambda x1, x2: (np.where(swap, x2, x1), np.where(swap, x1, x2))
+        sb1, sb2 = order(pos1, pos2)
+        sd1, sd2 = order(strand1[intra], strand2[intra])
+        ru1, ru2 = order(block['rs1'][intra], block['rs2'][intra])
+        rd1, rd2 = order(block['re1'][intra], block['re2'][intra])
+        facing = (sd1 == 1) & (sd2 == 0)
+        mollen = sb2 - sb1
+        # distance to the closest RE site
+        dist1 = sb1 - np.where(abs(sb1 - ru1) < abs(sb1 - rd1), ru1, rd1)
+        dist2 = sb2 - np.where(abs(sb2 - ru2) < abs(sb2 - rd2), ru2, rd2)
+        close = facing & (mollen <= self.maxdist)
+        size = 2 * self.window + 1
+        for hist, dist in ((self.rsite_right, dist1),
+                           (self.rsite_left, dist2)):
+            hist += np.bincount(dist[close & (abs(dist) <= self.window)] +
+                                self.window, minlength=size)
+        # molecules close to the diagonal
+        close = facing & (mollen <= self.diag_maxdist)
+        des = np.in1d(dist1, self.de_right) | np.in1d(dist2, self.de_left)
+        rbreaks = ~des & (rd1 == rd2)
+        rejoined = ~des & ~rbreaks
+        size = self.diag_maxdist + 1
+        for hist, kind in ((self.diag_des, des), (self.diag_rbreaks, rbreaks),
+                           (self.diag_rejoined, rejoined)):
+            hist += np.bincount(mollen[close & kind], minlength=size)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another part of the file of reads.
+
+        :param other: a :class:`ReadsStats` with the same parameters
+
+        :returns: itself
+        """
+        if other.params != self.params:
+            raise ValueError('ERROR: statistics with different parameters\n')
+        self.nreads += other.nreads
+        for name in ('dangling', 'dist_nts', 'dist_bins', 'rsite_right',
+                     'rsite_left', 'diag_des', 'diag_rbreaks',
+                     'diag_rejoined'):
+            setattr(self, name, _add(getattr(self, name),
+                                     getattr(other, name)))
+        for num in (0, 1):
+            self.genomic[num] = [_add(this, that) for this, that in
+                                 zip(self.genomic[num], other.genomic[num])]
+        return self
+
+    def genomic_distribution(self, first_read=True, resolution=None):
+        """
+        :param True first_read: counts of the first read-end (otherwise of
+           the second)
+        :param None resolution: size of the bins, should be a multiple of the
+           resolution of the statistics (by default the same)
+
+        :returns: a dictionary with, for each chromosome with reads, the
+           counts per bin
+        """
+        resolution = resolution or self.resolution
+        if resolution % self.resolution:
+            raise ValueError(('ERROR: resolution should be a multiple of '
+                              '%d\n') % self.resolution)
+        factor = resolution / self.resolution
+        distr = {}
+        for crm, counts in zip(self.genome_seq,
+                               self.genomic[0 if first_read else 1]):
+            if counts.any():
+                distr[crm] = np.bincount(np.arange(len(counts)) / factor,
+                                         weights=counts).astype(np.int64)
+        return distr
+
+    def save(self, fnam):
+        """
+        Save the statistics to a NumPy (.npz) file.
+
+        :param fnam: path to the output file
+        """
+        arrays = {}
+        for num in (0, 1):
+            arrays['genomic%d' % num] = np.concatenate(
+                self.genomic[num] + [np.zeros(0, dtype=np.int64)])
+            arrays['genomic%d_len' % num] = np.array(
+                [len(c) for c in self.genomic[num]], dtype=np.int64)
+        out = open(fnam, 'wb')
+        np.savez(out, crms=np.array(self.genome_seq.keys()),
+                 crm_lengths=np.array(self.genome_seq.values()),
+                 nreads=self.nreads, dangling=self.dangling,
+                 dist_nts=self.dist_nts, dist_bins=self.dist_bins,
+                 rsite_right=self.rsite_right, rsite_left=self.rsite_left,
+                 diag_des=self.diag_des, diag_rbreaks=self.diag_rbreaks,
+                 diag_rejoined=self.diag_rejoined,
+                 resolution=self.resolution, diag_maxdist=self.diag_maxdist,
+                 maxdist=self.maxdist, de_left=self.de_left,
+                 de_right=self.de_right, **arrays)
+        out.close()
+
+    @classmethod
+    def load(cls, fnam):
+        """
+        Load statistics saved with :func:`ReadsStats.save`
+
+        :param fnam: path to a NumPy (.npz) file
+        """
+        data = np.load(fnam)
+        genome_seq = OrderedDict(zip(data['crms'].tolist(),
+                                     data['crm_lengths'].tolist()))
+        stats = cls(genome_seq, resolution=int(data['resolution']),
+                    max_diff=len(data['dist_nts']),
+                    window=len(data['rsite_right']) / 2,
+                    maxdist=int(data['maxdist']),
+                    diag_maxdist=int(data['diag_maxdist']),
+                    de_left=data['de_left'].tolist(),
+                    de_right=data['de_right'].tolist())
+        stats.nreads = int(data['nreads'])
+        for name in ('dangling', 'dist_nts', 'dist_bins', 'rsite_right',
+                     'rsite_left', 'diag_des', 'diag_rbreaks',
+                     'diag_rejoined'):
+            setattr(stats, name, data[name])
+        for num in (0, 1):
+            bounds = np.cumsum(data['genomic%d_len' % num])
+            stats.genomic[num] = np.split(data['genomic%d' % num],
+                                          bounds[:-1])
+        data.close()
+        return stats
+
+
+def _chunk_stats(fnam, beg, end, crm_idx, genome_seq, params, chunk):
+    """
+    statistics of the reads starting in a byte range of a file in text format
+    """
+    stats = ReadsStats(genome_seq, **params)
+    lines = chunk_lines(fnam, beg, end)
+    for group in iter(lambda: list(islice(lines, chunk)), []):
+        stats.add_block(lines_to_block(group, crm_idx,
+                                       columns=STATS_COLUMNS))
+    return stats
+
+
+def reads_stats(fnam, nthreads=1, chunk=100000, **kwargs):
+    """
+    Computes, in a single pass over the reads, the statistics needed to plot
+    the quality of a file of pairs of reads (see :class:`ReadsStats`).
+
+    :param fnam: path to a file of pairs of reads, in text or binary format
+    :param 1 nthreads: number of parts of the file (in text format)
+       processed in parallel
+    :param 100000 chunk: number of reads processed at once (text format)
+    :param kwargs: parameters of the statistics (see :class:`ReadsStats`)
+
+    :returns: a :class:`ReadsStats`
+    """
+    header, genome_seq = read_pairs_header(fnam)
+    if is_binary_pairs(fnam):
+        stats = ReadsStats(genome_seq, **kwargs)
+        for block in iter_pairs_blocks(fnam, columns=STATS_COLUMNS):
+            stats.add_block(block)
+        return stats
+    params = ReadsStats(genome_seq, **kwargs).params
+    crm_idx = dict((c, i) for i, c in enumerate(genome_seq))
+    chunks = file_chunks(fnam, nthreads, start=len(header))
+    if len(chunks) == 1:
+        return _chunk_stats(fnam, chunks[0][0], None, crm_idx, genome_seq,
+                            params, chunk)
+    pool = mu.Pool(nthreads)
+    jobs = [pool.apply_async(_chunk_stats, args=(
+        fnam, beg, end, crm_idx, genome_seq, params, chunk))
+            for beg, end in chunks]
+    pool.close()
+    stats = jobs[0].get()
+    for job in jobs[1:]:
+        stats.merge(job.get())
+    pool.join()
+    return stats
+
+
+def get_reads_stats(fnam, nthreads=1, **kwargs):
+    """
+    Statistics of a file of pairs of reads (see :func:`reads_stats`). The
+    statistics are stored next to the file (with the extension .stats) and
+    loaded instead of being computed for the next calls, unless the file of
+    reads is newer or the parameters differ.
+
+    :param fnam: path to a file of pairs of reads
+    :param 1 nthreads: number of parts of the file processed in parallel
+    :param kwargs: parameters of the statistics (see :class:`ReadsStats`)
+
+    :returns: a :class:`ReadsStats`
+    """
+    stats_fnam = fnam + '.stats'
+    if (path.exists(stats_fnam) and
+        path.getmtime(stats_fnam) >= path.getmtime(fnam)):
+        stats = ReadsStats.load(stats_fnam)
+        if stats.params == ReadsStats(stats.genome_seq, **kwargs).params:
+            return stats
+    stats = reads_stats(fnam, nthreads=nthreads, **kwargs)
+    try:
+        stats.save(stats_fnam)
+    except IOError:
+        pass
+    return stats
@@ -4,7 +4,15 @@
 Definition and mapping of restriction enymes
 """
 
-from re import compile
+from re                          import compile
+from collections                 import OrderedDict
+from hashlib                     import md5
+from os                          import path, rename, getpid
+from numpy                       import array, asarray, concatenate, cumsum
+from numpy                       import fromiter, int64, maximum, savez
+from numpy                       import searchsorted, where
+from numpy                       import load as load_npz
+from pytadbit.utils.file_handling import mkdir
 
 
 def count_re_fragments(fnam):
@@ -136,6 +144,169 @@ def map_re_sites(enzyme_name, genome_seq, frag_chunk=100000, verbose=False):
         print 'Found %d RE sites' % count
     return frags
 
+class REFragments(object):
+    """
+    Index of restriction enzyme (RE) sites of a genome, stored as one sorted
+    NumPy array per chromosome (first position of the chromosome, RE sites,
+    and chromosome length), as in :func:`map_re_sites_nochunk`.
+
+    :param sites: an ordered dictionary with chromosome names as keys and
+       sorted arrays of RE sites as values
+    :param None enzyme_name: name of the enzyme
+    """
+    def __init__(self, sites, enzyme_name=None):
+        self.sites = OrderedDict((crm, asarray(sites[crm], dtype=int64))
+                                 for crm in sites)
+        self.enzyme_name = enzyme_name
+
+    @classmethod
+    def from_genome(cls, enzyme_name, genome_seq, verbose=False):
+        """
+        Search RE sites in a genome.
+
+        :param enzyme_name: name of the enzyme to map (upper/lower case are
+           important)
+        :param genome_seq: a dictionary containing the genomic sequence by
+           chromosome
+        """
+        enzyme      = RESTRICTION_ENZYMES[enzyme_name]
+        enz_pattern = compile(enzyme.replace('|', ''))
+        enz_cut     = enzyme.index('|') + 1 # re search starts at 0
+        sites = OrderedDict()
+        count = 0
+        for crm in genome_seq:
+            seq = genome_seq[crm]
+            found = fromiter((m.start() + enz_cut
+                              for m in enz_pattern.finditer(seq)), dtype=int64)
+            sites[crm] = concatenate(([1], found, [len(seq)]))
+            count += len(found)
+        if verbose:
+            print 'Found %d RE sites' % count
+        return cls(sites, enzyme_name)
+
+    @classmethod
+    def load(cls, fnam):
+        """
+        Load an index saved with :func:`REFragments.save`
+
+        :param fnam: path to a NumPy (.npz) file
+        """
+        data = load_npz(fnam)
+        crms = data['crms'].tolist()
+        bounds = data['bounds']
+        sites = data['sites']
+        enzyme_name = str(data['enzyme']) or None
+        data.close()
+        return cls(OrderedDict((crm, sites[bounds[i]:bounds[i + 1]])
+                               for i, crm in enumerate(crms)), enzyme_name)
+
+    def save(self, fnam):
+        """
+        Save the index to a NumPy (.npz) file. The file is written under a
+        temporary name and renamed, in order to never leave an incomplete
+        index.
+
+        :param fnam: path to the output file (should end in .npz)
+        """
+        crms = self.sites.keys()
+        bounds = cumsum([0] + [len(self.sites[c]) for c in crms])
+        tmp_fnam = '%s_%d.tmp.npz' % (fnam[:-4], getpid())
+        savez(tmp_fnam, crms=array(crms), bounds=bounds,
+              sites=concatenate([self.sites[c] for c in crms]
+                                ).astype('uint32'),
+              enzyme=array(self.enzyme_name or ''))
+        rename(tmp_fnam, fnam)
+
+    def __contains__(self, crm):
+        return crm in self.sites
+
+    def __getitem__(self, crm):
+        return self.sites[crm]
+
+    def __iter__(self):
+        return iter(self.sites)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def fragments(self, crm, pos, len_seq=None):
+        """
+        Find the RE fragments containing a batch of positions.
+
+        :param crm: chromosome name
+        :param pos: array of genomic positions
+        :param None len_seq: array with the length of the mapped reads. If
+           given, positions falling after the end of the chromosome are
+           moved to its last nucleotide (reads mapped partly outside the
+           chromosome)
+
+        :returns: the (corrected) positions, the positions of the closest
+           upstream RE site, and of the closest downstream RE site, as arrays
+        """
+        sites = self.sites[crm]
+        pos = asarray(pos, dtype=int64)
+        last = sites[-1]
+        outside = pos >= last
+        if len_seq is not None and outside.any():
+            if (pos[outside] - last + 1 >= asarray(len_seq)[outside]).any():
+                raise Exception('Read mapped mostly outside chromosome\n')
+            pos = where(outside, last - 1, pos)
+        idx = searchsorted(sites, pos, side='right')
+        if (idx >= len(sites)).any():
+            raise Exception('Position(s) outside chromosome %s\n' % crm)
+        return pos, sites[maximum(idx - 1, 0)], sites[idx]
+
+
+def _genome_key(enzyme_name, genome_seq, samples=1000, size=64):
+    """
+    Fingerprint of a genome and an enzyme, using chromosome names, lengths,
+    and a sample of small pieces of sequence (regularly spaced), or the
+    identifier of the cached genome.
+    """
+    key = md5(RESTRICTION_ENZYMES[enzyme_name])
+    if hasattr(genome_seq, 'checksum'):
+        # genome loaded from cache, already identified (see
+        # pytadbit.parsers.genome_parser.CachedGenome)
+        key.update(genome_seq.checksum)
+        return key.hexdigest()[:16]
+    for crm in genome_seq:
+        seq = genome_seq[crm]
+        key.update('%s\t%d\n' % (crm, len(seq)))
+        step = max(1, len(seq) / samples)
+        for beg in xrange(0, len(seq), step):
+            key.update(seq[beg:beg + size])
+    return key.hexdigest()[:16]
+
+
+def get_re_fragments(enzyme_name, genome_seq, cache_dir=None, verbose=False):
+    """
+    Index of RE sites of a given enzyme in a genome (see
+    :class:`REFragments`). If a cache directory is given, the index is
+    stored in it, and loaded instead of being computed for the next calls
+    with the same genome and enzyme.
+
+    :param enzyme_name: name of the enzyme to map (upper/lower case are
+       important)
+    :param genome_seq: a dictionary containing the genomic sequence by
+       chromosome
+    :param None cache_dir: path to the directory where to store indexes
+
+    :returns: a :class:`REFragments` object
+    """
+    if not cache_dir:
+        return REFragments.from_genome(enzyme_name, genome_seq, verbose=verbose)
+    fnam = path.join(cache_dir, 're_sites_%s_%s.npz' % (
+        enzyme_name.lower(), _genome_key(enzyme_name, genome_seq)))
+    if path.exists(fnam):
+        if verbose:
+            print 'Loading RE sites from %s' % fnam
+        return REFragments.load(fnam)
+    frags = REFragments.from_genome(enzyme_name, genome_seq, verbose=verbose)
+    mkdir(cache_dir)
+    frags.save(fnam)
+    return frags
+
+
 def complementary(seq):
     trs = dict([(nt1, nt2) for nt1, nt2 in zip('ATGCN', 'TACGN')])
     return ''.join([trs[s] for s in seq[::-1]])
@@ -161,6 +332,34 @@ def religated(r_enz):
     site = site.replace('|', '')
     return beg + site[min(len(beg), len(end)) : max(len(beg), len(end))] + end
 
+def ligation_sites(r_enzs):
+    """
+    returns the sequences resulting from the religation of the digested and
+    repaired ends of one or several enzymes (including ligations between ends
+    of different enzymes).
+
+    :param r_enzs: name of the enzyme, or list of names
+
+    :returns: a list of tuples (ligation site, RE site before the ligation,
+       RE site after the ligation), ligations of ends of the same enzyme first
+    """
+    if isinstance(r_enzs, str):
+        r_enzs = [r_enzs]
+    ends = []
+    for r_enz in r_enzs:
+        site = RESTRICTION_ENZYMES[r_enz]
+        beg, end = site.split('|')
+        site = site.replace('|', '')
+        ends.append((site[:max(len(beg), len(end))],
+                     site[min(len(beg), len(end)):], site))
+    ligations = [(left + right, site, site) for left, right, site in ends]
+    for left, _, site1 in ends:
+        for _, right, site2 in ends:
+            if site1 != site2 and not (left + right) in [
+                    l for l, _, _ in ligations]:
+                ligations.append((left + right, site1, site2))
+    return ligations
+
 
 class RE_dict(dict):
     def __getitem__(self, i):
@@ -5,11 +5,14 @@ convert a bunch of fasta files, or a single multi fasta file, into a dictionary
 """
 
 from collections import OrderedDict
-from pytadbit.utils.file_handling import magic_open
+from pytadbit.utils.file_handling import magic_open, mkdir
+from hashlib import md5
+from mmap import mmap, ACCESS_READ
+import os
 import re
 
 def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
-                verbose=True):
+                verbose=True, cache_dir=None):
     """
     Parse a list of fasta files, or just one fasta.
 
@@ -20,15 +23,29 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
        are passed, then chromosome names will be inferred from fasta headers
     :param None chr_filter: use only chromosome in the input list
     :param None chr_regexp: use only chromosome matching
+    :param None cache_dir: directory where to store the parsed genome. The
+       next calls with the same files (unless modified) and filters load it
+       from there (see :class:`CachedGenome`) instead of parsing the FASTA.
 
     :returns: a sorted dictionary with chromosome names as keys, and sequences
-       as values (sequence in upper case)
+       as values (sequence in upper case). If cache_dir is used, a
+       :class:`CachedGenome` object
     """
     if isinstance(f_names, str):
         f_names = [f_names]
     if isinstance(chr_names, str):
         chr_names = [chr_names]
 
+    if cache_dir:
+        cache_fnam = os.path.join(cache_dir, 'genome_%s' % _cache_key(
+            f_names, chr_names, chr_filter, chr_regexp))
+        if os.path.exists(cache_fnam + '.idx'):
+            if verbose:
+                print 'Loading parsed genome from %s' % cache_fnam
+            return CachedGenome(cache_fnam)
+        if chr_names:
+            chr_names = chr_names[:] # names are consumed while parsing
+
     if chr_filter:
         bad_chrom = lambda x: not x in chr_filter
     else:
@@ -88,4 +105,125 @@ def parse_fasta(f_names, chr_names=None, chr_filter=None, chr_regexp=None,
             genome_seq[header] = ''.join([l.rstrip() for l in fhandler]).upper()
         if 'UNWANTED' in genome_seq:
             del(genome_seq['UNWANTED'])
+    if cache_dir:
+        mkdir(cache_dir)
+        write_genome_cache(genome_seq, cache_fnam)
+        return CachedGenome(cache_fnam, genome_seq)
     return genome_seq
+
+
+def chromosome_lengths(genome_seq):
+    """
+    :param genome_seq: a dictionary with chromosome names as keys, and
+       sequences as values, or a :class:`CachedGenome` (sequences are not
+       loaded in this case)
+
+    :returns: a sorted dictionary with chromosome names as keys, and their
+       lengths as values
+    """
+    if isinstance(genome_seq, CachedGenome):
+        return genome_seq.lengths.copy()
+    return OrderedDict((crm, len(genome_seq[crm])) for crm in genome_seq)
+
+
+def _cache_key(f_names, chr_names, chr_filter, chr_regexp):
+    """
+    Identifier of a parsed genome, from the path, modification time and size
+    of the FASTA files, and the filters used.
+    """
+    key = md5()
+    for fnam in f_names:
+        stat = os.stat(fnam)
+        key.update('%s\t%d\t%d\n' % (os.path.abspath(fnam), stat.st_mtime,
+                                       stat.st_size))
+    key.update(repr((chr_names, chr_filter, chr_regexp)))
+    return key.hexdigest()[:16]
+
+
+def write_genome_cache(genome_seq, fnam):
+    """
+    Writes a genome to disk, as a file with all sequences concatenated
+    (fnam.seq), and an index with chromosome names, offsets and lengths
+    (fnam.idx). The index is written last, under a temporary name.
+
+    :param genome_seq: a dictionary with chromosome names as keys, and
+       sequences as values
+    :param fnam: path to the output files (without extension)
+    """
+    out = open(fnam + '.seq', 'wb')
+    index = []
+    offset = 0
+    for crm in genome_seq:
+        out.write(genome_seq[crm])
+        index.append('%s\t%d\t%d\n' % (crm, offset, len(genome_seq[crm])))
+        offset += len(genome_seq[crm])
+    out.close()
+    tmp_fnam = '%s_%d.idx.tmp' % (fnam, os.getpid())
+    out = open(tmp_fnam, 'w')
+    out.writelines(index)
+    out.close()
+    os.rename(tmp_fnam, fnam + '.idx')
+
+
+class CachedGenome(object):
+    """
+    Dictionary-like access to a genome written by
+    :func:`write_genome_cache`. The file of sequences is memory-mapped, and
+    only the chromosomes accessed are loaded (and kept) in memory.
+
+    :param fnam: path to the cached genome (without extension)
+    :param None sequences: dictionary of sequences already loaded
+    """
+    def __init__(self, fnam, sequences=None):
+        self.fnam = fnam
+        self.checksum = os.path.basename(fnam)
+        self.offsets = OrderedDict()
+        self.lengths = OrderedDict()
+        for line in open(fnam + '.idx'):
+            crm, offset, length = line.rsplit('\t', 2)
+            self.offsets[crm] = int(offset)
+            self.lengths[crm] = int(length)
+        self._seqs = dict(sequences or {})
+        self._mmap = None
+
+    def __getitem__(self, crm):
+        try:
+            return self._seqs[crm]
+        except KeyError:
+            offset = self.offsets[crm]
+        if self._mmap is None:
+            fhandler = open(self.fnam + '.seq', 'rb')
+            # empty files can not be mapped
+            self._mmap = (mmap(fhandler.fileno(), 0, access=ACCESS_READ)
+                          if os.fstat(fhandler.fileno()).st_size else '')
+            fhandler.close()
+        self._seqs[crm] = self._mmap[offset:offset + self.lengths[crm]]
+        return self._seqs[crm]
+
+    def __contains__(self, crm):
+        return crm in self.lengths
+
+    def __iter__(self):
+        return iter(self.lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def keys(self):
+        return self.lengths.keys()
+
+    def values(self):
+        return [self[crm] for crm in self]
+
+    def items(self):
+        return [(crm, self[crm]) for crm in self]
+
+    def iteritems(self):
+        for crm in self:
+            yield crm, self[crm]
+
+    def __getstate__(self):
+        # memory maps can not be pickled
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        return state
@@ -7,7 +7,16 @@ from warnings                import warn
 from math                    import sqrt, isnan
 from pytadbit.parsers.gzopen import gzopen
 from collections             import OrderedDict
-from pytadbit                import HiC_data
+from itertools               import islice, izip
+from sys                     import stdout
+from numpy                   import array, unique, concatenate, cumsum, where
+from numpy                   import int64, fromstring, arange, repeat, ones
+from scipy.sparse            import csr_matrix
+from pytadbit.parsers.pairs_parser import is_binary_pairs, read_pairs_header
+from pytadbit.parsers.pairs_parser import iter_pairs_blocks
+from pytadbit.parsers.pairs_parser import parse_region, region_offsets
+from pytadbit.utils.file_handling  import chunk_lines
+from pytadbit                import HiC_data, SparseHiC_data
 
 HIC_DATA = True
 
@@ -192,11 +201,15 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     :param 1 resolution: resolution of the matrix
     :param True hic: if False, TADbit assumes that files contains normalized
        data
+    :param False sparse: if True, returns
+       :class:`pytadbit.hic_data.SparseHiC_data` objects, storing interactions
+       in NumPy arrays instead of in a dictionary (much lower memory usage)
     :returns: the corresponding matrix concatenated into a huge list, also
        returns number or rows
 
     """
     one = kwargs.get('one', True)
+    hic_class = SparseHiC_data if kwargs.get('sparse', False) else HiC_data
     global HIC_DATA
     HIC_DATA = hic
     parser = parser or autoreader
@@ -211,7 +224,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             thing.close()
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
+            matrices.append(hic_class([(i, matrix[i]) for i in xrange(size**2)
                                       if matrix[i]], size, dict_sec=sections,
                                      chromosomes=chromosomes,
                                      resolution=resolution,
@@ -227,7 +240,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             sections = dict([(h, i) for i, h in enumerate(header)])
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
+            matrices.append(hic_class([(i, matrix[i]) for i in xrange(size**2)
                                       if matrix[i]], size, dict_sec=sections,
                                      chromosomes=chromosomes, masked=masked,
                                      resolution=resolution,
@@ -238,7 +251,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                 size = len(thing)
             else:
                 raise Exception('must be list of lists, all with same length.')
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
+            matrices.append(hic_class([(i, matrix[i]) for i in xrange(size**2)
                                       if matrix[i]], size))
         elif isinstance(thing, tuple):
             # case we know what we are doing and passing directly list of tuples
@@ -247,7 +260,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             if int(siz) != siz:
                 raise AttributeError('ERROR: matrix should be square.\n')
             size = int(siz)
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
+            matrices.append(hic_class([(i, matrix[i]) for i in xrange(size**2)
                                       if matrix[i]], size))
         elif 'matrix' in str(type(thing)):
             try:
@@ -258,7 +271,7 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                 size = row
             except Exception as exc:
                 print 'Error found:', exc
-            matrices.append(HiC_data([(i, matrix[i]) for i in xrange(size**2)
+            matrices.append(hic_class([(i, matrix[i]) for i in xrange(size**2)
                                       if matrix[i]], size))
         else:
             raise Exception('Unable to read this file or whatever it is :)')
@@ -269,47 +282,274 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
 
 def load_hic_data_from_reads(fnam, resolution, **kwargs):
     """
-    :param fnam: tsv file with reads1 and reads2
+    :param fnam: tsv file with reads1 and reads2 (can also be in binary
+       format, see :mod:`pytadbit.parsers.pairs_parser`)
     :param resolution: the resolution of the experiment (size of a bin in
-       bases)
+       bases). If a list of resolutions is given, the file is read only once
+       and a dictionary with one Hi-C data object per resolution is returned
+       (resolutions multiple of the smallest one are obtained by summing the
+       bins of the matrix at the smallest resolution)
     :param genome_seq: a dictionary containing the genomic sequence by
        chromosome
     :param False get_sections: for very very high resolution, when the column
        index does not fit in memory
+    :param False sparse: if True, returns a
+       :class:`pytadbit.hic_data.SparseHiC_data` object, storing interactions
+       in NumPy arrays instead of in a dictionary (much lower memory usage,
+       recommended for whole genome maps at high resolution)
+    :param 1000000 chunk: number of reads parsed and binned at once
+    :param False verbose: report progress
+    :param None region: chromosome name, or genomic region (e.g.
+       'chr3:1-20M'), to load only the interactions within this region. The
+       Hi-C data object contains only the chromosome of the region. If the
+       file is indexed (see :func:`pytadbit.parsers.pairs_parser.index_pairs`)
+       only the part of the file with the region is read
+    """
+    get_sections = kwargs.get('get_sections', True)
+    if isinstance(resolution, (list, tuple)):
+        resolutions = sorted(set(resolution))
+    else:
+        resolutions = [resolution]
+    # resolutions that can not be obtained from the finest one are binned
+    # in the same pass
+    finest = resolutions[0]
+    to_bin = [reso for reso in resolutions if reso % finest]
+    header, crm_lengths = read_pairs_header(fnam)
+    beg = end = None
+    region = kwargs.get('region', None)
+    if region:
+        crm, start, stop = parse_region(region, crm_lengths)
+        beg, end = region_offsets(fnam, crm_lengths.keys().index(crm),
+                                  start, stop)
+    if is_binary_pairs(fnam):
+        blocks = ((b['crm1'], b['pos1'], b['crm2'], b['pos2'])
+                  for b in iter_pairs_blocks(fnam, columns=('crm1', 'pos1',
+                                                            'crm2', 'pos2'),
+                                             beg=beg, end=end))
+    else:
+        blocks = _text_blocks(chunk_lines(fnam, beg or len(header), end),
+                              crm_lengths, chunk=kwargs.get('chunk', 1000000))
+    if region:
+        blocks = _region_blocks(blocks, crm_lengths.keys().index(crm),
+                                start, stop)
+        crm_lengths = OrderedDict([(crm, crm_lengths[crm])])
+    matrices = _bin_reads(blocks, crm_lengths, [finest] + to_bin,
+                          get_sections=get_sections,
+                          verbose=kwargs.get('verbose', False))
+    hic_datas = {}
+    for reso in resolutions:
+        if not reso in matrices:
+            matrices[reso] = _coarsen_matrix(matrices[finest], crm_lengths,
+                                             finest, reso, get_sections)
+        hic_datas[reso] = _matrix_to_hic_data(
+            matrices[reso], crm_lengths, reso, get_sections=get_sections,
+            sparse=kwargs.get('sparse', False))
+    if isinstance(resolution, (list, tuple)):
+        return hic_datas
+    return hic_datas[resolution]
+
+def _coarsen_matrix(matrix, crm_lengths, resolution, new_resolution,
+                    get_sections=True):
+    """
+    Sums the bins of a matrix of interaction counts binned at a given
+    resolution, into the bins of a larger resolution (must be a multiple of
+    the first one).
+
+    :returns: a sparse matrix (CSR) of interaction counts
+    """
+    factor = new_resolution / resolution
+    lengths = array(crm_lengths.values(), dtype=int64)
+    nbins = lengths / resolution + 1
+    new_nbins = lengths / new_resolution + 1
+    size = int(new_nbins.sum())
+    bins = arange(matrix.shape[0], dtype=int64)
+    if get_sections:
+        offsets = concatenate(([0], cumsum(nbins)[:-1]))
+        new_offsets = concatenate(([0], cumsum(new_nbins)[:-1]))
+        crm = repeat(arange(len(nbins)), nbins)
+        new_bins = new_offsets[crm] + (bins - offsets[crm]) / factor
+    else:
+        new_bins = bins / factor
+    inside = new_bins < size
+    summer = csr_matrix((ones(inside.sum(), dtype=int64),
+                         (bins[inside], new_bins[inside])),
+                        shape=(matrix.shape[0], size))
+    new_matrix = (summer.T * matrix * summer).tocsr()
+    new_matrix.sort_indices()
+    return new_matrix
+
+def _bin_positions(crm, pos, resolution, nbins, offsets, get_sections):
+    """
+    convert arrays of chromosome indexes and positions into bin indexes
+    """
+    bins = pos / resolution
+    if not get_sections:
+        return bins
+    known = crm >= 0
+    crm = where(known, crm, 0)
+    return where(known & (bins < nbins[crm]), offsets[crm] + bins, bins)
+
+def _text_blocks(lines, crm_lengths, chunk=1000000):
+    """
+    Parses reads by chunks of lines.
+
+    :param lines: iterator over the lines of the reads (without header)
+    :param crm_lengths: dictionary of chromosome lengths
+    :param 1000000 chunk: number of reads parsed at once
+
+    :returns: for each chunk, arrays of chromosome indexes (-1 if not in
+       crm_lengths) and positions of both read ends
+    """
+    crm_idx = dict((c, i) for i, c in enumerate(crm_lengths))
+    while True:
+        block = list(islice(lines, chunk))
+        if not block:
+            break
+        cols = _split_columns(block)
+        del block
+        crms = []
+        for col in (1, 7):
+            names, inv = unique(cols[col], return_inverse=True)
+            crms.append(array([crm_idx.get(n, -1) for n in names],
+                              dtype=int64)[inv])
+        pos1 = fromstring(' '.join(cols[2]), dtype=int64, sep=' ')
+        pos2 = fromstring(' '.join(cols[8]), dtype=int64, sep=' ')
+        del cols
+        yield crms[0], pos1, crms[1], pos2
+
+def _region_blocks(blocks, crm, beg, end):
+    """
+    Keeps the reads with both read ends in a genomic region.
+
+    :param blocks: iterator over blocks of reads (see :func:`_text_blocks`)
+    :param crm: index of the chromosome of the region
+    :param beg: first position of the region
+    :param end: last position of the region
+
+    :returns: for each block, arrays of chromosome indexes (0, the region
+       being the only chromosome) and positions of both read ends
+    """
+    for crm1, pos1, crm2, pos2 in blocks:
+        keep = ((crm1 == crm) & (crm2 == crm) & (pos1 >= beg) &
+                (pos1 <= end) & (pos2 >= beg) & (pos2 <= end))
+        pos1 = pos1[keep]
+        pos2 = pos2[keep]
+        yield crm1[keep] * 0, pos1, crm2[keep] * 0, pos2
+
+def _bin_reads(blocks, crm_lengths, resolutions, get_sections=True,
+               verbose=False):
+    """
+    Counts reads into the bins of each of the given resolutions, in a single
+    pass over the reads.
+
+    :param blocks: iterator over blocks of reads, each block being a tuple of
+       arrays of chromosome indexes and positions of both read ends
+    :param crm_lengths: dictionary of chromosome lengths
+    :param resolutions: list of resolutions
+
+    :returns: a dictionary with, for each resolution, a sparse matrix (CSR)
+       of interaction counts (symmetric)
+    """
+    lengths = array(crm_lengths.values(), dtype=int64)
+    tables = {}
+    for reso in resolutions:
+        nbins = lengths / reso + 1
+        offsets = concatenate(([0], cumsum(nbins)[:-1]))
+        tables[reso] = {'nbins'  : nbins,
+                        'offsets': offsets,
+                        'size'   : int(nbins.sum()),
+                        'matrix' : None,
+                        'pending': [],
+                        'npending': 0}
+    nreads = 0
+    if verbose:
+        print 'Binning reads:'
+    for crm1, pos1, crm2, pos2 in blocks:
+        nreads += len(pos1)
+        for reso in resolutions:
+            tbl = tables[reso]
+            size = tbl['size']
+            bin1 = _bin_positions(crm1, pos1, reso, tbl['nbins'],
+                                  tbl['offsets'], get_sections)
+            bin2 = _bin_positions(crm2, pos2, reso, tbl['nbins'],
+                                  tbl['offsets'], get_sections)
+            valid = (bin1 < size) & (bin2 < size)
+            bin1 = bin1[valid]
+            bin2 = bin2[valid]
+            # each read counts in both halves of the matrix
+            cells, counts = unique(concatenate((bin1 * size + bin2,
+                                                bin2 * size + bin1)),
+                                   return_counts=True)
+            tbl['pending'].append((cells, counts))
+            tbl['npending'] += len(cells)
+            # merge with the accumulated matrix only once pending cells are
+            # as many as the ones already accumulated
+            if tbl['matrix'] is None or tbl['npending'] > tbl['matrix'].nnz:
+                _merge_pending(tbl)
+        if verbose:
+            stdout.write('\r    %d reads binned' % nreads)
+            stdout.flush()
+    if verbose:
+        stdout.write('\n')
+    matrices = {}
+    for reso in resolutions:
+        _merge_pending(tables[reso])
+        matrices[reso] = tables[reso]['matrix']
+    return matrices
+
+def _split_columns(block, ncols=13):
+    """
+    split a list of lines into a list of columns
+    """
+    fields = ''.join(block).replace('\n', '\t').split('\t')
+    # faster, but only if all lines have the same number of columns
+    if len(fields) == ncols * len(block) + 1:
+        return [fields[col::ncols] for col in xrange(ncols)]
+    return zip(*[line.split('\t', 9) for line in block])
+
+def _merge_pending(tbl):
+    """
+    sums pending cells to the accumulated matrix
+    """
+    size = tbl['size']
+    if tbl['pending']:
+        cells, counts = zip(*tbl['pending'])
+        rows, cols = divmod(concatenate(cells), size)
+        counts = concatenate(counts)
+    else:
+        rows = cols = counts = array([], dtype=int64)
+    matrix = csr_matrix((counts, (rows, cols)), shape=(size, size))
+    if tbl['matrix'] is not None:
+        matrix = matrix + tbl['matrix']
+    matrix.sort_indices()
+    tbl['matrix'] = matrix
+    tbl['pending'] = []
+    tbl['npending'] = 0
+
+def _matrix_to_hic_data(matrix, crm_lengths, resolution, get_sections=True,
+                        sparse=False):
+    """
+    Builds a HiC_data (or SparseHiC_data) object from a sparse matrix of
+    interaction counts.
     """
     sections = []
     genome_seq = OrderedDict()
-    fhandler = open(fnam)
-    line = fhandler.next()
     size = 0
-    while line.startswith('#'):
-        if line.startswith('# CRM '):
-            crm, clen = line[6:].split()
-            genome_seq[crm] = int(clen) / resolution + 1
-            size += genome_seq[crm]
-        line = fhandler.next()
-    section_sizes = {}
-    if kwargs.get('get_sections', True):
+    for crm in crm_lengths:
+        genome_seq[crm] = crm_lengths[crm] / resolution + 1
+        size += genome_seq[crm]
+    if get_sections:
         for crm in genome_seq:
-            len_crm = genome_seq[crm]
-            section_sizes[(crm,)] = len_crm
-            sections.extend([(crm, i) for i in xrange(len_crm)])
+            sections.extend([(crm, i) for i in xrange(genome_seq[crm])])
     dict_sec = dict([(j, i) for i, j in enumerate(sections)])
-    imx = HiC_data((), size, genome_seq, dict_sec, resolution=resolution)
-    try:
-        while True:
-            _, cr1, ps1, _, _, _, _, cr2, ps2, _ = line.split('\t', 9)
-            try:
-                ps1 = dict_sec[(cr1, int(ps1) / resolution)]
-                ps2 = dict_sec[(cr2, int(ps2) / resolution)]
-            except KeyError:
-                ps1 = int(ps1) / resolution
-                ps2 = int(ps2) / resolution
-            imx[ps1, ps2] += 1
-            imx[ps2, ps1] += 1
-            line = fhandler.next()
-    except StopIteration:
-        pass
+    if sparse:
+        imx = SparseHiC_data(matrix, size, genome_seq, dict_sec,
+                             resolution=resolution)
+    else:
+        matrix = matrix.tocoo()
+        imx = HiC_data(izip((matrix.row.astype(int64) * size +
+                             matrix.col).tolist(),
+                            matrix.data.tolist()),
+                       size, genome_seq, dict_sec, resolution=resolution)
     imx.symmetricized = True
     return imx
-
@@ -2,14 +2,36 @@
 22 may 2015
 """
 
-from pytadbit.utils.file_handling         import magic_open
-from bisect                               import bisect_right as bisect
-from pytadbit.mapping.restriction_enzymes import map_re_sites
+from pytadbit.utils.file_handling         import magic_open, file_chunks
+from pytadbit.utils.file_handling         import chunk_lines, bgzip_file
+from pytadbit.mapping.restriction_enzymes import get_re_fragments
+from pytadbit.parsers.genome_parser       import chromosome_lengths
+from numpy                                import array, zeros, ones, int64
+from numpy                                import unique, fromstring
 from warnings                             import warn
-from sys                                  import stdout
-from subprocess                           import Popen
+from heapq                                import merge
+from itertools                            import islice
+from sys                                  import getsizeof
+import multiprocessing as mu
+import gzip
 import os
 
+# approximate memory used by each read stored in the list to be sorted
+# (pointer in the list plus sorting key)
+_READ_OVERHEAD = 8 + 80
+
+# maximum number of temporary files opened at once during the merge sort
+MAX_OPEN_FILES = 256
+
+# minimum size (in bytes) of the chunks of input files parsed in parallel
+_MIN_CHUNK_SIZE = 65536
+
+# number of lines of map files parsed at once
+_READ_BATCH = 10000
+
+# RE fragments used by the parsing processes (see _init_parser)
+_FRAGS = None
+
 def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
               genome_seq=None, re_name=None, verbose=False, clean=True,
               **kwargs):
@@ -37,8 +59,24 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     :param re_name: name of the restriction enzyme used
     :param True clean: remove temporary files required for indentification of
        multiple-contacts
-    :param False compress: compress (gzip) input map files. This is done in the
-       background while next MAP files are parsed, or while files are sorted.
+    :param False compress: compress (BGZF, see
+       :class:`pytadbit.utils.file_handling.BgzfWriter`) input map files,
+       using nthreads threads. This is done in the background while next MAP
+       files are parsed, or while files are sorted.
+    :param 1000 max_memory: maximum memory (in Mb) used to store reads before
+       sorting them into intermediate files. All intermediate files are then
+       merged in a single pass.
+    :param False compress_tmp: compress (gzip, fast) intermediate files, to
+       reduce disk usage.
+    :param 1 nthreads: number of processes used to parse and sort reads. Each
+       input file (or chunk of uncompressed input file) is parsed by a
+       different process, and both read ends are merged in parallel. Output
+       is identical to the one obtained with a single process.
+    :param None cache_dir: directory where to store the index of RE sites of
+       the genome (see
+       :func:`pytadbit.mapping.restriction_enzymes.get_re_fragments`), in
+       order to avoid searching them again the next time the same genome and
+       enzyme are used.
     """
     # not nice, dirty fix in order to allow this function to only parse
     # one SAM file
@@ -51,11 +89,11 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
     if (f_names2 and not out_file2) or (not f_names2 and out_file2):
         raise Exception('ERROR: out_file2 AND f_names2 needed\n')
 
-    frag_chunk = kwargs.get('frag_chunk', 100000)
     if verbose:
         print 'Searching and mapping RE sites to the reference genome'
-    frags = map_re_sites(re_name, genome_seq, frag_chunk=frag_chunk,
-                         verbose=verbose)
+    frags = get_re_fragments(re_name, genome_seq,
+                             cache_dir=kwargs.get('cache_dir', None),
+                             verbose=verbose)
 
     if isinstance(f_names1, str):
         f_names1 = [f_names1]
@@ -68,25 +106,23 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
         fnames = (f_names1,)
         outfiles = (out_file1, )
 
-    # max number of reads per intermediate files for sorting
-    max_size = 1000000
-    
+    # max memory (in Mb) used to store reads before sorting them into an
+    # intermediate file
+    max_memory = kwargs.get('max_memory', 1000) * 1024 * 1024
+    compress_tmp = kwargs.get('compress_tmp', False)
+    nthreads = kwargs.get('nthreads', 1)
+
+    # list of chunks of input files to be parsed, and sorted into temporary
+    # files, each chunk by one job
     windows = {}
     multis  = {}
-    procs   = []
+    jobs    = {}
     for read in range(len(fnames)):
-        if verbose:
-            print 'Loading read' + str(read + 1)
         windows[read] = {}
+        jobs[read] = []
         num = 0
-        # iteration over reads
-        nfile = 0
-        tmp_files = []
-        reads     = []
         for fnam in fnames[read]:
-            try:
-                fhandler = magic_open(fnam)
-            except IOError:
+            if not os.path.exists(fnam):
                 warn('WARNING: file "%s" not found\n' % fnam)
                 continue
             # get the iteration number of the iterative mapping
@@ -94,170 +130,365 @@ def parse_map(f_names1, f_names2=None, out_file1=None, out_file2=None,
                 num = int(fnam.split('.')[-1].split(':')[0])
             except:
                 num += 1
-            # set read counter
-            if verbose:
-                print 'loading file: %s' % (fnam)
-            # start parsing
-            read_count = 0
-            try:
-                while not False:
-                    for _ in xrange(max_size):
-                        try:
-                            reads.append(read_read(fhandler.next(), frags,
-                                                   frag_chunk))
-                        except KeyError:
-                            # Chromosome not in hash
-                            continue
-                        read_count += 1
-                    nfile += 1
-                    write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            except StopIteration:
-                fhandler.close()
-                nfile += 1
-                write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
-            windows[read][num] = read_count
-            if kwargs.get('compress', False) and fnam.endswith('.map'):
-                print 'compressing input MAP file'
-                procs.append(Popen(['gzip', fnam]))
-        nfile += 1
-        write_reads_to_file(reads, outfiles[read], tmp_files, nfile)
+            for beg, end in file_chunks(fnam, nthreads,
+                                        min_size=_MIN_CHUNK_SIZE):
+                jobs[read].append((fnam, num, beg, end))
 
-        # we have now sorted temporary files
-        # we do merge sort for eah pair
+    if nthreads > 1:
+        pool = mu.Pool(nthreads, initializer=_init_parser,
+                       initargs=(frags,))
+        # the memory budget is shared by all the workers
+        max_memory /= nthreads
+    else:
+        _init_parser(frags)
+    # parse and sort reads
+    results = {}
+    procs   = []
+    for read in range(len(fnames)):
         if verbose:
-            stdout.write('Merge sort')
-            stdout.flush()
-        while len(tmp_files) > 1:
-            file1 = tmp_files.pop(0)
-            try:
-                file2 = tmp_files.pop(0)
-            except IndexError:
-                break
+            print 'Loading read' + str(read + 1)
+        for njob, (fnam, num, beg, end) in enumerate(jobs[read]):
+            args = (fnam, beg, end, outfiles[read], njob, max_memory,
+                    compress_tmp)
+            if nthreads > 1:
+                results[read, njob] = pool.apply_async(_parse_chunk, args=args)
+            else:
+                if verbose:
+                    print 'loading file: %s' % (fnam)
+                results[read, njob] = _parse_chunk(*args)
+    # collect the sorted temporary files of each read end, grouped by input
+    # file
+    for read in range(len(fnames)):
+        tmp_files = []
+        for njob, (fnam, num, beg, end) in enumerate(jobs[read]):
+            if nthreads > 1:
+                results[read, njob] = results[read, njob].get()
+            chunk_files, read_count = results[read, njob]
+            if beg == 0:
+                tmp_files.append([])
+            tmp_files[-1].extend(chunk_files)
+            if beg == 0:
+                windows[read][num] = 0
+            windows[read][num] += read_count
+            if (end is None and kwargs.get('compress', False)
+                and fnam.endswith('.map')):
+                print 'compressing input MAP file'
+                procs.append(mu.Process(target=bgzip_file, args=(fnam, ),
+                                        kwargs={'nthreads': nthreads}))
+                procs[-1].start()
+        results[read] = _merge_order(tmp_files)
+
+    # we have now sorted temporary files, they are all merged at once
+    crm_lengths = chromosome_lengths(genome_seq).items()
+    for read in range(len(fnames)):
+        args = (results[read], outfiles[read], crm_lengths, windows[read],
+                compress_tmp, clean)
+        if nthreads > 1:
+            multis[read] = pool.apply_async(_write_parsed_reads, args=args)
+        else:
             if verbose:
-                stdout.write('.')
-            stdout.flush()
-            nfile += 1
-            tmp_files.append(merge_sort(file1, file2, outfiles[read], nfile))
-        if verbose:
-            stdout.write('\n')
-        tmp_name = tmp_files[0]
-        
+                print 'Merge sort (%d temporary files)' % len(results[read])
+                print 'Getting Multiple contacts'
+            multis[read] = _write_parsed_reads(*args)
+    if nthreads > 1:
+        pool.close()
         if verbose:
-            print 'Getting Multiple contacts'
-        reads_fh = open(outfiles[read], 'w')
-        ## Also pipe file header
-        # chromosome sizes (in order)
-        reads_fh.write('# Chromosome lengths (order matters):\n')
-        for crm in genome_seq:
-            reads_fh.write('# CRM %s\t%d\n' % (crm, len(genome_seq[crm])))
-        reads_fh.write('# Mapped\treads count by iteration\n')
-        for size in windows[read]:
-            reads_fh.write('# MAPPED %d %d\n' % (size, windows[read][size]))
-
-        ## Multicontacts
-        tmp_reads_fh = open(tmp_name)
-        try:
-            read_line = tmp_reads_fh.next()
-        except StopIteration:
-            raise StopIteration('ERROR!\n Nothing parsed, check input files and'
-                                ' chromosome names (in genome.fasta and SAM/MAP'
-                                ' files).')
-        prev_head = read_line.split('\t', 1)[0]
-        prev_head = prev_head.split('~' , 1)[0]
-        prev_read = read_line
-        multis[read] = 0
-        for read_line in tmp_reads_fh:
-            head = read_line.split('\t', 1)[0]
-            head = head.split('~' , 1)[0]
-            if head == prev_head:
-                multis[read] += 1
-                prev_read =  prev_read.strip() + '|||' + read_line
-            else:
-                reads_fh.write(prev_read)
-                prev_read = read_line
-            prev_head = head
-        reads_fh.write(prev_read)
-        reads_fh.close()
-        if clean:
-            os.system('rm -rf ' + tmp_name)
+            print 'Merge sort and getting Multiple contacts'
+        for read in multis:
+            multis[read] = multis[read].get()
+        pool.join()
     # wait for compression to finish
     for p in procs:
-        p.communicate()
+        p.join()
     return windows, multis
 
-def write_reads_to_file(reads, outfiles, tmp_files, nfile):
-    if not reads: # can be...
+def _init_parser(frags):
+    """
+    Stores the RE fragments in the (worker) process, in order to avoid
+    passing them to each job.
+    """
+    global _FRAGS
+    _FRAGS = frags
+
+def _chunk_lines(fnam, beg, end):
+    """
+    Iterates over the lines starting in a given byte range of a file.
+    """
+    if end is None and not beg:
+        fhandler = magic_open(fnam)
+        for line in fhandler:
+            yield line
+        fhandler.close()
         return
+    for line in chunk_lines(fnam, beg, end):
+        yield line
+
+def _parse_chunk(fnam, beg, end, outfile, njob, max_memory,
+                 compress_tmp=False):
+    """
+    Parses the reads of a chunk of a map file, sorting them into temporary
+    files.
+
+    :returns: the list of temporary files, and the number of reads parsed
+    """
+    reads      = []
+    tmp_files  = []
+    read_count = 0
+    size       = 0
+    nfile      = 0
+    lines      = _chunk_lines(fnam, beg, end)
+    while True:
+        batch = list(islice(lines, _READ_BATCH))
+        if not batch:
+            break
+        batch = read_reads(batch, _FRAGS)
+        reads.extend(batch)
+        read_count += len(batch)
+        size += sum(getsizeof(r) for r in batch) + _READ_OVERHEAD * len(batch)
+        if size > max_memory:
+            nfile += 1
+            write_reads_to_file(reads, outfile, tmp_files, nfile,
+                                compress=compress_tmp, njob=njob)
+            size = 0
+    nfile += 1
+    write_reads_to_file(reads, outfile, tmp_files, nfile,
+                        compress=compress_tmp, njob=njob)
+    return tmp_files, read_count
+
+def _write_parsed_reads(tmp_files, outfile, crm_lengths, windows,
+                        compress_tmp=False, clean=True):
+    """
+    Merges sorted temporary files into the final file of parsed reads,
+    grouping reads with multiple contacts.
+
+    :returns: the number of multiple contacts
+    """
+    tmp_files = merge_sort(tmp_files, outfile, compress=compress_tmp)
+    reads_fh = open(outfile, 'w')
+    ## Also pipe file header
+    # chromosome sizes (in order)
+    reads_fh.write('# Chromosome lengths (order matters):\n')
+    for crm, crm_len in crm_lengths:
+        reads_fh.write('# CRM %s\t%d\n' % (crm, crm_len))
+    reads_fh.write('# Mapped\treads count by iteration\n')
+    for size in windows:
+        reads_fh.write('# MAPPED %d %d\n' % (size, windows[size]))
+
+    ## Multicontacts
+    tmp_reads_fh = _merged_reads(tmp_files)
+    try:
+        read_line = tmp_reads_fh.next()
+    except StopIteration:
+        raise StopIteration('ERROR!\n Nothing parsed, check input files and'
+                            ' chromosome names (in genome.fasta and SAM/MAP'
+                            ' files).')
+    prev_head = read_line.split('\t', 1)[0]
+    prev_head = prev_head.split('~' , 1)[0]
+    prev_read = read_line
+    multis = 0
+    for read_line in tmp_reads_fh:
+        head = read_line.split('\t', 1)[0]
+        head = head.split('~' , 1)[0]
+        if head == prev_head:
+            multis += 1
+            prev_read =  prev_read.strip() + '|||' + read_line
+        else:
+            reads_fh.write(prev_read)
+            prev_read = read_line
+        prev_head = head
+    reads_fh.write(prev_read)
+    reads_fh.close()
+    if clean:
+        for tmp_name in tmp_files:
+            os.remove(tmp_name)
+    return multis
+
+def _tmp_name(outfiles, prefix, compress=False):
     tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_%03d_' % nfile) + outfiles.split('/')[-1]])
+                            [prefix + outfiles.split('/')[-1]])
     tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
+    return tmp_name + ('.gz' if compress else '')
+
+def _open_tmp(tmp_name, mode='r'):
+    if tmp_name.endswith('.gz'):
+        # lowest compression level, we want speed
+        return gzip.open(tmp_name, mode + 'b', 1)
+    return open(tmp_name, mode)
+
+def _read_key(read):
+    return read.split('\t', 1)[0].split('~', 1)[0]
+
+def write_reads_to_file(reads, outfiles, tmp_files, nfile, compress=False,
+                        njob=0):
+    """
+    Sorts reads by read ID and writes them to a new temporary file.
+
+    :param reads: list of reads (as strings), will be emptied
+    :param outfiles: path to the final output file, used to name the
+       temporary file
+    :param tmp_files: list of temporary files where to append the new one
+    :param nfile: number of the temporary file
+    :param False compress: gzip the temporary file
+    :param 0 njob: number of the parsing job (temporary files of each job are
+       named differently)
+    """
+    if not reads: # can be...
+        return
+    tmp_name = _tmp_name(outfiles, 'tmp_%03d_%03d_' % (njob, nfile), compress)
     tmp_files.append(tmp_name)
-    out = open(tmp_name, 'w')
-    out.write(''.join(sorted(reads, key=lambda x: x.split('\t', 1)[0].split('~')[0])))
+    out = _open_tmp(tmp_name, 'w')
+    reads.sort(key=_read_key)
+    out.writelines(reads)
     out.close()
     del(reads[:]) # empty list
 
-def merge_sort(file1, file2, outfiles, nfile):
-    tmp_name = os.path.join(*outfiles.split('/')[:-1] +
-                            [('tmp_merged_%03d_' % nfile) + outfiles.split('/')[-1]])
-    tmp_name = ('/' * outfiles.startswith('/')) + tmp_name
-    tmp_file = open(tmp_name, 'w')
-    fh1 = open(file1)
-    fh2 = open(file2)
-    greater = lambda x, y: x.split('\t', 1)[0].split('~')[0] > y.split('\t', 1)[0].split('~')[0]
-    read1 = fh1.next()
-    read2 = fh2.next()
-    while True:
-        if greater(read2, read1):
-            tmp_file.write(read1)
-            try:
-                read1 = fh1.next()
-            except StopIteration:
-                tmp_file.write(read2)
-                break
-        else:
-            tmp_file.write(read2)
-            try:
-                read2 = fh2.next()
-            except StopIteration:
-                tmp_file.write(read1)
-                break
-    for read in fh1:
-        tmp_file.write(read)
-    for read in fh2:
-        tmp_file.write(read)
-    fh1.close()
-    fh2.close()
-    tmp_file.close()
-    os.system('rm -f ' + file1)
-    os.system('rm -f ' + file2)
-    return tmp_name
-
-def read_read(r, frags, frag_chunk):
-    name, seq, _, _, ali = r.split('\t')[:5]
-    crm, strand, pos = ali.split(':')[:3]
-    positive = strand == '+'
-    len_seq  = len(seq)
-    if positive:
-        pos = int(pos)
-    else:
-        pos = int(pos) + len_seq - 1 # remove 1 because all inclusive
-    frag_piece = frags[crm][pos / frag_chunk]
-    idx = bisect(frag_piece, pos)
-    try:
-        next_re = frag_piece[idx]
-    except IndexError:
-        # case where part of the read is mapped outside chromosome
-        count = 0
-        while idx >= len(frag_piece) and count < len_seq:
-            pos -= 1
-            count += 1
-            frag_piece = frags[crm][pos / frag_chunk]
-            idx = bisect(frag_piece, pos)
-        if count >= len_seq:
-            raise Exception('Read mapped mostly outside ' +
-                            'chromosome\n')
-        next_re = frag_piece[idx]
-    prev_re = frag_piece[idx - 1 if idx else 0]
-    return ('%s\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
-        name, crm, pos, positive, len_seq, prev_re, next_re))
+def _merge_order(groups):
+    """
+    Orders the groups of sorted temporary files (one group per input file) as
+    they used to be merged two by two, in order to keep the same order
+    between reads with the same ID (i.e. the different contacts of a read):
+    when merging two files, reads of the second file went first.
+
+    :param groups: list of lists of temporary files, the files of each group
+       being in the order of the reads in the input file
+
+    :returns: the list of temporary files, reads with the same ID being
+       expected first from the first files
+    """
+    queue = [group for group in groups if group]
+    while len(queue) > 1:
+        group1 = queue.pop(0)
+        group2 = queue.pop(0)
+        queue.append(group2 + group1)
+    return queue[0] if queue else []
+
+def _merged_reads(tmp_files):
+    """
+    Iterates over the reads of a list of sorted temporary files, in a single
+    pass (k-way merge using a heap). Order between reads with the same ID is
+    preserved (reads of the first file go first).
+    """
+    def decorate(fhandler, num):
+        for read in fhandler:
+            yield _read_key(read), num, read
+    fhandlers = [_open_tmp(tmp_name) for tmp_name in tmp_files]
+    for _, _, read in merge(*[decorate(fh, num)
+                              for num, fh in enumerate(fhandlers)]):
+        yield read
+    for fhandler in fhandlers:
+        fhandler.close()
+
+def merge_sort(tmp_files, outfiles, compress=False, max_files=MAX_OPEN_FILES):
+    """
+    Makes sure that the number of sorted temporary files to be merged does
+    not exceed a given maximum number of simultaneously opened files, merging
+    them by groups of consecutive files if needed (the order of the files is
+    kept). All the reads are merged at once in the usual case (a single pass
+    over the reads).
+
+    :param tmp_files: list of paths to sorted temporary files (are removed
+       when merged)
+    :param outfiles: path to the final output file, used to name the
+       temporary files
+    :param False compress: gzip the temporary files
+    :param MAX_OPEN_FILES max_files: maximum number of files opened at the
+       same time
+
+    :returns: the list of sorted temporary files to be merged
+    """
+    tmp_files = list(tmp_files)
+    nfile = 0
+    while len(tmp_files) > max_files:
+        merged = []
+        for beg in xrange(0, len(tmp_files), max_files):
+            group = tmp_files[beg:beg + max_files]
+            if len(group) == 1:
+                merged.extend(group)
+                continue
+            nfile += 1
+            tmp_name = _tmp_name(outfiles, 'tmp_merged_%03d_' % nfile,
+                                 compress)
+            out = _open_tmp(tmp_name, 'w')
+            out.writelines(_merged_reads(group))
+            out.close()
+            for fnam in group:
+                os.remove(fnam)
+            merged.append(tmp_name)
+        tmp_files = merged
+    return tmp_files
+
+def read_reads(lines, frags):
+    """
+    Parses a batch of lines of a map file, searching the RE fragment of each
+    read (reads mapped on chromosomes not present in the index are skipped).
+
+    :param lines: list of lines of a map file
+    :param frags: an index of RE sites, as returned by
+       :func:`pytadbit.mapping.restriction_enzymes.get_re_fragments`
+
+    :returns: the list of parsed reads (as lines of text)
+    """
+    if not lines:
+        return []
+    nreads = len(lines)
+    names, seqs, crms, strands, poss = _map_columns(lines)
+    len_seq  = array(map(len, seqs), dtype=int64)
+    positive = array(strands) == '+'
+    pos      = fromstring(' '.join(poss), sep=' ', dtype=int64)
+    # remove 1 because all inclusive
+    pos[~positive] += len_seq[~positive] - 1
+    prev_re = zeros(nreads, dtype=int64)
+    next_re = zeros(nreads, dtype=int64)
+    keep    = ones(nreads, dtype=bool)
+    crm_names, crm_idx = unique(crms, return_inverse=True)
+    for num, crm in enumerate(crm_names):
+        idx = (crm_idx == num).nonzero()[0]
+        if not crm in frags:
+            # Chromosome not in hash
+            keep[idx] = False
+            continue
+        pos[idx], prev_re[idx], next_re[idx] = frags.fragments(
+            crm, pos[idx], len_seq[idx])
+    # all the reads are written at once in a single string, which is then
+    # split (much faster than formatting each read)
+    flat = [None] * (7 * nreads)
+    flat[0::7] = names
+    flat[1::7] = crms
+    for num, col in enumerate((pos, positive.view('int8'), len_seq, prev_re),
+                              2):
+        flat[num::7] = map(str, col.tolist())
+    flat[6::7] = [v + '\n\0' for v in map(str, next_re.tolist())]
+    reads = '\t'.join(flat)[:-1].split('\0\t')
+    if not keep.all():
+        reads = [read for read, k in zip(reads, keep) if k]
+    return reads
+
+def _map_columns(lines):
+    """
+    Columns of a batch of lines of a map file needed to parse the reads:
+    read IDs, sequences, and chromosome, strand and position of the first
+    alignment.
+    """
+    nreads = len(lines)
+    fields = ''.join(lines).replace('\n', '\t').split('\t')
+    if len(fields) == 5 * nreads + 1:
+        alis = ':'.join(fields[4::5]).split(':')
+        if len(alis) == 4 * nreads:
+            return (fields[0::5][:nreads], fields[1::5][:nreads],
+                    alis[0::4], alis[1::4], alis[2::4])
+    # lines with extra columns, or reads with several alignments
+    fields = [r.split('\t', 5) for r in lines]
+    alis   = [f[4].split(':', 3) for f in fields]
+    return ([f[0] for f in fields], [f[1] for f in fields],
+            [a[0] for a in alis], [a[1] for a in alis], [a[2] for a in alis])
+
+def read_read(r, frags):
+    """
+    Parses one line of a map file (see :func:`read_reads`).
+
+    :raises KeyError: if the chromosome is not in the index of RE sites
+    """
+    reads = read_reads([r], frags)
+    if not reads:
+        raise KeyError(r.split('\t')[4].split(':')[0])
+    return reads[0]
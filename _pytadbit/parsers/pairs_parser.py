@@ -0,0 +1,443 @@
+"""
+17 Oct 2026
+
+Binary format for pairs of reads (files generated by
+:func:`pytadbit.mapping.get_intersection` and the filtering)
+
+Reads are stored by blocks, each block containing one array per column
+(chromosome names are stored as small integers, their index in the header).
+The file starts with the same header as the text (tab-separated) format:
+
+::
+
+  MAGIC | header length (uint32) | header text
+  block: number of reads (uint32) | size of IDs (uint32)
+         | IDs ('\\n' joined, zlib compressed) | one array per column (see
+         COLUMNS)
+
+Files sorted by position of the first read-end (as generated by
+:func:`pytadbit.mapping.get_intersection`, and kept sorted by the filtering)
+can be indexed (see :func:`index_pairs`), in order to read only the reads of a
+genomic region (see :func:`region_offsets`).
+"""
+
+from collections                  import OrderedDict
+from os                           import path
+from re                           import match
+from struct                       import pack, unpack, calcsize
+from numpy                        import array, frombuffer, fromstring, unique
+from numpy                        import int64, searchsorted, savez
+from numpy                        import dtype as np_dtype
+from numpy                        import load as load_npz
+from zlib                         import compress, decompress
+from pytadbit.utils.file_handling import line_start
+
+MAGIC = 'TADBITPAIRS\x01'
+
+# columns of the text format (except the read ID), and their binary type
+COLUMNS = (('crm1'   , 'int16' ),
+           ('pos1'   , 'uint32'),
+           ('strand1', 'int8'  ),
+           ('nts1'   , 'uint16'),
+           ('rs1'    , 'uint32'),
+           ('re1'    , 'uint32'),
+           ('crm2'   , 'int16' ),
+           ('pos2'   , 'uint32'),
+           ('strand2', 'int8'  ),
+           ('nts2'   , 'uint16'),
+           ('rs2'    , 'uint32'),
+           ('re2'    , 'uint32'))
+
+_BLOCK_HEAD = '<II'
+
+
+def is_binary_pairs(fnam):
+    """
+    :param fnam: path to a file of pairs of reads
+
+    :returns: True if the file is in binary format
+    """
+    fhandler = open(fnam, 'rb')
+    start = fhandler.read(len(MAGIC))
+    fhandler.close()
+    return start == MAGIC
+
+
+def _header_crm_lengths(header):
+    crm_lengths = OrderedDict()
+    for line in header.split('\n'):
+        if line.startswith('# CRM '):
+            crm, clen = line[6:].split()
+            crm_lengths[crm] = int(clen)
+    return crm_lengths
+
+
+def _read_binary_header(fhandler):
+    if fhandler.read(len(MAGIC)) != MAGIC:
+        raise IOError('ERROR: %s not in binary pairs format\n' % (
+            fhandler.name))
+    size = unpack('<I', fhandler.read(4))[0]
+    return fhandler.read(size)
+
+
+def read_pairs_header(fnam):
+    """
+    Reads the header of a file of pairs of reads, in text or binary format.
+
+    :param fnam: path to a file of pairs of reads
+
+    :returns: the header (as text, lines starting with '#') and a dictionary
+       with chromosome lengths
+    """
+    if is_binary_pairs(fnam):
+        fhandler = open(fnam, 'rb')
+        header = _read_binary_header(fhandler)
+        fhandler.close()
+    else:
+        header = ''
+        for line in open(fnam):
+            if not line.startswith('#'):
+                break
+            header += line
+    return header, _header_crm_lengths(header)
+
+
+def iter_pairs_blocks(fnam, columns=None, ids=False, beg=None, end=None):
+    """
+    Iterates over the blocks of reads of a file in binary format.
+
+    :param fnam: path to a file of pairs of reads in binary format
+    :param None columns: list of columns to load (by default all, see
+       COLUMNS); columns not loaded are skipped
+    :param False ids: also load read IDs (as a list)
+    :param None beg: byte position of the first block to read (by default
+       the first block of the file, see :func:`region_offsets`)
+    :param None end: byte position where to stop reading (by default the end
+       of the file)
+
+    :returns: for each block a dictionary with, as keys, the column names
+       ('id' for read IDs), and as values NumPy arrays (of type int64 for
+       positions)
+    """
+    columns = set(columns or [c for c, _ in COLUMNS])
+    fhandler = open(fnam, 'rb')
+    _read_binary_header(fhandler)
+    if beg is not None:
+        fhandler.seek(beg)
+    head_size = calcsize(_BLOCK_HEAD)
+    while end is None or fhandler.tell() < end:
+        head = fhandler.read(head_size)
+        if not head:
+            break
+        nreads, ids_size = unpack(_BLOCK_HEAD, head)
+        block = {}
+        if ids:
+            block['id'] = decompress(fhandler.read(ids_size)).split('\n')
+        else:
+            fhandler.seek(ids_size, 1)
+        for col, typ in COLUMNS:
+            size = nreads * np_dtype(typ).itemsize
+            if col in columns:
+                block[col] = frombuffer(fhandler.read(size),
+                                        dtype=typ).astype(int64)
+            else:
+                fhandler.seek(size, 1)
+        yield block
+    fhandler.close()
+
+
+def iter_pairs_lines(fnam):
+    """
+    Iterates over the reads of a file of pairs of reads, in text or binary
+    format, as lines of text (without header).
+
+    :param fnam: path to a file of pairs of reads
+    """
+    if not is_binary_pairs(fnam):
+        for line in open(fnam):
+            if not line.startswith('#'):
+                yield line
+        return
+    crms = _header_crm_lengths(read_pairs_header(fnam)[0]).keys()
+    for block in iter_pairs_blocks(fnam, ids=True):
+        cols = [block[c].tolist() for c, _ in COLUMNS]
+        for i, read in enumerate(block['id']):
+            yield '%s\t%s\t%d\t%d\t%d\t%d\t%d\t%s\t%d\t%d\t%d\t%d\t%d\n' % (
+                read, crms[cols[0][i]], cols[1][i], cols[2][i], cols[3][i],
+                cols[4][i], cols[5][i], crms[cols[6][i]], cols[7][i],
+                cols[8][i], cols[9][i], cols[10][i], cols[11][i])
+
+
+def lines_to_block(lines, crm_idx, columns=None):
+    """
+    Parses lines of text into a block of columns.
+
+    :param lines: list of lines of pairs of reads in text format
+    :param crm_idx: dictionary with chromosome names as keys and their index
+       as values
+    :param None columns: list of columns to parse (by default all, see
+       COLUMNS)
+
+    :returns: a dictionary with, as keys, the column names ('id' for read
+       IDs), and as values NumPy arrays
+    """
+    columns = set(columns or [c for c, _ in COLUMNS])
+    fields = ''.join(lines).replace('\n', '\t').split('\t')
+    if len(fields) != 13 * len(lines) + 1:
+        raise IOError('ERROR: expecting 13 columns per read\n')
+    block = {'id': fields[0:-1:13]}
+    for num, (col, _) in enumerate(COLUMNS, 1):
+        if col not in columns:
+            continue
+        values = fields[num:-1:13]
+        if col.startswith('crm'):
+            names, inv = unique(values, return_inverse=True)
+            block[col] = array([crm_idx[n] for n in names], dtype=int64)[inv]
+        else:
+            block[col] = fromstring(' '.join(values), dtype=int64, sep=' ')
+    return block
+
+
+class PairsWriter(object):
+    """
+    Writes pairs of reads in binary format.
+
+    :param fnam: path to the output file
+    :param header: header of the file (lines starting with '#'), should
+       contain chromosome names and lengths (lines starting with '# CRM ')
+    :param 1000000 chunk: number of reads per block when writing lines
+    """
+    def __init__(self, fnam, header, chunk=1000000):
+        self.crm_idx = dict((c, i) for i, c in enumerate(
+            _header_crm_lengths(header)))
+        self.chunk = chunk
+        self.nreads = 0
+        self._lines = []
+        self._out = open(fnam, 'wb')
+        self._out.write(MAGIC)
+        self._out.write(pack('<I', len(header)))
+        self._out.write(header)
+
+    def write_block(self, block, keep=None):
+        """
+        :param block: dictionary of columns, as returned by
+           :func:`iter_pairs_blocks` (with IDs)
+        :param None keep: boolean array with the reads to be written
+        """
+        ids = block['id']
+        if keep is not None:
+            ids = [read for read, k in zip(ids, keep) if k]
+        if not ids:
+            return
+        nreads = len(ids)
+        ids = compress('\n'.join(ids), 1)
+        self._out.write(pack(_BLOCK_HEAD, nreads, len(ids)))
+        self._out.write(ids)
+        for col, typ in COLUMNS:
+            values = block[col] if keep is None else block[col][keep]
+            self._out.write(values.astype(typ).tostring())
+        self.nreads += nreads
+
+    def write_line(self, line):
+        """
+        :param line: a read in text format
+        """
+        self._lines.append(line)
+        if len(self._lines) >= self.chunk:
+            self._flush()
+
+    def _flush(self):
+        if self._lines:
+            self.write_block(lines_to_block(self._lines, self.crm_idx))
+            self._lines = []
+
+    def close(self):
+        self._flush()
+        self._out.close()
+
+
+def tsv_to_pairs(fnam, outfile, chunk=1000000):
+    """
+    Converts a file of pairs of reads from text (tab-separated) to binary
+    format.
+
+    :param fnam: path to the input file in text format
+    :param outfile: path to the output file
+    :param 1000000 chunk: number of reads per block
+
+    :returns: number of reads converted
+    """
+    header, _ = read_pairs_header(fnam)
+    out = PairsWriter(outfile, header, chunk=chunk)
+    for line in iter_pairs_lines(fnam):
+        out.write_line(line)
+    out.close()
+    # reads are in the same order
+    if load_pairs_index(fnam) is not None:
+        index_pairs(outfile)
+    return out.nreads
+
+
+def _index_text(fnam, step):
+    header, crm_lengths = read_pairs_header(fnam)
+    crm_idx = dict((c, i) for i, c in enumerate(crm_lengths))
+    size = path.getsize(fnam)
+    offsets = []
+    keys = []
+    fhandler = open(fnam)
+    pos = len(header)
+    while pos < size:
+        pos = line_start(fhandler, pos)
+        line = fhandler.readline()
+        if not line:
+            break
+        _, crm, beg, _ = line.split('\t', 3)
+        offsets.append(pos)
+        keys.append((crm_idx[crm] << 32) | int(beg))
+        pos += step
+    fhandler.close()
+    return offsets, keys
+
+
+def _index_binary(fnam):
+    fhandler = open(fnam, 'rb')
+    _read_binary_header(fhandler)
+    head_size = calcsize(_BLOCK_HEAD)
+    # size of a read, the first two columns being crm1 (int16) and pos1
+    # (uint32)
+    read_size = sum(np_dtype(typ).itemsize for _, typ in COLUMNS)
+    offsets = []
+    keys = []
+    while True:
+        offset = fhandler.tell()
+        head = fhandler.read(head_size)
+        if not head:
+            break
+        nreads, ids_size = unpack(_BLOCK_HEAD, head)
+        fhandler.seek(ids_size, 1)
+        crm = unpack('<h', fhandler.read(2))[0]
+        fhandler.seek(2 * nreads - 2, 1)
+        beg = unpack('<I', fhandler.read(4))[0]
+        fhandler.seek((read_size - 2) * nreads - 4, 1)
+        offsets.append(offset)
+        keys.append((crm << 32) | beg)
+    fhandler.close()
+    return offsets, keys
+
+
+def index_pairs(fnam, step=1048576):
+    """
+    Builds the block index of a file of pairs of reads sorted by position
+    of the first read-end (chromosomes in the order of the header). The
+    index is stored next to the file (with the extension .idx).
+
+    :param fnam: path to a sorted file of pairs of reads, in text or binary
+       format
+    :param 1048576 step: distance (in bytes) between indexed reads, for files
+       in text format (files in binary format are indexed at each block)
+
+    :returns: the byte positions of the indexed reads (or blocks), and their
+       keys (chromosome index << 32 | position)
+    """
+    if is_binary_pairs(fnam):
+        offsets, keys = _index_binary(fnam)
+    else:
+        offsets, keys = _index_text(fnam, step)
+    offsets = array(offsets, dtype=int64)
+    keys = array(keys, dtype=int64)
+    out = open(fnam + '.idx', 'wb')
+    savez(out, offsets=offsets, keys=keys)
+    out.close()
+    return offsets, keys
+
+
+def load_pairs_index(fnam):
+    """
+    :param fnam: path to a file of pairs of reads
+
+    :returns: the index of the file (see :func:`index_pairs`), None if the
+       file is not indexed or if the index is older than the file
+    """
+    idx_fnam = fnam + '.idx'
+    if (not path.exists(idx_fnam) or
+        path.getmtime(idx_fnam) < path.getmtime(fnam)):
+        return None
+    data = load_npz(idx_fnam)
+    index = data['offsets'], data['keys']
+    data.close()
+    return index
+
+
+def parse_region(region, crm_lengths):
+    """
+    :param region: chromosome name, or genomic region as 'chr3:1-20M'
+       (positions are 1-based, and can be followed by K, M or G)
+    :param crm_lengths: dictionary with chromosome lengths
+
+    :returns: the chromosome name, and first and last positions of the region
+    """
+    if region in crm_lengths:
+        return region, 1, crm_lengths[region]
+    crm, _, coords = region.rpartition(':')
+    if crm not in crm_lengths:
+        raise ValueError('ERROR: chromosome %s not found\n' % (
+            crm or region))
+    positions = []
+    for val in coords.replace(',', '').split('-'):
+        found = match(r'^(\d+(?:\.\d*)?)([KMG]?)B?$', val.strip().upper())
+        if not found:
+            raise ValueError('ERROR: wrong genomic region %s\n' % region)
+        positions.append(int(float(found.group(1)) *
+                             {'': 1, 'K': 1e3, 'M': 1e6,
+                              'G': 1e9}[found.group(2)] + 0.5))
+    if len(positions) != 2 or positions[0] > positions[1]:
+        raise ValueError('ERROR: wrong genomic region %s\n' % region)
+    return crm, positions[0], positions[1]
+
+
+def region_offsets(fnam, crm, beg, end):
+    """
+    Byte range of an indexed file (see :func:`index_pairs`) containing the
+    reads with the first read-end in a given genomic region.
+
+    :param fnam: path to a file of pairs of reads
+    :param crm: index of the chromosome (order in the header)
+    :param beg: first position of the region
+    :param end: last position of the region
+
+    :returns: the byte positions where to start and to stop reading (None
+       for the end of the file). Both are None if the file is not indexed
+    """
+    index = load_pairs_index(fnam)
+    if index is None or not len(index[0]):
+        return None, None
+    offsets, keys = index
+    # reads with the same key as the beginning of the region may be in the
+    # previous block
+    first = max(searchsorted(keys, (crm << 32) | beg, side='left') - 1, 0)
+    last = searchsorted(keys, (crm << 32) | end, side='right')
+    return (int(offsets[first]),
+            int(offsets[last]) if last < len(offsets) else None)
+
+
+def pairs_to_tsv(fnam, outfile):
+    """
+    Converts a file of pairs of reads from binary to text (tab-separated)
+    format.
+
+    :param fnam: path to the input file in binary format
+    :param outfile: path to the output file
+
+    :returns: number of reads converted
+    """
+    out = open(outfile, 'w')
+    out.write(read_pairs_header(fnam)[0])
+    nreads = 0
+    for line in iter_pairs_lines(fnam):
+        out.write(line)
+        nreads += 1
+    out.close()
+    # reads are in the same order
+    if load_pairs_index(fnam) is not None:
+        index_pairs(outfile)
+    return nreads
@@ -4,15 +4,18 @@
 
 from os                           import path, listdir
 from pytadbit.parsers.hic_parser  import read_matrix
-from pytadbit.tadbit_py           import _tadbit_wrapper
+from pytadbit.hic_data            import SparseHiC_data
+from pytadbit.tadbit_py           import _tadbit_wrapper, _tadbit_band_wrapper
 from math                         import isnan, sqrt
 from scipy.sparse.csr             import csr_matrix
-from scipy.stats                  import mannwhitneyu
+from scipy.stats                  import mannwhitneyu, norm
+import multiprocessing as mu
 import numpy as np
 
 
 def tadbit(x, remove=None, n_cpus=1, verbose=True,
-           max_tad_size="max", no_heuristic=0, use_topdom=False, topdom_window=5, **kwargs):
+           max_tad_size="max", no_heuristic=0, use_topdom=False, topdom_window=5,
+           banded=False, window=None, overlap=None, **kwargs):
     """
     The TADbit algorithm works on raw chromosome interaction count data.
     The normalization is neither necessary nor recommended,
@@ -44,6 +47,24 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     :param False no_heuristic: whether to use or not some heuristics
     :param False use_topdom: whether to use TopDom algorithm to find tads or not (http://www.ncbi.nlm.nih.gov/pubmed/26704975, http://zhoulab.usc.edu/TopDom/)
     :param 5 topdom_window: the window size for topdom algorithm
+    :param False banded: only pass to the segmentation the interactions closer
+       than max_tad_size bins (once removed columns), as a contiguous array
+       of diagonals, the other ones being only summed by column. Memory usage
+       grows with size * max_tad_size instead of size * size. TADs are then
+       strictly limited to max_tad_size bins (without band, merged TADs may
+       be longer): results are the same as without band when the TADs found
+       without band are not longer than max_tad_size
+    :param None window: if given, the matrix is split in overlapping windows of
+       this number of bins (several times max_tad_size), segmented
+       independently, in parallel (using n_cpus). Breakpoints found in the
+       overlap of two windows are stitched (see :func:`stitch_windows`). The
+       number of TADs (ntads) can not be set in this case, and the number of
+       TADs of each window being optimized independently, results get closer
+       to the ones of the whole matrix with larger windows
+    :param None overlap: number of bins shared by consecutive windows (by
+       default max_tad_size, at least max_tad_size and smaller than the
+       window, so that a TAD cut by the end of a window is found whole in the
+       next one)
     :param False get_weights: either to return the weights corresponding to the
        Hi-C count (weights are a normalization dependent of the count of each
        columns)
@@ -52,27 +73,56 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
        boundaries, and the corresponding list associated log likelihoods.
        If no weights are given, it may also return calculated weights.
     """
+    if window and 'ntads' in kwargs:
+        raise Exception('ERROR: number of TADs can not be set when '
+                        'segmenting by windows\n')
     nums = [hic_data for hic_data in read_matrix(x, one=False)]
+
+    if window and not use_topdom and len(nums[0]) > window:
+        return _windowed_tadbit(nums, window, overlap=overlap, remove=remove,
+                                n_cpus=n_cpus, verbose=verbose,
+                                max_tad_size=max_tad_size,
+                                no_heuristic=no_heuristic, banded=banded,
+                                **kwargs)
     
     if not use_topdom:
         size = len(nums[0])
-        nums = [num.get_as_tuple() for num in nums]
         if not remove:
             # if not given just remove columns with zero in diagonal
-            remove = tuple([0 if nums[0][i*size+i] else 1 for i in xrange(size)])
+            remove = tuple([0 if nums[0][i, i] else 1 for i in xrange(size)])
         n_cpus = n_cpus if n_cpus != 'max' else 0
         max_tad_size = size if max_tad_size in ["max", "auto"] else max_tad_size
-        _, nbks, passages, _, _, bkpts = \
-           _tadbit_wrapper(nums,             # list of lists of Hi-C data
-                           remove,           # list of columns marking filtered
-                           size,             # size of one row/column
-                           len(nums),        # number of matrices
-                           n_cpus,           # number of threads
-                           int(verbose),     # verbose 0/1
-                           max_tad_size,     # max_tad_size
-                           kwargs.get('ntads', -1) + 1,
-                           int(no_heuristic),# heuristic 0/1
-                           )
+        if banded:
+            width = min(max_tad_size, size - 1)
+            nums, offs = zip(*[num.get_as_band(width, remove) for num in nums])
+            _, nbks, passages, _, _, bkpts = \
+               _tadbit_band_wrapper(list(nums),  # list of arrays of diagonals
+                                    list(offs),  # list of arrays out of them
+                                    remove,      # list of columns marking filtered
+                                    size,        # size of one row/column
+                                    width,       # number of diagonals
+                                    len(nums),   # number of matrices
+                                    n_cpus,      # number of threads
+                                    int(verbose),# verbose 0/1
+                                    max_tad_size,# max_tad_size
+                                    kwargs.get('ntads', -1) + 1,
+                                    int(no_heuristic),# heuristic 0/1
+                                    )
+            # only the breakpoints of the optimal segmentation are returned
+            nbks = 0
+        else:
+            nums = [num.get_as_tuple() for num in nums]
+            _, nbks, passages, _, _, bkpts = \
+               _tadbit_wrapper(nums,             # list of lists of Hi-C data
+                               remove,           # list of columns marking filtered
+                               size,             # size of one row/column
+                               len(nums),        # number of matrices
+                               n_cpus,           # number of threads
+                               int(verbose),     # verbose 0/1
+                               max_tad_size,     # max_tad_size
+                               kwargs.get('ntads', -1) + 1,
+                               int(no_heuristic),# heuristic 0/1
+                               )
     
         breaks = [i for i in xrange(size) if bkpts[i + nbks * size] == 1]
         scores = [p for p in passages if p > 0]
@@ -85,7 +135,7 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     else:
         result = {'start': [], 'end'  : [], 'score': [], 'tag': []}
     
-        ret = TopDom(nums[0],window_size=5)
+        ret = TopDom(nums[0], window_size=topdom_window)
         
         
         for key in sorted(ret):
@@ -104,6 +154,122 @@ def tadbit(x, remove=None, n_cpus=1, verbose=True,
     return result
 
 
+def split_windows(size, window, overlap):
+    """
+    :param size: number of rows/columns of the matrix
+    :param window: number of bins of each window
+    :param overlap: minimum number of bins shared by consecutive windows
+
+    :returns: the list of (start, end) positions of the windows (end excluded),
+       the last one being placed at the end of the matrix
+    """
+    windows = []
+    beg = 0
+    while True:
+        end = min(beg + window, size)
+        windows.append((beg, end))
+        if end == size:
+            return windows
+        beg = max(0, min(end - overlap, size - window))
+
+
+def stitch_windows(windows, breaks):
+    """
+    Merges the breakpoints found in overlapping windows. In the overlap of two
+    windows, breakpoints are taken from the first window before the cut, and
+    from the second one after. The cut is the breakpoint found by both windows
+    that is the closest to the middle of the overlap (the middle itself if
+    none).
+
+    :param windows: list of (start, end) positions of the windows
+    :param breaks: list (one per window) of dictionaries with, as keys, the
+       breakpoints found in the window (in matrix referential) and, as values,
+       their scores
+
+    :returns: a dictionary of breakpoints and scores
+    """
+    stitched = {}
+    cut = 0
+    for num, (beg, _) in enumerate(windows):
+        if num:
+            lo = max(beg, cut)
+            hi = windows[num - 1][1]
+            mid = (lo + hi) / 2
+            common = [b for b in breaks[num] if lo <= b < hi and b in stitched]
+            cut = min(common, key=lambda b: (abs(b - mid), b)) if common else mid
+            stitched = dict((b, s) for b, s in stitched.iteritems() if b < cut)
+        stitched.update((b, s) for b, s in breaks[num].iteritems() if b >= cut)
+    return stitched
+
+
+def _tadbit_window(args):
+    """
+    Runs :func:`tadbit` on a window of the matrices.
+
+    :returns: a dictionary of breakpoints (last bin of each TAD but the last
+       one) and scores, in window referential
+    """
+    matrices, remove, kwargs = args
+    # too few rows/columns to be segmented
+    if len(remove) - sum(remove) < 6:
+        return {}
+    result = tadbit(matrices, remove=remove, n_cpus=1, verbose=False, **kwargs)
+    return dict(zip(result['end'][:-1], result['score'][:-1]))
+
+
+def _windowed_tadbit(nums, window, overlap=None, remove=None, n_cpus=1,
+                     verbose=True, max_tad_size="max", **kwargs):
+    """
+    Same as :func:`tadbit` segmenting overlapping windows of the matrices.
+    """
+    size = len(nums[0])
+    if max_tad_size in ["max", "auto"] or max_tad_size > window:
+        max_tad_size = window
+    if overlap is None:
+        overlap = max_tad_size
+    if not max_tad_size <= overlap < window:
+        raise Exception('ERROR: overlap should be at least max_tad_size, and '
+                        'smaller than the window\n')
+    if not remove:
+        # if not given just remove columns with zero in diagonal
+        remove = tuple([0 if nums[0][i, i] else 1 for i in xrange(size)])
+    windows = split_windows(size, window, overlap)
+    csrs = [num.get_hic_data_as_csr() for num in nums]
+    kwargs['max_tad_size'] = max_tad_size
+    jobs = []
+    for beg, end in windows:
+        matrices = []
+        for csr in csrs:
+            sub = csr[beg:end, beg:end]
+            # counts are expected as integers
+            sub.data = np.rint(sub.data)
+            matrices.append(SparseHiC_data(sub.astype(int), end - beg))
+        jobs.append((matrices, remove[beg:end], kwargs))
+    if verbose:
+        print '  segmenting %d windows of %d bins' % (len(windows), window)
+    n_cpus = mu.cpu_count() if n_cpus in ('max', 0) else n_cpus
+    if n_cpus > 1 and len(jobs) > 1:
+        pool = mu.Pool(min(n_cpus, len(jobs)))
+        results = pool.map(_tadbit_window, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_tadbit_window, jobs)
+    del(jobs)
+    # breakpoints in matrix referential
+    results = [dict((b + beg, sc) for b, sc in res.iteritems())
+               for (beg, _), res in zip(windows, results)]
+    stitched = stitch_windows(windows, results)
+    breaks = sorted(stitched)
+
+    result = {'start': [], 'end'  : [], 'score': []}
+    for brk in xrange(len(breaks)+1):
+        result['start'].append((breaks[brk-1] + 1) if brk > 0 else 0)
+        result['end'  ].append(breaks[brk] if brk < len(breaks) else size - 1)
+        result['score'].append(stitched[breaks[brk]] if brk < len(breaks) else None)
+    return result
+
+
 def batch_tadbit(directory, parser=None, **kwargs):
     """
     Use tadbit on directories of data files.
@@ -189,78 +355,202 @@ def TopDom(hic_data,window_size,statFilter=True):
         of computed p-values by Wilcox Ranksum Test as score while boundaries and gaps have a score of zero.
     """
     n_bins = len(hic_data)
-    mean_cf = np.zeros(n_bins)
     pvalue = np.ones(n_bins)
-      
+
     local_ext = np.ones(n_bins)*(-0.5)
-    
-    #Step 1
+
+    # upper (and lower) diagonals of the matrix, up to 2 * window_size
     csr_mat = hic_data.get_hic_data_as_csr()
-    for i in xrange(n_bins):
-        diamond_mean = Get_Diamond_Matrix_Mean(data=csr_mat, i=i, size=window_size)
-        mean_cf[i] = diamond_mean
-        
+    upper, lower = Get_Band(csr_mat, 2 * window_size)
+
+    #Step 1
+    mean_cf = Get_Diamond_Means(upper, window_size)
+
     #Step 2
     gap_idx = Which_Gap_Region(data=csr_mat)
     proc_regions = Which_process_region(rmv_idx=gap_idx, n_bins=n_bins, min_size=3)
-    
+
     for key in proc_regions:
-        
+
         start = proc_regions[key]["start"]
         end = proc_regions[key]["end"]
-    
-        #print "Process Regions from " + str(start) + " to " + str(end)
-      
+
         local_ext[start:end+1] = Detect_Local_Extreme(x=mean_cf[start:end+1])
-    
+
     if statFilter:
         #Step 3
-        lil_mat = csr_mat.todense()
-        for k in range(1,(2*window_size)):
-        
-          mat_row = []
-          mat_column = []
-          my_range = range((n_bins*k), (n_bins*n_bins), 1+n_bins)
-          mat_values = np.empty(len(my_range))
-          col_arr = 0 
-          for j in my_range:
-              mat_row.append(int(round(j/lil_mat.shape[0])))
-              mat_column.append(j%lil_mat.shape[0])
-              mat_values[col_arr] = lil_mat[int(round(j/lil_mat.shape[0])),j%lil_mat.shape[0]]
-              col_arr = col_arr + 1
-          
-          scale_values = scale(mat_values)
-          
-          for i in xrange(len(mat_row)):
-              lil_mat[mat_column[i],mat_row[i]] = scale_values[i]
-              
-        
+        # upper diagonals are replaced by the z-scores of the lower ones
+        for k in xrange(1, 2 * window_size):
+            upper[k, :n_bins - k] = scale(lower[k, :n_bins - k])
+
         for key in proc_regions:
             start = proc_regions[key]['start']
             end = proc_regions[key]['end']
-            
-            pvalue[start:end] = Get_Pvalue(data=lil_mat[start:end+1, start:end+1], size=window_size, scale=1)
-    
-        for i in xrange(len(local_ext)):
-            if local_ext[i] == -1 and pvalue[i] < 0.05:
-                local_ext[i] = -2
-        local_ext[local_ext==-1] = 0
-        local_ext[local_ext==-2] = -1  
-        
+
+            pvalue[start:end] = Get_Pvalue_Band(upper[:, start:end + 1],
+                                                size=window_size)
+
+        local_ext[(local_ext == -1) & ~(pvalue < 0.05)] = 0
+
         pvalue_cut=0.05
     else:
         pvalue = None
         pvalue_cut=None
-        
+
     domains = Convert_Bin_To_Domain_TMP(n_bins=n_bins,
-                                  signal_idx=np.where(local_ext==-1)[0], 
-                                  gap_idx=np.where(local_ext==-0.5)[0], 
-                                  pvalues=pvalue, 
+                                  signal_idx=np.where(local_ext==-1)[0],
+                                  gap_idx=np.where(local_ext==-0.5)[0],
+                                  pvalues=pvalue,
                                   pvalue_cut=pvalue_cut)
-    
-        
+
     return domains
-    
+
+
+def Get_Band(data, width):
+    """
+    :param data: Hi-C matrix in scipy sparse format
+    :param width: number of diagonals to extract
+
+    :returns: two arrays of shape (width, number of bins) with, in row k and
+       column i, the values of the cells (i, i+k) and (i+k, i) respectively
+       (upper and lower diagonals of the matrix)
+    """
+    n_bins = data.shape[0]
+    coo = data.tocoo()
+    upper = np.zeros((width, n_bins))
+    lower = np.zeros((width, n_bins))
+    dist = coo.col - coo.row
+    keep = (dist >= 0) & (dist < width)
+    upper[dist[keep], coo.row[keep]] = coo.data[keep]
+    keep = (dist <= 0) & (dist > -width)
+    lower[-dist[keep], coo.col[keep]] = coo.data[keep]
+    return upper, lower
+
+
+def Get_Diamond_Means(band, size):
+    """
+    Mean interaction of each bin i with its upstream region, the diamond being
+    the sub-matrix [i-size+1:i+1, i+1:i+size+1] (as in
+    :func:`Get_Diamond_Matrix_Mean`, but for all bins at once).
+
+    :param band: upper diagonals of the matrix (see :func:`Get_Band`), at least
+       2 * size
+    :param size: window size
+
+    :returns: an array with the mean of each diamond (NaN for the last bin)
+    """
+    n_bins = band.shape[1]
+    pos = np.arange(n_bins)
+    total = np.zeros(n_bins)
+    for k in xrange(1, 2 * size):
+        cumul = np.concatenate(([0], np.cumsum(band[k])))
+        # first and last rows of the diamond crossing the diagonal k
+        beg = np.maximum(0, pos + 1 - min(k, size))
+        end = np.minimum(np.minimum(pos, pos + size - k), n_bins - 1 - k)
+        good = end >= beg
+        total[good] += cumul[end[good] + 1] - cumul[beg[good]]
+    ncells = ((pos - np.maximum(0, pos - size + 1) + 1) *
+              (np.minimum(pos + size + 1, n_bins) - pos - 1))
+    means = np.empty(n_bins)
+    means[-1] = np.nan
+    means[:-1] = total[:-1] / ncells[:-1]
+    return means
+
+
+def Get_Pvalue_Band(band, size, batch=10000):
+    """
+    Same as :func:`Get_Pvalue` working on the upper diagonals of a region
+    (see :func:`Get_Band`), and running the Wilcoxon rank-sum tests by batches
+    of bins.
+
+    :param band: upper diagonals of the region, at least 2 * size
+    :param size: window size
+    :param 10000 batch: number of bins tested at once
+
+    :returns: the p-values of the n_bins - 1 first bins of the region
+    """
+    n_bins = band.shape[1]
+    # offsets of the cells of the diamond, and of the upstream and downstream
+    # triangles, relative to the bin tested
+    dia = [(-a, b) for b in xrange(size) for a in xrange(size, 0, -1)]
+    ups = [(-a, -b) for a in xrange(size + 1, 0, -1) for b in xrange(a - 1, 0, -1)]
+    dws = [(a, b) for a in xrange(size) for b in xrange(a + 1, size)]
+    pvalue = np.ones(n_bins - 1)
+    for beg in xrange(1, n_bins, batch):
+        pos = np.arange(beg, min(beg + batch, n_bins))[:, None]
+        xvals = _band_cells(band, pos, dia)
+        yvals = np.concatenate((_band_cells(band, pos, ups),
+                                _band_cells(band, pos, dws)), axis=1)
+        # empty cells of the diamond, and empty or zero cells of the triangles
+        # are not considered
+        xvals[np.isnan(xvals)] = np.inf
+        yvals[yvals == 0] = np.inf
+        pvalue[beg - 1:pos[-1, 0]] = _mannwhitneyu_less(xvals, yvals)
+    pvalue[np.isnan(pvalue)] = 1
+    return pvalue
+
+
+def _band_cells(band, pos, offsets):
+    """
+    :returns: the values of the cells (pos + row offset, pos + column offset)
+       of the matrix, infinite for the cells out of the matrix
+    """
+    n_bins = band.shape[1]
+    rows = pos + np.array([o[0] for o in offsets], dtype=int)
+    cols = pos + np.array([o[1] for o in offsets], dtype=int)
+    good = (rows >= 0) & (cols < n_bins)
+    vals = np.empty(rows.shape)
+    vals[~good] = np.inf
+    vals[good] = band[cols[good] - rows[good], rows[good]]
+    return vals
+
+
+def _mannwhitneyu_less(xvals, yvals):
+    """
+    Vectorized one-sided (less) Mann-Whitney rank test, with continuity and tie
+    corrections, as :func:`scipy.stats.mannwhitneyu`. Each row of the input
+    arrays is a test, infinite values are ignored (NaN are considered higher
+    than any other value).
+
+    :returns: an array with the p-value of each test
+    """
+    nrows = xvals.shape[0]
+    values = np.concatenate((xvals, yvals), axis=1)
+    isx = np.zeros(values.shape, dtype=bool)
+    isx[:, :xvals.shape[1]] = True
+    isx &= ~np.isinf(values)
+    # NaN are ranked after any other value, all different
+    values[np.isnan(values)] = -np.inf
+    values[np.isinf(values) & (values > 0)] = np.nan
+    values[np.isneginf(values)] = np.inf
+    order = np.argsort(values, axis=1, kind='mergesort')
+    rows = np.arange(nrows)[:, None]
+    values = values[rows, order].ravel()
+    isx = isx[rows, order].ravel()
+    width = order.shape[1]
+    # average ranks of ties
+    diff = np.ones(values.shape, dtype=bool)
+    diff[1:] = (values[1:] != values[:-1]) | np.isinf(values[1:])
+    diff[::width] = True
+    starts = np.flatnonzero(diff)
+    counts = np.diff(np.append(starts, len(values)))
+    ranks = (starts % width + (counts + 1) / 2.).repeat(counts)
+    n1 = isx.reshape(nrows, width).sum(axis=1).astype(float)
+    n2 = (~np.isnan(values)).reshape(nrows, width).sum(axis=1) - n1
+    ties = np.bincount(starts // width, weights=counts ** 3 - counts,
+                       minlength=nrows)
+    size = n1 + n2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tiecorr = np.where(size < 2, 1., 1 - ties / (size ** 3 - size))
+        u1 = (n1 * n2 + n1 * (n1 + 1) / 2.
+              - (ranks * isx).reshape(nrows, width).sum(axis=1))
+        sd = np.sqrt(tiecorr * n1 * n2 * (n1 + n2 + 1) / 12.)
+        zscore = (u1 - n1 * n2 / 2. - 0.5) / sd
+    pvalue = norm.sf(zscore)
+    pvalue[tiecorr == 0] = np.nan
+    return pvalue
+
+
 def Get_Diamond_Matrix_Mean(data, i, size):
 
   n_bins = data.shape[1]
@@ -273,26 +563,33 @@ def Get_Diamond_Matrix_Mean(data, i, size):
   return (data[lowerbound:(i+1),(i+1):upperbound].mean())
   
 def Which_Gap_Region(data):
-  
+
   n_bins = data.shape[1]
 
+  # for each bin, closest upstream bin (or itself) with which it interacts
+  coo = data.tocoo()
+  nonzero = coo.data != 0
+  closest = np.ones(n_bins, dtype=int) * -1
+  np.maximum.at(closest, np.maximum(coo.row, coo.col)[nonzero],
+                np.minimum(coo.row, coo.col)[nonzero])
+
   gap = np.zeros(n_bins)
-  
+
   i=0
   while i < n_bins:
-  
+
     j = i + 1
-    while j < n_bins:
-      if data[i:j+1, i:j+1].sum() == 0:
-        gap[i:j+1] = -0.5
+    # the sub-matrix [i:j+1, i:j+1] is empty
+    if closest[i] < i:
+      while j < n_bins and closest[j] < i:
         j = j+1
-      else:
-        break
-    
-    i = j  
-  
+      if j > i + 1:
+        gap[i:j] = -0.5
+
+    i = j
+
   idx = np.where(gap==-0.5)[0]
-  
+
   #return dict(zip(idx,idx))
   return idx
 
@@ -16,7 +16,9 @@ from shutil                       import copyfile
 from pytadbit.utils.sqlite_utils  import get_jobid, add_path, get_path_id, print_db
 from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.mapping.analyze     import insert_sizes
+from pytadbit.mapping.reads_stats import get_reads_stats
 from pytadbit.mapping.filter      import filter_reads, apply_filter
+from multiprocessing              import cpu_count
 import sqlite3 as lite
 import time
 
@@ -28,7 +30,7 @@ def run(opts):
 
     fname1, fname2 = load_parameters_fromdb(opts)
 
-    param_hash = digest_parameters(opts)
+    param_hash = digest_parameters(opts, extra=['compress'])
 
     reads = path.join(opts.workdir, '03_filtered_reads',
                       'all_r1-r2_intersection_%s.tsv' % param_hash)
@@ -40,14 +42,17 @@ def run(opts):
 
         # compute the intersection of the two read ends
         print 'Getting intersection between read 1 and read 2'
-        count, multiples = get_intersection(fname1, fname2, reads)
+        count, multiples = get_intersection(fname1, fname2, reads,
+                                            nthreads=opts.cpus)
 
         # compute insert size
         print 'Get insert size...'
         hist_path = path.join(opts.workdir,
                               'histogram_fragment_sizes_%s.pdf' % param_hash)
+        # statistics of the reads computed once, and stored next to them
+        reads_stats = get_reads_stats(reads, nthreads=opts.cpus)
         median, max_f, mad = insert_sizes(
-            reads, nreads=1000000, stats=('median', 'first_decay', 'MAD'),
+            reads_stats, stats=('median', 'first_decay', 'MAD'),
             savefig=hist_path)
         
         print '  - median insert size =', median
@@ -63,15 +68,18 @@ def run(opts):
                '(%d bp) to check for random breaks') % min_dist
     
         print "identify pairs to filter..."
-        masked = filter_reads(reads, max_molecule_length=max_mole,
-                              over_represented=opts.over_represented,
-                              max_frag_size=opts.max_frag_size,
-                              min_frag_size=opts.min_frag_size,
-                              re_proximity=opts.re_proximity,
-                              min_dist_to_re=min_dist, fast=True)
-
-    n_valid_pairs = apply_filter(reads, mreads, masked,
-                                 filters=opts.apply)
+        masked, n_valid_pairs = filter_reads(
+            reads, max_molecule_length=max_mole,
+            over_represented=opts.over_represented,
+            max_frag_size=opts.max_frag_size,
+            min_frag_size=opts.min_frag_size,
+            re_proximity=opts.re_proximity,
+            min_dist_to_re=min_dist, fast=True,
+            outfile=mreads, filters=opts.apply, nthreads=opts.cpus,
+            compress=opts.compress)
+    else:
+        n_valid_pairs = apply_filter(reads, mreads, masked,
+                                     filters=opts.apply, nthreads=opts.cpus)
 
     finish_time = time.localtime()
     print median, max_f, mad
@@ -121,7 +129,8 @@ def save_to_db(opts, count, multiples, reads, mreads, n_valid_pairs, masked,
             unique (PATHid))""")
         try:
             parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )            
+            param_hash = digest_parameters(opts, get_md5=True,
+                                           extra=['compress'])
             cur.execute("""
     insert into JOBs
      (Id  , Parameters, Launch_time, Finish_time,    Type, Parameters_md5)
@@ -318,6 +327,17 @@ def populate_args(parser):
                         help='''[%(default)s] to exclude read-ends falling too
                         close from RE site (pseudo-dangling-ends)''')
 
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=1, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. If higher
+                        than 1, reads are filtered in parallel (if 0 all
+                        available) cores will be used''')
+
+    glopts.add_argument('--compress', dest='compress', action='store_true',
+                        default=False,
+                        help='''compress (BGZF, in parallel) the files with
+                        the IDs of the reads filtered''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
@@ -345,6 +365,12 @@ def check_options(opts):
     if opts.apply:
         opts.apply.sort()
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # for lustre file system....
     if 'tmpdb' in opts and opts.tmpdb:
         dbdir = opts.tmpdb
@@ -358,7 +384,7 @@ def check_options(opts):
             pass
 
     # check if job already run using md5 digestion of parameters
-    if already_run(opts) and not opts.force:
+    if already_run(opts, extra=['compress']) and not opts.force:
         if 'tmpdb' in opts and opts.tmpdb:
             remove(path.join(dbdir, dbfile))
         exit('WARNING: exact same job already computed, see JOBs table above')
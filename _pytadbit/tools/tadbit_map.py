@@ -20,7 +20,7 @@ mapping strategy
 
 from argparse                             import HelpFormatter
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
-from pytadbit.utils.fastq_utils           import quality_plot
+from pytadbit.utils.fastq_utils           import quality_plot, fastq_qc
 from pytadbit.utils.file_handling         import which, mkdir
 from pytadbit.mapping.full_mapper         import full_mapping
 from pytadbit.utils.sqlite_utils          import get_path_id, add_path, print_db
@@ -48,13 +48,20 @@ def run(opts):
     if opts.quality_plot:
         logging.info('Generating Hi-C QC plot at:\n  ' +
                path.join(opts.workdir, path.split(opts.fastq)[-1] + '.pdf'))
-        dangling_ends, ligated = quality_plot(opts.fastq, r_enz=opts.renz,
-                                              nreads=100000, paired=False,
+        # statistics are computed on a random sample of reads
+        stats = fastq_qc(opts.fastq, r_enz=opts.renz, nreads=100000,
+                         paired=False)
+        dangling_ends, ligated = quality_plot(opts.fastq, stats=stats,
                                               savefig=path.join(
                                                   opts.workdir,
                                                   path.split(opts.fastq)[-1] + '.pdf'))
-        logging.info('  - Dangling-ends (sensu-stricto): %.3f%%', dangling_ends)
-        logging.info('  - Ligation sites: %.3f%%', ligated)
+        logging.info('  - Sampled reads: %d', stats['nreads'])
+        if opts.renz:
+            logging.info('  - Dangling-ends (sensu-stricto): %.3f%% '
+                         '(95%% CI: %.3f-%.3f%%)', dangling_ends,
+                         *stats['dangling_ends_ci'])
+            logging.info('  - Ligation sites: %.3f%% (95%% CI: %.3f-%.3f%%)',
+                         ligated, *stats['ligated_ci'])
         return
 
     logging.info('mapping %s read %s to %s', opts.fastq, opts.read, opts.workdir)
@@ -65,7 +72,8 @@ def run(opts):
                             r_enz=opts.renz, temp_dir=opts.tmp, nthreads=opts.cpus,
                             frag_map=not opts.iterative, clean=not opts.keep_tmp,
                             windows=opts.windows, get_nread=True, skip=opts.skip,
-                            suffix=param_hash, **opts.gem_param)
+                            suffix=param_hash, stream=opts.stream,
+                            **opts.gem_param)
 
     # adjust line count
     if opts.skip:
@@ -188,6 +196,13 @@ def populate_args(parser):
                       default=False,
                       help='[DEBUG] keep temporary files.')
 
+    glopts.add_argument('--stream', dest='stream', action='store_true',
+                      default=False,
+                      help='''run all mapping rounds at the same time, passing
+                      reads from one step to the next through named pipes
+                      in the temporary directory (no intermediate FASTQ or
+                      MAP files written to disk)''')
+
     mapper.add_argument("-C", "--cpu", dest="cpus", type=int,
                         default=0, help='''[%(default)s] Maximum number of CPU
                         cores  available in the execution host. If higher
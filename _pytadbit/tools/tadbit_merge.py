@@ -14,6 +14,7 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.sqlite_utils  import get_path_id
 from pytadbit.utils.file_handling import mkdir
+from pytadbit.utils.hyperloglog   import get_pairs_sketch, library_complexity
 from os                           import path, remove
 from string                       import ascii_letters
 from random                       import random
@@ -119,6 +120,17 @@ def run(opts):
 
     nreads = merge_2d_beds(mreads1, mreads2, outbed)
 
+    # library complexity of the merged samples (e.g. lanes of a same library),
+    # from the combined sketches of distinct reads of each sample
+    print 'estimating library complexity'
+    sketch = get_pairs_sketch(mreads1).merge(get_pairs_sketch(mreads2))
+    sketch.save(outbed + '.hll')
+    complexity = library_complexity(sketch.count, sketch.cardinality())
+    print '  - duplicated reads: %.2f%%' % (100 * complexity['duplicate rate'])
+    if complexity['library size']:
+        print '  - estimated library size: %d molecules (%.1f%% sequenced)' % (
+            complexity['library size'], 100 * complexity['saturation'])
+
     finish_time = time.localtime()
     save_to_db (opts, mreads1, mreads2, decay_corr_dat, decay_corr_fig,
                 len(bads.keys()), len(hic_data1), nreads,
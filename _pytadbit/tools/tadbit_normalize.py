@@ -16,6 +16,7 @@ from string                       import ascii_letters
 from random                       import random
 from shutil                       import copyfile
 from cPickle                      import dump
+from multiprocessing              import cpu_count
 import sqlite3 as lite
 import time
 
@@ -25,14 +26,42 @@ def run(opts):
     check_options(opts)
     launch_time = time.localtime()
 
-    param_hash = digest_parameters(opts)
     if opts.bed:
         mreads = path.realpath(opts.bed)
     else:
         mreads = path.join(opts.workdir, load_parameters_fromdb(opts))
 
+    # each resolution is stored as an independent job, as if run with
+    # --resolution
+    resolutions = opts.resolutions or [opts.reso]
+    opts.resolutions = None
+    todo = []
+    for reso in sorted(resolutions, reverse=True):
+        opts.reso = reso
+        if len(resolutions) > 1:
+            if already_run(opts, extra=['cpus']) and not opts.force:
+                print ('WARNING: exact same job already computed at '
+                       'resolution %s, skipping' % (nice(reso)))
+                continue
+        todo.append(reso)
+    if not todo:
+        return
+
+    # the resolutions to compute are binned from a single read of the file
     print 'loading', mreads
-    hic_data = load_hic_data_from_reads(mreads, opts.reso)
+    hic_datas = load_hic_data_from_reads(mreads, todo,
+                                         sparse=opts.sparse, verbose=True)
+
+    for reso in todo:
+        opts.reso = reso
+        if len(resolutions) > 1:
+            print '\nResolution %s' % (nice(reso))
+        normalize_resolution(opts, hic_datas.pop(reso), mreads, launch_time)
+        launch_time = time.localtime()
+
+def normalize_resolution(opts, hic_data, mreads, launch_time):
+    # the number of CPUs does not change the results
+    param_hash = digest_parameters(opts, extra=['cpus'])
 
     mkdir(path.join(opts.workdir, '04_normalization'))
 
@@ -59,8 +88,12 @@ def run(opts):
     # Identify biases
     if not opts.filter_only:
         print 'Get biases using ICE...'
-        hic_data.normalize_hic(silent=False, max_dev=0.1, iterations=0,
-                               factor=opts.factor)
+        hic_data.normalize_hic(silent=False, max_dev=0.1,
+                               iterations=opts.iterations, factor=opts.factor,
+                               sparse=True, n_cpus=opts.cpus, log=path.join(
+                                   opts.workdir, '04_normalization',
+                                   'ICE_convergence_%s_%s.tsv' % (
+                                       opts.reso, param_hash)))
 
     print 'Getting cis/trans...'
     cis_trans_N_D = cis_trans_N_d = float('nan')
@@ -245,7 +278,7 @@ def save_to_db(opts, cis_trans_N_D, cis_trans_N_d, cis_trans_n_D, cis_trans_n_d,
                 unique (JOBid))""")
         try:
             parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )
+            param_hash = digest_parameters(opts, get_md5=True, extra=['cpus'])
             cur.execute("""
             insert into JOBs
             (Id  , Parameters, Launch_time, Finish_time, Type , Parameters_md5)
@@ -380,9 +413,17 @@ def populate_args(parser):
                         working directory database)''')
 
     glopts.add_argument('-r', '--resolution', dest='reso', metavar="INT",
-                        action='store', default=None, type=int, required=True,
+                        action='store', default=None, type=int,
                         help='''resolution at which to output matrices''')
 
+    glopts.add_argument('--resolutions', dest='resolutions', metavar="NUM",
+                        action='store', default=None, type=float, nargs='+',
+                        help='''list of resolutions at which to output
+                        matrices (e.g.: 1e6 1e5 2e4). The file of reads is
+                        parsed only once, matrices at resolutions multiple of
+                        the smallest one are obtained by merging its bins. Each
+                        resolution is stored as a different job''')
+
     glopts.add_argument('--perc_zeros', dest='perc_zeros', metavar="FLOAT",
                         action='store', default=95, type=float, 
                         help=('[%(default)s%%] maximum percentage of zeroes '
@@ -401,6 +442,25 @@ def populate_args(parser):
                         help='''[%(default)s] normalization(s) to apply.
                         Order matters.''')
 
+    glopts.add_argument('--iterations', dest='iterations', metavar="INT",
+                        action='store', default=0, type=int,
+                        help='''[%(default)s] number of iterations of ICE
+                        (stops before if the sum of all rows differ by less
+                        than 10%% from their mean)''')
+
+    glopts.add_argument('--sparse', dest='sparse', action='store_true',
+                        default=False,
+                        help='''store the Hi-C matrix in arrays instead of a
+                        dictionary (much lower memory usage, recommended for
+                        genomic matrices at high resolution)''')
+
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=1, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. If higher
+                        than 1, tasks with multi-threading
+                        capabilities will enabled (if 0 all available)
+                        cores will be used''')
+
     glopts.add_argument('--factor', dest='factor', metavar="NUM",
                         action='store', default=1, type=float,
                         help='''[%(default)s] target mean value of a cell after
@@ -446,6 +506,15 @@ def populate_args(parser):
 
 def check_options(opts):
 
+    # check resolutions
+    if not opts.reso and not opts.resolutions:
+        raise Exception('ERROR: --resolution or --resolutions is needed')
+    if opts.reso and opts.resolutions:
+        raise Exception('ERROR: --resolution and --resolutions are '
+                        'incompatible')
+    if opts.resolutions:
+        opts.resolutions = sorted(set(int(r) for r in opts.resolutions))
+
     # check resume
     if not path.exists(opts.workdir):
         raise IOError('ERROR: wordir not found.')
@@ -462,8 +531,14 @@ def check_options(opts):
         except IOError:
             pass
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # check if job already run using md5 digestion of parameters
-    if already_run(opts):
+    if already_run(opts, extra=['cpus']):
         if 'tmpdb' in opts and opts.tmpdb:
             remove(path.join(dbdir, dbfile))
         exit('WARNING: exact same job already computed, see JOBs table above')
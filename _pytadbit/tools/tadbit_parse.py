@@ -22,6 +22,7 @@ import logging
 from cPickle import load, UnpicklingError
 import sqlite3 as lite
 from warnings import warn
+from multiprocessing import cpu_count
 
 DESC = "Parse mapped Hi-C reads and get the intersection"
 
@@ -54,18 +55,24 @@ def run(opts):
         f_names2  = None
         out_file1 = path.join(opts.workdir, outdir, '%s_r2_%s.tsv' % (name, param_hash))
         
+    cache_dir = opts.cache_dir or path.join(opts.workdir, 'cache')
     logging.info('parsing genomic sequence')
     try:
         # allows the use of cPickle genome to make it faster
         genome = load(open(opts.genome[0]))
     except UnpicklingError:
-        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom)
+        genome = parse_fasta(opts.genome, chr_regexp=opts.filter_chrom,
+                             cache_dir=cache_dir)
 
     if not opts.skip:
         logging.info('parsing reads in %s project', name)
         counts, multis = parse_map(f_names1, f_names2, out_file1=out_file1,
                                    out_file2=out_file2, re_name=renz, verbose=True,
-                                   genome_seq=genome, compress=opts.compress_input)
+                                   genome_seq=genome, compress=opts.compress_input,
+                                   max_memory=opts.max_memory,
+                                   compress_tmp=opts.compress_tmp,
+                                   nthreads=opts.cpus,
+                                   cache_dir=cache_dir)
     else:
         counts = {}
         counts[0] = {}
@@ -308,6 +315,31 @@ def populate_args(parser):
                         done. This is done in background, while next MAP file is
                         processed, or while reads are sorted.''')
 
+    glopts.add_argument('--max_memory', dest='max_memory', metavar="INT",
+                        type=int, default=1000,
+                        help='''[%(default)s] maximum memory (in Mb) used to
+                        store reads before sorting them into temporary files''')
+
+    glopts.add_argument('--compress_tmp', dest='compress_tmp',
+                        action='store_true', default=False,
+                        help='''Compress temporary files used to sort the reads
+                        (lowers disk usage)''')
+
+    glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
+                        default=1, help='''[%(default)s] Maximum number of CPU
+                        cores  available in the execution host. If higher
+                        than 1, map files (or chunks of them) are parsed and
+                        sorted in parallel (if 0 all available) cores will be
+                        used''')
+
+    glopts.add_argument('--cache_dir', dest='cache_dir', metavar='PATH',
+                        type=str, default=None,
+                        help='''[WORKDIR/cache] directory where to store the
+                        parsed reference genome and the positions of its
+                        restriction sites, reused by next runs with the same
+                        genome and enzyme (can be shared between working
+                        directories)''')
+
     glopts.add_argument('--tmpdb', dest='tmpdb', action='store', default=None,
                         metavar='PATH', type=str,
                         help='''if provided uses this directory to manipulate the
@@ -347,6 +379,12 @@ def check_options(opts):
     if opts.workdir.endswith('/'):
         opts.workdir = opts.workdir[:-1]
 
+    # number of cpus
+    if opts.cpus == 0:
+        opts.cpus = cpu_count()
+    else:
+        opts.cpus = min(opts.cpus, cpu_count())
+
     # write log
     log_format = '[PARSING]   %(message)s'
 
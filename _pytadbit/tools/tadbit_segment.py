@@ -12,11 +12,13 @@ from pytadbit.utils.sqlite_utils  import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils  import add_path, get_jobid, print_db
 from pytadbit.utils.file_handling import mkdir
 from pytadbit.parsers.tad_parser  import parse_tads
+from pytadbit.hic_data            import SparseHiC_data
 from os                           import path, remove
 from time                         import sleep
 from shutil                       import copyfile
 from string                       import ascii_letters
 from random                       import random
+from numpy                        import rint
 import sqlite3 as lite
 import time
 
@@ -25,7 +27,8 @@ DESC = 'Finds TAD or compartment segmentation in Hi-C data.'
 def run(opts):
     check_options(opts)
     launch_time = time.localtime()
-    param_hash = digest_parameters(opts)
+    # segmentation by windows only changes the hash of the jobs using it
+    param_hash = digest_parameters(opts, extra=[] if opts.window else ['window'])
 
     if opts.nosql:
         bad_co = opts.bad_co
@@ -65,19 +68,10 @@ def run(opts):
         cmprt_dir = path.join(opts.workdir, '05_segmentation',
                               'compartments_%s' % (nice(reso)))
         mkdir(cmprt_dir)
-        firsts = hic_data.find_compartments(crms=opts.crms, savefig=cmprt_dir,
-                                            suffix=param_hash, log=cmprt_dir,
-                                            rich_in_A=opts.rich_in_A)
-
-        for crm in opts.crms or hic_data.chromosomes:
-            if not crm in firsts:
-                continue
-            ev_file = open(path.join(cmprt_dir,
-                                     '%s_EigVect_%s.tsv' % (crm, param_hash)), 'w')
-            ev_file.write('# first EV\tsecond EV\n')
-            ev_file.write('\n'.join(['\t'.join([str(v) for v in vs])
-                                     for vs in zip(*firsts[crm])]))
-            ev_file.close()
+        hic_data.find_compartments(crms=opts.crms, savefig=cmprt_dir,
+                                   suffix=param_hash, log=cmprt_dir,
+                                   saveev=cmprt_dir, n_cpus=opts.cpus,
+                                   rich_in_A=opts.rich_in_A)
 
         for crm in opts.crms or hic_data.chromosomes:
             cmprt_file = path.join(cmprt_dir, '%s_%s.tsv' % (crm, param_hash))
@@ -93,12 +87,20 @@ def run(opts):
         tad_dir = path.join(opts.workdir, '05_segmentation',
                              'tads_%s' % (nice(reso)))
         mkdir(tad_dir)
+        if opts.window:
+            csr = hic_data.get_hic_data_as_csr()
         for crm in hic_data.chromosomes:
             if opts.crms and not crm in opts.crms:
                 continue
             print '  - %s' % crm
-            matrix = hic_data.get_matrix(focus=crm)
             beg, end = hic_data.section_pos[crm]
+            if opts.window:
+                # no dense matrix, windows are extracted from a sparse one
+                matrix = csr[beg:end, beg:end]
+                matrix.data = rint(matrix.data)
+                matrix = SparseHiC_data(matrix.astype(int), end - beg)
+            else:
+                matrix = hic_data.get_matrix(focus=crm)
             size = len(matrix)
             if size < 10:
                 print "     Chromosome too short (%d bins), skipping..." % size
@@ -110,7 +112,7 @@ def run(opts):
             result = tadbit([matrix], remove=to_rm,
                             n_cpus=opts.cpus, verbose=False,
                             max_tad_size=max_tad_size,
-                            no_heuristic=False)
+                            no_heuristic=False, window=opts.window)
             tads = load_tad_height(result, size, beg, end, hic_data)
             table = ''
             table += '%s\t%s\t%s\t%s%s\n' % ('#', 'start', 'end', 'score', 'density')
@@ -162,7 +164,8 @@ def save_to_db(opts, cmp_result, tad_result, reso, inputs,
                 Resolution int)""")
         try:
             parameters = digest_parameters(opts, get_md5=False)
-            param_hash = digest_parameters(opts, get_md5=True )
+            param_hash = digest_parameters(
+                opts, get_md5=True, extra=[] if opts.window else ['window'])
             cur.execute("""
             insert into JOBs
             (Id  , Parameters, Launch_time, Finish_time, Type , Parameters_md5)
@@ -337,6 +340,13 @@ def populate_args(parser):
                         help='''an integer defining the maximum size of TAD. Default
                         defines it as the number of rows/columns''')
 
+    glopts.add_argument('--window', dest='window', metavar="INT",
+                        action='store', default=None, type=int,
+                        help='''segment chromosomes by overlapping windows of this
+                        number of bins (several times max_tad_size), in
+                        parallel, stitching TAD borders found in overlaps.
+                        Default segments the whole chromosome at once''')
+
     glopts.add_argument("-C", "--cpu", dest="cpus", type=int,
                         default=0, help='''[%(default)s] Maximum number of CPU
                         cores  available in the execution host. If higher
@@ -364,7 +374,8 @@ def check_options(opts):
         opts.tmpdb = path.join(dbdir, dbfile)
         copyfile(path.join(opts.workdir, 'trace.db'), opts.tmpdb)
 
-    if already_run(opts) and not opts.force:
+    if already_run(opts, extra=[] if opts.window else ['window']) and \
+           not opts.force:
         if 'tmpdb' in opts and opts.tmpdb:
             remove(path.join(dbdir, dbfile))
         exit('WARNING: exact same job already computed, see JOBs table above')
@@ -7,11 +7,12 @@ from gzip import open as gopen
 import numpy as np
 from pytadbit.utils.extraviews import tadbit_savefig
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES, religated, repaired
+from pytadbit.utils.hyperloglog import HyperLogLog
 from os import SEEK_END
 from numpy import std, mean
-from random import random
+from random import random, Random
+from itertools import islice
 from subprocess import Popen, PIPE
-import re
 
 try:
     from matplotlib import pyplot as plt
@@ -19,7 +20,224 @@ except ImportError:
     warn('matplotlib not found\n')
 
 
-def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=False):
+def _fastq_handler(fnam):
+    if fnam.endswith('.gz'):
+        return gopen(fnam)
+    if fnam.endswith('.dsrc'):
+        proc = Popen(['dsrc', 'd', '-t8', '-s', fnam], stdout=PIPE)
+        return proc.stdout
+    return open(fnam)
+
+
+def _sync_fastq(fhandler, offset):
+    """
+    Moves the file handler to the beginning of the first FASTQ entry found
+    after offset.
+    """
+    fhandler.seek(offset)
+    if offset:
+        fhandler.readline()  # partial line
+    while True:
+        pos = fhandler.tell()
+        line = fhandler.readline()
+        if not line:
+            return False
+        if line.startswith('@'):
+            fhandler.readline()
+            # only a header line is followed, two lines later, by '+'
+            if fhandler.readline().startswith('+'):
+                fhandler.seek(pos)
+                return True
+        fhandler.seek(pos + len(line))
+
+
+def _sample_fastq(fnam, nreads, seed=1, cluster=100):
+    """
+    Yields lists of FASTQ entries (as lists of lines) randomly picked in the
+    file. Entries are read by clusters of consecutive entries starting at
+    random positions of the file.
+    """
+    fhandler = open(fnam, 'rb')
+    fhandler.seek(0, SEEK_END)
+    flen = fhandler.tell()
+    rnd = Random(seed)
+    offsets = sorted(int(rnd.random() * flen)
+                     for _ in xrange(max(1, nreads / cluster)))
+    end = 0
+    lines = []
+    for offset in offsets:
+        if offset < end:
+            # entries already read, continue with the next ones
+            fhandler.seek(end)
+        elif not _sync_fastq(fhandler, offset):
+            break
+        for _ in xrange(cluster):
+            entry = [fhandler.readline() for _ in xrange(4)]
+            if not entry[-1]:
+                break
+            lines.extend(entry)
+        end = fhandler.tell()
+        if len(lines) >= 4 * nreads:
+            break
+    fhandler.close()
+    return lines
+
+
+def _motif_matrix(seqs, motif):
+    """
+    :returns: a boolean matrix, with the same shape as seqs, where motif starts
+    """
+    nrow, ncol = seqs.shape
+    found = np.zeros((nrow, ncol), dtype=bool)
+    size = len(motif)
+    if size > ncol:
+        return found
+    match = np.ones((nrow, ncol - size + 1), dtype=bool)
+    for i, nt in enumerate(motif):
+        match &= seqs[:, i:ncol - size + 1 + i] == ord(nt)
+    found[:, :ncol - size + 1] = match
+    return found
+
+
+def _isolated(match, size):
+    """
+    Removes motifs directly preceded or followed by the same motif (e.g.
+    GATC in GATCGATC)
+    """
+    alone = match.copy()
+    alone[:, size:] &= ~match[:, :-size]
+    alone[:, :-size] &= ~match[:, size:]
+    return alone
+
+
+def fastq_qc(fnam, r_enz=None, nreads=None, paired=False, seed=1,
+             chunk=100000):
+    """
+    Computes the sequencing quality of a given FASTQ file, and, if a
+    restriction enzyme (RE) name is provided, the distribution of digested and
+    undigested RE sites and the proportion of dangling-ends.
+
+    Reads are processed by chunks, as arrays of bytes.
+
+    :param fnam: path to FASTQ file
+    :param None r_enz: name of the restriction enzyme
+    :param None nreads: number of reads to sample (randomly picked in the
+       file by clusters of consecutive reads). If None all reads are used.
+       Compressed files can not be sampled, in which case the first nreads
+       are used
+    :param False paired: is input FASTQ contains both ends
+    :param 1 seed: seed of the random sampling
+    :param 100000 chunk: number of reads processed at once
+
+    :returns: a dictionary with the statistics. Percentages of dangling-ends
+       (sensu stricto) and of reads with at least a ligation site come with
+       their 95% confidence interval
+    """
+    if nreads and not fnam.endswith(('.gz', '.dsrc')):
+        lines = _sample_fastq(fnam, nreads, seed=seed)
+        chunks = (lines[i:i + 4 * chunk]
+                  for i in xrange(0, len(lines), 4 * chunk))
+    else:
+        fhandler = _fastq_handler(fnam)
+        if nreads:
+            fhandler = islice(fhandler, 4 * nreads)
+        chunks = iter(lambda: list(islice(fhandler, 4 * chunk)), [])
+    if r_enz:
+        r_site = RESTRICTION_ENZYMES[r_enz].replace('|', '')
+        l_site = religated(r_enz)
+        d_site = repaired(r_enz)
+        # in case the religated site equals 2 restriction sites (like DpnII)
+        isolate = r_site * 2 == l_site
+    stats = {}
+    for lines in chunks:
+        seqs = [l.rstrip('\n') for l in lines[1::4]]
+        qals = [l.rstrip('\n') for l in lines[3::4]]
+        read_len = max(len(s) for s in seqs)
+        if read_len > stats.get('read_len', 0):
+            # reads longer than previous ones, extend per position counts
+            for key, val in stats.items():
+                if isinstance(val, np.ndarray):
+                    stats[key] = np.append(val, np.zeros(
+                        read_len - len(val), dtype=val.dtype))
+            stats['read_len'] = read_len
+        read_len = stats['read_len']
+        # reads shorter than read_len are padded with spaces
+        seqs = np.frombuffer(''.join(s.ljust(read_len) for s in seqs),
+                             dtype=np.uint8).reshape(-1, read_len)
+        qals = np.frombuffer(''.join(q.ljust(read_len) for q in qals),
+                             dtype=np.uint8).reshape(-1, read_len)
+        valid = qals != ord(' ')
+        qals = np.where(valid, qals.astype(float) - 33, 0)
+        for key, val in (('nreads'  , len(seqs)),
+                         ('qual_n'  , valid.sum(axis=0)),
+                         ('qual_sum', qals.sum(axis=0)),
+                         ('qual_sq' , (qals ** 2).sum(axis=0)),
+                         ('nts_N'   , (seqs == ord('N')).sum(axis=0))):
+            stats[key] = stats.get(key, 0) + val
+        if not r_enz:
+            continue
+        sites = _motif_matrix(seqs, r_site)
+        fixes = _motif_matrix(seqs, d_site)
+        liges = _motif_matrix(seqs, l_site)
+        if isolate:
+            sites = _isolated(sites, len(r_site))
+            fixes = _isolated(fixes, len(d_site))
+        sites = sites.astype(np.int16)
+        liges = liges.astype(np.int16)
+        fixes = fixes.astype(np.int16)
+        # dangling-ends found inside RE or ligation sites are not counted
+        for site, matrix in ((r_site, sites), (l_site, liges)):
+            if d_site in site:
+                pos = site.find(d_site)
+                fixes[:, pos:] -= matrix[:, :read_len - pos]
+        half = (read_len + 1) / 2
+        # dangling-ends per read, from the dangling-end site, or from the RE
+        # site
+        de_fixes = fixes[:, 0] + (fixes[:, half] if paired else 0)
+        de_sites = sites[:, 0] + (sites[:, half] if paired else 0)
+        ligep = liges.any(axis=1)
+        for key, val in (('sites'     , sites.sum(axis=0)),
+                         ('liges'     , liges.sum(axis=0)),
+                         ('fixes'     , fixes.sum(axis=0)),
+                         ('de_fixes'  , de_fixes.sum()),
+                         ('de_fixes_sq', (de_fixes ** 2).sum()),
+                         ('de_sites'  , de_sites.sum()),
+                         ('de_sites_sq', (de_sites ** 2).sum()),
+                         ('ligep'     , ligep.sum())):
+            stats[key] = stats.get(key, 0) + val
+    nreads = stats['nreads']
+    qual_n = np.maximum(stats.pop('qual_n'), 1)
+    stats['qual_mean'] = stats.pop('qual_sum') / qual_n
+    stats['qual_std'] = np.sqrt(np.maximum(
+        stats.pop('qual_sq') / qual_n - stats['qual_mean'] ** 2, 0))
+    stats['r_enz'] = r_enz
+    stats['paired'] = paired
+    if not r_enz:
+        return stats
+    stats.update({'r_site': r_site, 'l_site': l_site, 'd_site': d_site})
+    seq_len = stats['read_len'] + 1 - max(len(r_site), len(l_site),
+                                          len(d_site))
+    for key in ('sites', 'liges', 'fixes'):
+        stats[key] = stats[key][:max(0, seq_len)]
+    key = 'de_fixes' if (stats['fixes'] > 0).any() else 'de_sites'
+    for name, total, total_sq in (('dangling_ends', stats.pop(key),
+                                   stats.pop(key + '_sq')),
+                                  ('ligated', stats['ligep'],
+                                   stats['ligep'])):
+        mean_val = float(total) / nreads
+        dev = 1.96 * np.sqrt(max(float(total_sq) / nreads - mean_val ** 2, 0)
+                             / nreads)
+        stats[name] = 100 * mean_val
+        stats[name + '_ci'] = (100 * (mean_val - dev), 100 * (mean_val + dev))
+    stats.pop('de_fixes', None)
+    stats.pop('de_fixes_sq', None)
+    stats.pop('de_sites', None)
+    stats.pop('de_sites_sq', None)
+    return stats
+
+
+def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None,
+                 paired=False, stats=None):
     """
     Plots the sequencing quality of a given FASTQ file. If a restrinction enzyme
     (RE) name is provided, can also represent the distribution of digested and
@@ -30,111 +248,26 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
     the number of reads).
 
     :param fnam: path to FASTQ file
-    :param None nreads: max number of reads to read, not necesary to read all
+    :param None nreads: number of reads to randomly sample, not necesary to
+       read all (see :func:`fastq_qc`)
     :param None savefig: path to a file where to save the image generated;
        if None, the image will be shown using matplotlib GUI (the extension
        of the file name will determine the desired format).
     :param False paired: is input FASTQ contains both ends
+    :param None stats: statistics already computed with :func:`fastq_qc`
+       (in which case fnam, r_enz, nreads and paired are not used)
 
     :returns: the percentage of dangling-ends (sensu stricto) and the percentage of
        reads with at least a ligation site.
     """
-    phred = dict([(c, i) for i, c in enumerate(
-        '!"#$%&\'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\]^_`abcdefghijklmnopqrstuvwxyz{|}~')])
-    quals = []
-    henes = []
-    sites = []
-    fixes = []
-    liges = []
-    ligep = 0
+    if stats is None:
+        stats = fastq_qc(fnam, r_enz=r_enz, nreads=nreads, paired=paired)
+    r_enz = stats['r_enz']
+    paired = stats['paired']
+    nreads = stats['nreads']
+    # length of the lines of the FASTQ (with end of line)
+    line_len = stats['read_len'] + 1
     tkw = dict(size=4, width=1.5)
-    if fnam.endswith('.gz'):
-        fhandler = gopen(fnam)
-    elif fnam.endswith('.dsrc'):
-        proc = Popen(['dsrc', 'd', '-t8', '-s', fnam], stdout=PIPE)
-        fhandler = proc.stdout
-    else:
-        fhandler = open(fnam)
-    if not r_enz:
-        if nreads:
-            while True:
-                try:
-                    next(fhandler)
-                except EOFError:
-                    break
-                seq = next(fhandler)
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-                if len(quals) > nreads:
-                    break
-        else: # do this because it's faster
-            while True:
-                try:
-                    next(fhandler)
-                except EOFError:
-                    break
-                seq = next(fhandler)
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-    else:
-        r_site = RESTRICTION_ENZYMES[r_enz].replace('|', '')
-        l_site = religated(r_enz)
-        d_site = repaired(r_enz)
-        if r_site*2 == l_site:
-            # in case the religated site equals 2 restriction sites (like DnpII)
-            site = re.compile('(?<!%s)' % r_site + r_site + '(?!%s)' % r_site)
-            fixe = re.compile('(?<!%s)' % d_site + d_site + '(?!%s)' % d_site)
-        else:
-            site = re.compile(r_site)
-            fixe = re.compile(d_site)
-        lige = re.compile(l_site)
-        if nreads:
-            while True:
-                try:
-                    next(fhandler)
-                except StopIteration:
-                    break
-                seq = next(fhandler)
-                sites.extend([m.start() for m in site.finditer(seq)])
-                fixes.extend([m.start() for m in fixe.finditer(seq)])
-                liges.extend([m.start() for m in lige.finditer(seq)])
-                ligep += l_site in seq
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-                if len(quals) > nreads:
-                    break
-        else: # do this because it's faster
-            while True:
-                try:
-                    next(fhandler)
-                except StopIteration:
-                    break
-                seq = next(fhandler)
-                sites.extend([m.start() for m in site.finditer(seq)])
-                fixes.extend([m.start() for m in fixe.finditer(seq)])
-                liges.extend([m.start() for m in lige.finditer(seq)])
-                ligep += l_site in seq
-                if 'N' in seq:
-                    henes.extend([i for i, s in enumerate(seq) if s == 'N'])
-                next(fhandler)
-                line = next(fhandler)
-                quals.append([phred[i] for i in line.strip()])
-    fhandler.close()
-    if not nreads:
-        nreads = len(quals)
-    quals = zip(*quals)
-    meanquals = [np.mean(q) for q in quals]
-    errorquals = [np.std(q) for q in quals]
-
     if axe:
         ax = axe
         fig = axe.get_figure()
@@ -154,18 +287,18 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
                        left=False, bottom=False)
         ax.tick_params(axis='both', direction='out', top=False, right=False,
                        left=False, bottom=False, which='minor')
-    ax.errorbar(range(len(line.strip())), meanquals,
+    ax.errorbar(range(line_len - 1), stats['qual_mean'],
                 linewidth=1, elinewidth=1, color='darkblue',
-                yerr=errorquals, ecolor='orange')
+                yerr=stats['qual_std'], ecolor='orange')
 
-    ax.set_xlim((0, len(line)))
+    ax.set_xlim((0, line_len))
     ax.set_xlabel('Nucleotidic position')
     ax.set_ylabel('PHRED score')
     ax.set_title('Sequencing Quality (%d reads)' % (nreads))
     ax.yaxis.label.set_color('darkblue')
     ax.tick_params(axis='y', colors='darkblue', **tkw)
     axb = ax.twinx()
-    axb.plot([henes.count(i) for i in xrange(len(line))], linewidth=1,
+    axb.plot(list(stats['nts_N']) + [0], linewidth=1,
              color='black', linestyle='--')
     axb.yaxis.label.set_color('black')
     axb.tick_params(axis='y', colors='black', **tkw)
@@ -176,7 +309,7 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
     except ValueError:
         axb.set_yscale('linear')
     ax.set_ylim((0, ax.get_ylim()[1]))
-    ax.set_xlim((0, len(line)))
+    ax.set_xlim((0, line_len))
 
     if r_enz:
         ax.set_title('Sequencing Quality and deconvolution (%s %d reads)' % (
@@ -189,26 +322,17 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
         ax2.grid(ls='-', color='w', lw=1, alpha=0.3, which='minor')
         ax2.set_axisbelow(True)
         ax2.set_xlabel('Nucleotidic position')
-        seq_len = len(line) - max((len(r_site), len(l_site), len(d_site)))
-        sites = [sites.count(k) for k in xrange(seq_len)] # Undigested
-        liges = [liges.count(k) for k in xrange(seq_len)] # OK
-        fixes = [fixes.count(k) for k in xrange(seq_len)] # DE
-        if d_site in r_site:
-            pos = r_site.find(d_site)
-            fixes = (fixes[:pos] +
-                     [fixes[k] - sites[k-pos] for k in xrange(pos, seq_len)])
-        if d_site in l_site:
-            pos = l_site.find(d_site)
-            fixes = (fixes[:pos] +
-                     [fixes[k] - liges[k-pos] for k in xrange(pos, seq_len)])
+        r_site = stats['r_site']
+        l_site = stats['l_site']
+        d_site = stats['d_site']
+        sites = stats['sites'].astype(float) # Undigested
+        liges = stats['liges'].astype(float) # OK
+        fixes = stats['fixes'].astype(float) # DE
         site_len = max((len(r_site), len(l_site), len(d_site)))
         if paired:
-            sites[len(line) / 2 - site_len:
-                  len(line) / 2] = [float('nan')] * site_len
-            liges[len(line) / 2 - site_len:
-                  len(line) / 2] = [float('nan')] * site_len
-            fixes[len(line) / 2 - site_len:
-                  len(line) / 2] = [float('nan')] * site_len
+            sites[line_len / 2 - site_len:line_len / 2] = float('nan')
+            liges[line_len / 2 - site_len:line_len / 2] = float('nan')
+            fixes[line_len / 2 - site_len:line_len / 2] = float('nan')
         ax2.plot(sites, linewidth=2, color='darkred')
         ax2.set_ylabel('Undigested RE site (%s)' % r_site)
         ax2.yaxis.label.set_color('darkred')
@@ -229,25 +353,20 @@ def quality_plot(fnam, r_enz=None, nreads=None, axe=None, savefig=None, paired=F
             ax4.set_ylabel('Dangling-ends (%s)' % d_site)
         else:
             ax2.set_ylabel('RE site & Dangling-ends  (%s)' % r_site)
-        ax2.set_xlim((0, len(line)))
-        lig_cnt = (np.nansum(liges) - liges[0] - liges[len(line) / 2])
-        sit_cnt = (np.nansum(sites) - sites[0] - sites[len(line) / 2])
-        des = ((100. * (fixes[0] + (fixes[(len(line) / 2)]
-                                            if paired else 0)))
-                       / nreads) if any([f > 0 for f in fixes]) else (
-            100. * (sites[0] + (sites[(len(line) / 2)] if paired else 0))) / nreads
+        ax2.set_xlim((0, line_len))
+        lig_cnt = (np.nansum(liges) - liges[0] - liges[line_len / 2])
+        sit_cnt = (np.nansum(sites) - sites[0] - sites[line_len / 2])
         plt.title(('Percentage of digested sites: %.0f%%, of dangling-ends: %.0f%%\n' +
                    'Percentage of reads with ligation site: %.0f%%') %(
                       (100. * lig_cnt) / (lig_cnt + sit_cnt),
-                      des,
-                      (ligep * 100.) / nreads))
+                      stats['dangling_ends'], stats['ligated']))
         plt.subplots_adjust(right=0.85)
     if savefig:
         tadbit_savefig(savefig)
         plt.close('all')
     elif not axe:
         plt.show()
-    return des, (ligep * 100.) / nreads
+    return stats.get('dangling_ends'), stats.get('ligated')
 
 
 def make_patch_spines_invisible(ax):
@@ -322,32 +441,20 @@ def count_reads_approx(fnam, samples=1000, verbose=True):
     return int(nreads)
 
 
-def _trailing_zeroes(num):
-    """Counts the number of trailing 0 bits in num."""
-    if num == 0:
-        return 32 # Assumes 32 bit integer inputs!
-    p = 0
-    while (num >> p) & 1 == 0:
-        p += 1
-    return p
-
 def estimate_cardinality(values, k):
     """Estimates the number of unique elements in the input set values.
 
-    from: http://blog.notdot.net/2012/09/Dam-Cool-Algorithms-Cardinality-Estimation
+    Uses a :class:`pytadbit.utils.hyperloglog.HyperLogLog` sketch.
 
     Arguments:
-        values: An iterator of hashable elements to estimate the cardinality of.
+        values: An iterator of strings to estimate the cardinality of.
         k: The number of bits of hash to use as a bucket number; there will be 2**k buckets.
     """
-    num_buckets = 2 ** k
-    max_zeroes = [0] * num_buckets
-    for value in values:
-        h = hash(value)
-        bucket = h & (num_buckets - 1) # Mask out the k least significant bits as bucket ID
-        bucket_hash = h >> k
-        max_zeroes[bucket] = max(max_zeroes[bucket], _trailing_zeroes(bucket_hash))
-    return 2 ** (float(sum(max_zeroes)) / num_buckets) * num_buckets * 0.79402
+    sketch = HyperLogLog(k)
+    values = iter(values)
+    for chunk in iter(lambda: list(islice(values, 100000)), []):
+        sketch.add(chunk)
+    return sketch.cardinality()
 
 
 def main():
@@ -3,11 +3,15 @@
 """
 
 import ctypes
-import os, errno
+import os, errno, stat
 import platform
 import bz2, gzip, zipfile, tarfile
+import zlib
+from functools import partial
+from struct import pack, unpack
 from subprocess import Popen, PIPE
 from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 def check_pik(path):
     with open(path, "r") as f:
@@ -21,12 +25,21 @@ def magic_open(filename, verbose=False, cpus=None):
     """
     To read uncompressed zip gzip bzip2 or tar.xx files
 
+    Gzip and bzip2 files are decompressed by pigz and pbzip2 (in a separate
+    process) if they are installed and more than one CPU is available.
+    Otherwise, BGZF files (blocked gzip, see :class:`BgzfReader`) are opened
+    with random access.
+
     :param filename: either a path to a file, or a file handler
+    :param None cpus: number of CPUs used to decompress (by default all)
 
     :returns: opened file ready to be iterated
     """
     if isinstance(filename, str) or isinstance(filename, unicode):
         fhandler = file(filename, 'rb')
+        if stat.S_ISFIFO(os.fstat(fhandler.fileno()).st_mode):
+            # named pipes can not be rewound, they are read as text
+            return fhandler
         inputpath = True
         if tarfile.is_tarfile(filename):
             print 'tar'
@@ -59,20 +72,326 @@ def magic_open(filename, verbose=False, cpus=None):
             raise NotImplementedError(
                 'Not exactly one file in this zip archieve.')
         return zhandler.open(zhandler.NameToInfo.keys()[0])
+    cpus = cpus or cpu_count()
     if start_of_file.startswith('\x42\x5a\x68'):
         if verbose:
             print 'bz2'
+        pbzip2_binary = which('pbzip2') if inputpath and cpus > 1 else None
         fhandler.close()
+        if pbzip2_binary:
+            proc = Popen([pbzip2_binary, '-dc', '-p%d' % cpus, filename],
+                         stdout=PIPE)
+            return proc.stdout
         return bz2.BZ2File(filename)
     if start_of_file.startswith('\x1f\x8b\x08'):
         if verbose:
             print 'gz'
+        pigz_binary = which('pigz') if inputpath and cpus > 1 else None
+        if pigz_binary:
+            fhandler.close()
+            proc = Popen([pigz_binary, '-dc', '-p', str(cpus), filename],
+                         stdout=PIPE)
+            return proc.stdout
+        if inputpath and _is_bgzf_start(start_of_file):
+            fhandler.close()
+            return BgzfReader(filename)
         return gzip.GzipFile(fileobj=fhandler)
     if verbose:
         print 'text'
     return fhandler
 
 
+# empty block marking the end of a BGZF file
+_BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43'
+             '\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+# maximum size of the uncompressed data of a BGZF block
+BGZF_BLOCK_SIZE = 65280
+
+
+def _is_bgzf_start(start_of_file):
+    return (start_of_file.startswith('\x1f\x8b\x08\x04') and
+            start_of_file[12:14] == 'BC')
+
+
+def is_bgzf(fnam):
+    """
+    :param fnam: path to a file
+
+    :returns: True if the file is compressed in BGZF format
+    """
+    fhandler = file(fnam, 'rb')
+    start_of_file = fhandler.read(16)
+    fhandler.close()
+    return _is_bgzf_start(start_of_file)
+
+
+class BgzfReader(object):
+    """
+    Reads a BGZF file (blocked gzip, as written by :class:`BgzfWriter`, bgzip
+    or samtools), with random access. Positions are virtual offsets, as in
+    htslib: position of the compressed block in the file << 16 | position in
+    the uncompressed block.
+
+    :param fnam: path to a BGZF file
+    """
+    def __init__(self, fnam):
+        self.name = fnam
+        self._fhandler = file(fnam, 'rb')
+        self._load_block(0)
+
+    def _load_block(self, offset):
+        """
+        decompress the block starting at a given position in the file
+
+        :returns: False if there is no block at this position (end of file)
+        """
+        self._pos = 0
+        self._block = offset
+        self._data = ''
+        self._next = offset
+        self._fhandler.seek(offset)
+        head = self._fhandler.read(12)
+        if not head:
+            return False
+        if not head.startswith('\x1f\x8b\x08\x04'):
+            raise IOError('ERROR: %s not in BGZF format\n' % self.name)
+        xlen = unpack('<H', head[10:12])[0]
+        extra = self._fhandler.read(xlen)
+        # size of the block is in the extra subfield 'BC'
+        pos = 0
+        while extra[pos:pos + 2] != 'BC':
+            if pos >= xlen:
+                raise IOError('ERROR: %s not in BGZF format\n' % self.name)
+            pos += 4 + unpack('<H', extra[pos + 2:pos + 4])[0]
+        bsize = unpack('<H', extra[pos + 4:pos + 6])[0] + 1
+        self._data = zlib.decompress(
+            self._fhandler.read(bsize - xlen - 20), -15)
+        self._next = offset + bsize
+        return True
+
+    def tell(self):
+        """
+        :returns: the current virtual offset
+        """
+        return (self._block << 16) | self._pos
+
+    def seek(self, offset):
+        """
+        :param offset: virtual offset (see :func:`BgzfReader.tell`)
+        """
+        if offset >> 16 != self._block:
+            self._load_block(offset >> 16)
+        self._pos = offset & 0xFFFF
+
+    def read(self, size=-1):
+        chunks = []
+        while size:
+            if self._pos >= len(self._data):
+                if not self._load_block(self._next):
+                    break
+                continue
+            end = len(self._data) if size < 0 else self._pos + size
+            chunk = self._data[self._pos:end]
+            self._pos += len(chunk)
+            size -= len(chunk) if size > 0 else 0
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def readline(self):
+        chunks = []
+        while True:
+            if self._pos >= len(self._data):
+                if not self._load_block(self._next):
+                    break
+                continue
+            end = self._data.find('\n', self._pos) + 1
+            if not end:
+                chunks.append(self._data[self._pos:])
+                self._pos = len(self._data)
+                continue
+            chunks.append(self._data[self._pos:end])
+            self._pos = end
+            break
+        return ''.join(chunks)
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self._fhandler.close()
+
+
+def _bgzf_block(data, level=6):
+    """
+    compress data (at most BGZF_BLOCK_SIZE) into a BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    return (pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                 len(cdata) + 25) + cdata +
+            pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class BgzfWriter(object):
+    """
+    Writes a BGZF file (blocked gzip), readable by any gzip tool, and with
+    random access with :class:`BgzfReader`. Blocks are compressed in
+    parallel threads.
+
+    :param fnam: path to the output file
+    :param 1 nthreads: number of threads compressing blocks
+    :param 6 level: compression level (1 fastest, 9 smallest)
+    """
+    def __init__(self, fnam, nthreads=1, level=6):
+        self.name = fnam
+        self._out = file(fnam, 'wb')
+        self._compress = partial(_bgzf_block, level=level)
+        self._pool = ThreadPool(nthreads) if nthreads > 1 else None
+        # data is compressed when there is enough for a few blocks per thread
+        self._max_size = 4 * nthreads * BGZF_BLOCK_SIZE
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self._max_size:
+            self._flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _flush(self, last=False):
+        data = ''.join(self._buffer)
+        end = len(data) if last else len(data) - len(data) % BGZF_BLOCK_SIZE
+        blocks = [data[beg:beg + BGZF_BLOCK_SIZE]
+                  for beg in xrange(0, end, BGZF_BLOCK_SIZE)]
+        if self._pool:
+            blocks = self._pool.map(self._compress, blocks)
+        else:
+            blocks = map(self._compress, blocks)
+        self._out.write(''.join(blocks))
+        self._buffer = [data[end:]]
+        self._size = len(data) - end
+
+    def close(self):
+        self._flush(last=True)
+        self._out.write(_BGZF_EOF)
+        self._out.close()
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+
+
+def bgzip_file(fnam, nthreads=1, level=6):
+    """
+    Compresses a file in BGZF format (see :class:`BgzfWriter`), replacing it
+    by a file with the same name and the extension .gz
+
+    :param fnam: path to the file to compress
+    :param 1 nthreads: number of threads compressing blocks
+    :param 6 level: compression level (1 fastest, 9 smallest)
+
+    :returns: path to the compressed file
+    """
+    out = BgzfWriter(fnam + '.gz', nthreads=nthreads, level=level)
+    fhandler = file(fnam, 'rb')
+    for data in iter(lambda: fhandler.read(16 * BGZF_BLOCK_SIZE), ''):
+        out.write(data)
+    fhandler.close()
+    out.close()
+    os.remove(fnam)
+    return fnam + '.gz'
+
+
+def is_compressed(fnam):
+    """
+    :param fnam: path to a file
+
+    :returns: True if the file is compressed in any of the formats handled by
+       :func:`magic_open`
+    """
+    fhandler = file(fnam, 'rb')
+    start_of_file = fhandler.read(4)
+    fhandler.close()
+    return (start_of_file.startswith('\x1f\x8b\x08') or
+            start_of_file.startswith('\x42\x5a\x68') or
+            start_of_file.startswith('\x50\x4b\x03\x04') or
+            fnam.endswith('.dsrc') or tarfile.is_tarfile(fnam))
+
+
+def file_chunks(fnam, nchunks, start=0, min_size=65536):
+    """
+    Splits an uncompressed text file in byte ranges, in order to be processed
+    in parallel. The beginning of each range is adjusted to the beginning of
+    a line when iterating over it with :func:`chunk_lines`.
+
+    :param fnam: path to a file
+    :param nchunks: number of chunks
+    :param 0 start: byte position from where to start (e.g. to skip header)
+    :param 65536 min_size: minimum size of a chunk (in bytes)
+
+    :returns: a list of (start, end) byte positions, end being None for the
+       last chunk
+    """
+    if nchunks < 2 or is_compressed(fnam):
+        return [(start, None)]
+    step = (os.path.getsize(fnam) - start) / nchunks
+    if step < min_size:
+        return [(start, None)]
+    chunks = [(start + i * step, start + (i + 1) * step)
+              for i in xrange(nchunks)]
+    chunks[-1] = (chunks[-1][0], None)
+    return chunks
+
+
+def line_start(fhandler, pos):
+    """
+    :param fhandler: file handler opened on an uncompressed text file
+    :param pos: byte position
+
+    :returns: the position of the first line starting at, or after, pos. The
+       file handler is placed at this position
+    """
+    if not pos:
+        fhandler.seek(0)
+        return 0
+    # if we are not at the beginning of a line, skip the partial line
+    fhandler.seek(pos - 1)
+    return pos - 1 + len(fhandler.readline())
+
+
+def chunk_lines(fnam, beg, end):
+    """
+    Iterates over the lines starting in a given byte range of an uncompressed
+    text file (see :func:`file_chunks`).
+
+    :param fnam: path to a file
+    :param beg: start of the byte range
+    :param end: end of the byte range (None for the end of the file)
+    """
+    fhandler = file(fnam)
+    pos = line_start(fhandler, beg)
+    if end is None:
+        for line in fhandler:
+            yield line
+    else:
+        for line in fhandler:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line
+    fhandler.close()
+
+
 def get_free_space_mb(folder, div=2):
     """
     Return folder/drive free space (in bytes)
@@ -0,0 +1,317 @@
+"""
+17 Oct 2026
+
+HyperLogLog sketches to estimate the number of distinct reads (library
+complexity) of FASTQ files or of files of pairs of reads.
+
+Elements are hashed with a stable 64 bit hash (the same in any process or
+machine), so that sketches computed separately (e.g. one per sequencing lane)
+can be saved and merged.
+"""
+
+from itertools                     import islice
+from math                          import exp, log
+from os                            import path
+from numpy                         import array, zeros, uint8, uint64
+from numpy                         import int64, frombuffer, maximum, unique
+from numpy                         import where, savez, append
+from numpy                         import load as load_npz
+from numpy                         import char as np_char
+from pytadbit.parsers.pairs_parser import is_binary_pairs, iter_pairs_blocks
+from pytadbit.parsers.pairs_parser import read_pairs_header, iter_pairs_lines
+from pytadbit.parsers.pairs_parser import lines_to_block
+from pytadbit.utils.file_handling  import magic_open
+
+# columns defining duplicated pairs of reads (as in
+# :func:`pytadbit.mapping.filter.filter_reads`)
+DUPLICATE_COLUMNS = ('crm1', 'pos1', 'crm2', 'pos2', 'strand1', 'strand2')
+
+_SEED = uint64(0x9E3779B97F4A7C15)
+
+
+def _mix(hashes):
+    """
+    splitmix64 finalizer, scrambles the bits of an array of uint64
+    """
+    hashes = (hashes ^ (hashes >> uint64(30))) * uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> uint64(27))) * uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> uint64(31))
+
+
+def hash_strings(values):
+    """
+    Stable 64 bit hash of a list of strings.
+
+    :param values: list of strings
+
+    :returns: a NumPy array of uint64
+    """
+    values = array(values, dtype=str)
+    if not len(values):
+        return zeros(0, dtype=uint64)
+    lengths = np_char.str_len(values)
+    nwords = (lengths.max() + 7) / 8
+    words = frombuffer(values.astype('S%d' % (8 * nwords)).tostring(),
+                       dtype='<u8').reshape(-1, nwords)
+    hashes = zeros(len(values), dtype=uint64) + _SEED
+    # only words within each string are hashed, to get the same hash whatever
+    # the length of the longest string of the list
+    for i in xrange(nwords):
+        hashes = where(lengths > 8 * i, _mix(hashes ^ words[:, i]), hashes)
+    return _mix(hashes ^ lengths.astype(uint64))
+
+
+def hash_columns(columns):
+    """
+    Stable 64 bit hash of rows of integers.
+
+    :param columns: list of NumPy arrays of integers (all of the same size)
+
+    :returns: a NumPy array of uint64
+    """
+    hashes = zeros(len(columns[0]), dtype=uint64) + _SEED
+    for col in columns:
+        hashes = _mix(hashes ^ col.astype(uint64))
+    return hashes
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog sketch (Flajolet et al. 2007) to estimate the number of
+    distinct elements of a set. The relative error of the estimation is around
+    1.04 / sqrt(2**precision).
+
+    :param 16 precision: number of bits of the hash used to select a register
+       (the sketch uses 2**precision registers)
+    :param None registers: values of the registers (e.g. of a saved sketch)
+    :param 0 count: number of elements already added (counting repeated ones)
+    """
+    def __init__(self, precision=16, registers=None, count=0):
+        if not 4 <= precision <= 24:
+            raise ValueError('ERROR: precision should be between 4 and 24\n')
+        self.precision = precision
+        if registers is None:
+            registers = zeros(1 << precision, dtype=uint8)
+        self.registers = registers
+        self.count = count
+
+    def add_hashes(self, hashes):
+        """
+        :param hashes: NumPy array of 64 bit hashes (see :func:`hash_strings`
+           and :func:`hash_columns`)
+        """
+        if not len(hashes):
+            return
+        self.count += len(hashes)
+        nbits = 64 - self.precision
+        idx = (hashes >> uint64(nbits)).astype(int64)
+        rest = hashes & uint64((1 << nbits) - 1)
+        # position of the first bit set (from the left)
+        bit_len = zeros(len(rest), dtype=int64)
+        for shift in (32, 16, 8, 4, 2, 1):
+            big = rest >= uint64(1 << shift)
+            bit_len[big] += shift
+            rest[big] >>= uint64(shift)
+        bit_len += rest.astype(int64)
+        ranks = nbits - bit_len + 1
+        # maximum rank per register
+        keys = unique((idx << 6) | ranks)
+        idx = keys >> 6
+        last = append(idx[1:] != idx[:-1], True)
+        idx = idx[last]
+        self.registers[idx] = maximum(self.registers[idx], keys[last] & 63)
+
+    def add(self, values):
+        """
+        :param values: list of strings
+        """
+        self.add_hashes(hash_strings(values))
+
+    def merge(self, other):
+        """
+        Merge another sketch into this one (the result estimates the number of
+        distinct elements of the union of both sets).
+
+        :param other: a :class:`HyperLogLog` with the same precision
+
+        :returns: itself
+        """
+        if other.precision != self.precision:
+            raise ValueError('ERROR: sketches with different precisions\n')
+        self.registers = maximum(self.registers, other.registers)
+        self.count += other.count
+        return self
+
+    def copy(self):
+        return HyperLogLog(self.precision, self.registers.copy(), self.count)
+
+    def cardinality(self):
+        """
+        :returns: the estimated number of distinct elements
+        """
+        nregs = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / nregs)
+        estimate = alpha * nregs ** 2 / (2. ** -self.registers.astype(float)).sum()
+        empty = (self.registers == 0).sum()
+        # small cardinalities, linear counting
+        if estimate <= 2.5 * nregs and empty:
+            estimate = nregs * log(float(nregs) / empty)
+        return estimate
+
+    def __len__(self):
+        return int(self.cardinality() + 0.5)
+
+    @classmethod
+    def load(cls, fnam):
+        """
+        Load a sketch saved with :func:`HyperLogLog.save`
+
+        :param fnam: path to a NumPy (.npz) file
+        """
+        data = load_npz(fnam)
+        registers = data['registers']
+        count = int(data['count'])
+        data.close()
+        precision = len(registers).bit_length() - 1
+        return cls(precision, registers, count)
+
+    def save(self, fnam):
+        """
+        Save the sketch to a NumPy (.npz) file.
+
+        :param fnam: path to the output file
+        """
+        out = open(fnam, 'wb')
+        savez(out, registers=self.registers, count=self.count)
+        out.close()
+
+
+def sketch_fastq(fnam, nreads=None, prefix=50, precision=16, chunk=100000):
+    """
+    Sketch of the distinct reads of a FASTQ file, reads being identified by
+    the beginning of their sequence.
+
+    :param fnam: path to FASTQ file (can be compressed)
+    :param None nreads: number of reads to use (the first ones), all by
+       default
+    :param 50 prefix: number of nucleotides of each read used
+    :param 16 precision: precision of the sketch
+    :param 100000 chunk: number of reads processed at once
+
+    :returns: a :class:`HyperLogLog` sketch
+    """
+    sketch = HyperLogLog(precision)
+    fhandler = magic_open(fnam)
+    if nreads:
+        fhandler = islice(fhandler, 4 * nreads)
+    for lines in iter(lambda: list(islice(fhandler, 4 * chunk)), []):
+        sketch.add([l.rstrip('\n')[:prefix] for l in lines[1::4]])
+    return sketch
+
+
+def sketch_pairs(fnam, precision=16, chunk=100000):
+    """
+    Sketch of the distinct pairs of reads of a file generated by
+    :func:`pytadbit.mapping.get_intersection`, or by the filtering, in text or
+    binary format. Pairs of reads are identified as in the filter of
+    duplicates (see DUPLICATE_COLUMNS).
+
+    :param fnam: path to a file of pairs of reads
+    :param 16 precision: precision of the sketch
+    :param 100000 chunk: number of reads processed at once (text format)
+
+    :returns: a :class:`HyperLogLog` sketch
+    """
+    sketch = HyperLogLog(precision)
+    if is_binary_pairs(fnam):
+        blocks = iter_pairs_blocks(fnam, columns=DUPLICATE_COLUMNS)
+    else:
+        crm_idx = dict((c, i) for i, c in enumerate(read_pairs_header(fnam)[1]))
+        lines = iter_pairs_lines(fnam)
+        blocks = (lines_to_block(chunk_lines, crm_idx,
+                                 columns=DUPLICATE_COLUMNS)
+                  for chunk_lines in
+                  iter(lambda: list(islice(lines, chunk)), []))
+    for block in blocks:
+        sketch.add_hashes(hash_columns([block[c] for c in DUPLICATE_COLUMNS]))
+    return sketch
+
+
+def get_pairs_sketch(fnam, precision=16):
+    """
+    Sketch of the distinct pairs of reads of a file (see
+    :func:`sketch_pairs`). The sketch is stored next to the file (with the
+    extension .hll) and loaded instead of being computed for the next calls,
+    unless the file of reads is newer.
+
+    :param fnam: path to a file of pairs of reads
+    :param 16 precision: precision of the sketch
+
+    :returns: a :class:`HyperLogLog` sketch
+    """
+    sketch_fnam = fnam + '.hll'
+    if (path.exists(sketch_fnam) and
+        path.getmtime(sketch_fnam) >= path.getmtime(fnam)):
+        sketch = HyperLogLog.load(sketch_fnam)
+        if sketch.precision == precision:
+            return sketch
+    sketch = sketch_pairs(fnam, precision=precision)
+    try:
+        sketch.save(sketch_fnam)
+    except IOError:
+        pass
+    return sketch
+
+
+def library_complexity(nreads, ndistinct):
+    """
+    Estimates the size of the library (number of distinct molecules) from the
+    number of reads sequenced and the number of distinct reads, as in Picard
+    EstimateLibraryComplexity (reads being drawn uniformly from the molecules
+    of the library).
+
+    :param nreads: number of reads
+    :param ndistinct: number of distinct reads (e.g. estimated with
+       :func:`HyperLogLog.cardinality`)
+
+    :returns: a dictionary with the duplicate rate, the estimated number of
+       molecules in the library (None if no duplicate found), and the
+       saturation (proportion of the library already sequenced)
+    """
+    ndistinct = min(float(ndistinct), nreads)
+    stats = {'reads'         : nreads,
+             'distinct'      : ndistinct,
+             'duplicate rate': (1 - ndistinct / nreads) if nreads else 0.,
+             'library size'  : None,
+             'saturation'    : 0.}
+    if not nreads or ndistinct >= nreads:
+        return stats
+    # root of: ndistinct / size - 1 + exp(-nreads / size)
+    func = lambda size: ndistinct / size - 1 + exp(-nreads / size)
+    beg = 1.
+    end = 100.
+    while func(end * ndistinct) > 0:
+        end *= 10
+    for _ in xrange(40):
+        mid = (beg + end) / 2
+        if func(mid * ndistinct) > 0:
+            beg = mid
+        else:
+            end = mid
+    size = ndistinct * (beg + end) / 2
+    stats['library size'] = size
+    stats['saturation'] = ndistinct / size
+    return stats
+
+
+def expected_duplicate_rate(library_size, nreads):
+    """
+    :param library_size: number of molecules in the library (see
+       :func:`library_complexity`)
+    :param nreads: number of reads to be sequenced
+
+    :returns: the expected proportion of duplicated reads
+    """
+    if not library_size:
+        return 0.
+    return 1 - library_size * (1 - exp(-float(nreads) / library_size)) / nreads
@@ -51,6 +51,12 @@ matrix W of size N:
 
 """
 
+from numpy                  import ones, zeros, diff, repeat, arange, where
+from numpy                  import array, bincount, concatenate, cumsum, isnan
+from numpy                  import searchsorted
+from scipy.sparse           import diags
+from multiprocessing.pool   import ThreadPool
+
 def _update_S(W):
     S = {}
     meanS = 0.0
@@ -145,7 +151,178 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     return B
 
 
-def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
+def _row_blocks(W, n_blocks):
+    """
+    split a CSR matrix into blocks of consecutive rows with about the same
+    number of non-zero cells. Returns, for each block, the index of its first
+    row, the block itself and the (global) row index of each cell
+    """
+    bounds = [0]
+    for n in xrange(1, n_blocks):
+        bounds.append(int(W.indptr.searchsorted(W.nnz * n / n_blocks)))
+    bounds.append(W.shape[0])
+    blocks = []
+    for beg, end in zip(bounds[:-1], bounds[1:]):
+        if beg >= end:
+            continue
+        block = W[beg:end]
+        blocks.append((beg, block,
+                       repeat(arange(beg, end), diff(block.indptr))))
+    return blocks
+
+def _scale_and_sum(args):
+    """
+    divide the cells of a block of rows by the biases of their row and column
+    (if given) and return the sum of each row
+    """
+    (beg, block, rows), DB = args
+    if DB is not None:
+        block.data /= DB[rows] * DB[block.indices]
+    return beg, block.dot(ones(block.shape[1]))
+
+def iterative_sparse(hic_data, bads=None, iterations=0, max_dev=0.00001,
+                     verbose=False, n_cpus=1, log=None, **kwargs):
+    """
+    Implementation of iterative correction Imakaev 2012, vectorized over a
+    sparse matrix. Returns the same biases as
+    :func:`pytadbit.utils.normalize_hic.iterative`.
+
+    :param hic_data: HiC_data object (or SparseHiC_data) containing the
+       interaction data
+    :param None bads: dictionary with column not to be considered
+    :param 0 iterations: number of iterations to do (99 if a fully smoothed
+       matrix with no visibility differences between columns is desired)
+    :param 0.00001 max_dev: maximum difference allowed between a row and the
+       mean value of all raws
+    :param 1 n_cpus: number of threads used to rescale the matrix and compute
+       the sums of its rows
+    :param None log: path to a file where to write the convergence log (sum of
+       rows, minimum, mean and maximum and maximum deviation at each
+       iteration)
+    :returns: a vector of biases (length equal to the size of the matrix)
+    """
+    if verbose:
+        print 'iterative correction'
+    size = len(hic_data)
+    keep = ones(size)
+    if bads:
+        keep[[b for b in bads if b < size]] = 0.
+    if verbose:
+        print "  - copying matrix"
+    keep = diags(keep, 0)
+    W = (keep * hic_data.get_hic_data_as_csr() * keep).tocsr()
+    W.eliminate_zeros()
+    present = diff(W.indptr) > 0
+    nrows = present.sum()
+    if nrows == 0:
+        raise ZeroDivisionError('ERROR: normalization failed, all bad columns')
+    blocks = _row_blocks(W, n_cpus)
+    pool = ThreadPool(n_cpus) if n_cpus > 1 else None
+    mapper = pool.map if pool else map
+    if log:
+        log = open(log, 'w')
+        log.write('#iteration\tmin_sum\tmean_sum\tmax_sum\tmax_deviation\n')
+    if verbose:
+        print "  - computing baises"
+    B = ones(size)
+    DB = None
+    for it in xrange(iterations + 1):
+        S = zeros(size)
+        for beg, sums in mapper(_scale_and_sum, [(b, DB) for b in blocks]):
+            S[beg:beg + len(sums)] = sums
+        meanS = S[present].sum() / nrows
+        DB = S / meanS
+        B[present] *= DB[present]
+        if iterations == 0: # exit before, we do not need to update W
+            if log:
+                log.write('%d\t%f\t%f\t%f\tnan\n' % (
+                    it, S[present].min(), meanS, S[present].max()))
+            break
+        minS, maxS = S[present].min(), S[present].max()
+        dev = max(abs(minS  / meanS - 1), abs(maxS / meanS - 1))
+        if verbose:
+            print '   %15.3f %15.3f %15.3f %4s %9.5f' % (minS, meanS, maxS, it, dev)
+        if log:
+            log.write('%d\t%f\t%f\t%f\t%f\n' % (it, minS, meanS, maxS, dev))
+        if dev < max_dev:
+            break
+    if pool:
+        pool.close()
+    if log:
+        log.close()
+    B = where(present & (B != 0), B * meanS**.5, 1.)
+    return dict(enumerate(B.tolist()))
+
+
+def diagonal_sums(hic_data, bads=None, bias=None):
+    """
+    Sums interactions by distance to the diagonal, for each chromosome, in a
+    single pass over the non-zero cells of a HiC matrix.
+
+    Only the cells of the upper triangle are considered, and, as in
+    :func:`expected`, the cells (i, j) with i in bads are skipped. Cells with
+    NaN values are ignored.
+
+    :param hic_data: HiC_data object
+    :param None bads: dictionary with column not to be considered
+    :param None bias: dictionary of biases, if given, also sums interactions
+       normalized by the biases of their row and column
+
+    :returns: two dictionaries. The first one with, for each chromosome, the
+       raw sums ('raw'), the normalized sums ('norm', None without bias) and
+       the number of cells ('cells') at each distance, as arrays of the length
+       of the chromosome. The second one with the same values for all the
+       inter-chromosomal cells together
+    """
+    size = len(hic_data)
+    sections = sorted(hic_data.section_pos.items(), key=lambda x: x[1])
+    if not sections:
+        sections = [(None, (0, size))]
+    begs = array([b for _, (b, _) in sections])
+    ends = array([e for _, (_, e) in sections])
+    nsec = len(sections)
+    longest = int((ends - begs).max())
+
+    bad = zeros(size, dtype=bool)
+    bad[[b for b in (bads or {}) if b < size]] = True
+    rows, cols, vals = hic_data._coo()
+    keep = (cols >= rows) & (cols < size)
+    keep &= ~(bad[rows] | isnan(vals))
+    rows, cols, vals = rows[keep], cols[keep], vals[keep].astype(float)
+    if bias is not None:
+        bias = array([bias.get(i, 1.) for i in xrange(size)], dtype=float)
+        nvals = vals / (bias[rows] * bias[cols])
+    # chromosome of each cell (nsec if out of all chromosomes)
+    crm1 = searchsorted(ends, rows, side='right')
+    crm2 = searchsorted(ends, cols, side='right')
+    intra = (crm1 == crm2) & (crm1 < nsec)
+    inter = (crm1 != crm2) & (crm2 < nsec)
+    idx = crm1[intra] * longest + (cols - rows)[intra]
+    raw = bincount(idx, weights=vals[intra],
+                   minlength=nsec * longest).reshape(nsec, longest)
+    if bias is not None:
+        norm = bincount(idx, weights=nvals[intra],
+                        minlength=nsec * longest).reshape(nsec, longest)
+
+    # number of cells at each distance, from the valid rows
+    valid = concatenate(([0], cumsum(~bad)))
+    cis = {}
+    for num, (crm, (beg, end)) in enumerate(sections):
+        length = end - beg
+        cis[crm] = {
+            'raw'  : raw[num, :length],
+            'norm' : norm[num, :length] if bias is not None else None,
+            'cells': valid[end - arange(length)] - valid[beg]}
+    after = ends[-1] - ends
+    trans = {
+        'raw'  : vals[inter].sum(),
+        'norm' : nvals[inter].sum() if bias is not None else None,
+        'cells': int(((valid[ends] - valid[begs]) * after).sum())}
+    return cis, trans
+
+
+def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False,
+             normalized=False, per_chromosome=False, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
@@ -156,8 +333,13 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
        if not enough reads are observed at a given distance the observations
        of the distance+1 are summed. a signal to noise ratio of < 0.05
        corresponds to > 400 reads.
+    :param False normalized: use interactions normalized by the biases of the
+       HiC_data object
+    :param False per_chromosome: compute the expected values of each
+       chromosome separately
     
-    :returns: a vector of biases (length equal to the size of the matrix)
+    :returns: a dictionary of expected values by distance (or, if
+       per_chromosome, a dictionary of these dictionaries by chromosome)
     """
     min_n = signal_to_noise ** -2. # equals 400 when default
 
@@ -168,38 +350,62 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
     except AttributeError:
         pass
 
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
+    cis, _ = hic_data.diagonal_sums(bads=bads or {}, normalized=normalized)
+    key = 'norm' if normalized else 'raw'
+    if per_chromosome:
+        return dict((crm, _group_distances(cis[crm][key], cis[crm]['cells'],
+                                           len(cis[crm][key]), min_n))
+                    for crm in cis)
+    sums = zeros(size + 1)
+    cells = zeros(size + 1)
+    for crm in cis:
+        length = min(len(cis[crm][key]), size + 1)
+        sums[:length] += cis[crm][key][:length]
+        cells[:length] += cis[crm]['cells'][:length]
+    return _group_distances(sums, cells, size, min_n)
+
 
+def _group_distances(sums, cells, size, min_n):
+    """
+    Averages interactions by distance, summing consecutive distances until
+    min_n interactions are observed.
+    """
+    sums = sums.tolist() + [0.] * (size + 1 - len(sums))
+    cells = cells.tolist() + [0] * (size + 1 - len(cells))
     expc = {}
     dist = 0
     while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
-        for dist in range(dist, new_dist + 1):
+        sum_diag = n_diag = 0
+        last = dist
+        while True:
+            sum_diag += sums[last]
+            n_diag += cells[last]
+            if not n_diag:
+                val = 0.
+                break
+            if sum_diag > min_n or last >= size:
+                val = float(sum_diag) / n_diag
+                break
+            last += 1
+        for dist in xrange(dist, last + 2):
             expc[dist] = val
+        dist = last + 1
     return expc
 
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
-    if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in xrange(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in xrange(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if len(diag) == 0:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    elif dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
-    else:
-        return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
+
+def trans_expected(hic_data, bads=None, normalized=False):
+    """
+    Computes the expected value of inter-chromosomal interactions, as the
+    mean of all the inter-chromosomal cells of a HiC matrix.
+
+    :param hic_data: HiC_data object
+    :param None bads: dictionary with column not to be considered
+    :param False normalized: use interactions normalized by the biases of the
+       HiC_data object
+
+    :returns: the mean inter-chromosomal interaction (0 if none)
+    """
+    _, trans = hic_data.diagonal_sums(bads=bads or {}, normalized=normalized)
+    if not trans['cells']:
+        return 0.
+    return float(trans['norm' if normalized else 'raw']) / trans['cells']
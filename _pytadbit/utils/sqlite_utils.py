@@ -48,7 +48,11 @@ def delete_entries(cur, table, col, val):
     except lite.OperationalError:
         pass
 
-def already_run(opts):
+def already_run(opts, extra=None):
+    """
+    :param None extra: extra parameter to remove from digestion (see
+       :func:`digest_parameters`)
+    """
     if 'tmpdb' in opts and 'tmp' in opts and opts.tmp and opts.tmpdb:
         dbpath = opts.tmpdb
     else:
@@ -58,7 +62,7 @@ def already_run(opts):
         with con:
             # check if table exists
             cur = con.cursor()
-            param_hash = digest_parameters(opts, get_md5=True)
+            param_hash = digest_parameters(opts, get_md5=True, extra=extra)
             cur.execute("select * from JOBs where Parameters_md5 = '%s'" % param_hash)
             found = len(cur.fetchall()) == 1
             if found:
@@ -34,6 +34,37 @@ def right_double_mad(arr):
     right_mad = np.median(np.abs(arr[arr >  med] - med))
     return right_mad
 
+def hist_percentile(values, counts, perc):
+    """
+    Percentile of a sample given as a histogram (same as numpy.percentile,
+    with linear interpolation, on the whole sample).
+
+    :param values: sorted array of values
+    :param counts: number of times each value is found in the sample
+    :param perc: percentile (between 0 and 100)
+    """
+    cumul = np.cumsum(counts)
+    index = perc / 100. * (cumul[-1] - 1)
+    below = int(index)
+    weight = index - below
+    lower = values[np.searchsorted(cumul, below, side='right')]
+    upper = values[np.searchsorted(cumul, min(below + 1, cumul[-1] - 1),
+                                   side='right')]
+    return lower * (1 - weight) + upper * weight
+
+def hist_right_double_mad(values, counts):
+    """
+    Same as :func:`right_double_mad` for a sample given as a histogram.
+
+    :param values: sorted array of values
+    :param counts: number of times each value is found in the sample
+    """
+    med = hist_percentile(values, counts, 50)
+    right = (values > med) & (counts > 0)
+    if not right.any():
+        return np.nan
+    return hist_percentile(values[right] - med, counts[right], 50)
+
 def newton_raphson (guess, contour, sq_length, jmax=2000, xacc=1e-12):
     """
     Newton-Raphson method as defined in:
@@ -0,0 +1,77 @@
+"""
+17 Oct 2026
+
+Benchmark of the segmentation by windows: compares boundaries and running time
+of TADbit run on overlapping windows to the result of TADbit run on the full
+chromosome.
+
+usage: python benchmark_windowed_tadbit.py [n_cpus]
+"""
+
+from pytadbit  import tadbit
+from os        import path
+from sys       import argv
+from time      import time
+from numpy     import zeros, loadtxt, matrix
+
+
+# test data of the package
+PATH = path.abspath(path.join(path.split(path.realpath(__file__))[0],
+                              '..', 'test'))
+
+
+def load_chromosome(copies=4):
+    """
+    Builds a longer chromosome by placing the test matrices along the diagonal
+    """
+    fnams = [path.join(PATH, '20Kb', 'chrT', 'chrT_%s.tsv' % c)
+             for c in 'BCD']
+    mats = [loadtxt(fnam, skiprows=1, usecols=range(1, 101)) for fnam in fnams]
+    mats = [mats[i % len(mats)] for i in xrange(copies)]
+    size = sum(len(m) for m in mats)
+    chrom = zeros((size, size), dtype=int)
+    pos = 0
+    for mat in mats:
+        chrom[pos:pos + len(mat), pos:pos + len(mat)] = mat
+        pos += len(mat)
+    return matrix(chrom)
+
+
+def agreement(ref, new, dist=1):
+    """
+    Proportion of reference boundaries found within dist bins
+    """
+    return float(sum(1 for b in ref if any(abs(b - n) <= dist for n in new))
+                 ) / (len(ref) or 1)
+
+
+def run(chrom, n_cpus, **kwargs):
+    tic = time()
+    result = tadbit(chrom, n_cpus=n_cpus, verbose=False, **kwargs)
+    return result['end'][:-1], time() - tic
+
+
+def main():
+    n_cpus = int(argv[1]) if len(argv) > 1 else 1
+    print ('{:<12}{:>6}{:>10}{:>8}{:>11}{:>11}{:>10}').format(
+        'matrix', 'bins', 'window', 'max', 'time (s)', 'boundaries',
+        'recall')
+    for name, chrom, max_tad_size in [
+        ('chrT_B', path.join(PATH, '20Kb', 'chrT', 'chrT_B.tsv'), 20),
+        ('chrT_A', path.join(PATH, '40Kb', 'chrT', 'chrT_A.tsv'), 20),
+        ('chrT_BCDB', load_chromosome(), 30)]:
+        full, full_time = run(chrom, n_cpus, max_tad_size=max_tad_size)
+        size = None if isinstance(chrom, str) else len(chrom)
+        print ('{:<12}{:>6}{:>10}{:>8}{:>11.2f}{:>11}{:>10}').format(
+            name, size or '', 'full', max_tad_size, full_time, len(full), '')
+        for window in (2 * max_tad_size, 3 * max_tad_size,
+                       4 * max_tad_size):
+            wind, wind_time = run(chrom, n_cpus, max_tad_size=max_tad_size,
+                                  window=window)
+            print ('{:<12}{:>6}{:>10}{:>8}{:>11.2f}{:>11}{:>10.2f}').format(
+                '', '', window, max_tad_size, wind_time, len(wind),
+                agreement(full, wind))
+
+
+if __name__ == "__main__":
+    exit(main())
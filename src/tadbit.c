@@ -1233,3 +1233,961 @@ tadbit
    return;
 
 }
+
+
+// Banded version of the segmentation. The interactions are given as the
+// 'D'+1 first diagonals of the upper triangular part of the matrix, once
+// removed the filtered rows/columns, one after the other (the interaction
+// between 'i' and 'i+d' is at position 'i+d*n'). TADs are at most 'D' bins
+// long, so that the interactions further than 'D' bins only enter the
+// log-likelihoods through the blocks above and below the TADs, where they
+// are summarized by column (see 'll_band'). The memory used for the
+// observations, the log-likelihoods and the jobs is proportional to
+// 'n*(D+1)' instead of 'n*n'.
+
+#define BAND(i, j, n) ((i) < (j) ? (i)+((j)-(i))*(n) : (j)+((i)-(j))*(n))
+
+void
+fg_band(
+  // input //
+  const int    n,
+  const int    D,
+  const int    i_,
+  const int    _i,
+  const int    j_,
+  const int    _j,
+  const int    diag,
+  const int    *k,
+  const int    *dp,
+  const double *w,
+  const double a,
+  const double b,
+  const double da,
+  const double db,
+  const int    nc,
+  const double ksum,
+  const double kdsum,
+        double *c,
+  // output //
+        double *f,
+        double *g
+){
+// SYNOPSIS:                                                            
+//   Same as 'fg' for banded data (see 'll_band'). 'ksum' and 'kdsum'   
+//   are the sums of the counts, and of the counts times the log of     
+//   the distance, of the cells of the block out of the band.           
+//                                                                      
+
+   // See the comment about 'tmp' in 'fg'.
+   long double tmp;
+   int i;
+   int j;
+   int i_high;
+   int j_low = diag ? j_+1 : j_;
+   int j_high = _j+1;
+   int index;
+
+   *f = 0.0; *g = 0.0;
+   // Initialize cache.
+   for (index = 0 ; index < nc ; index++) c[index] = NAN;
+
+   for (j = j_low ; j < j_high ; j++) {
+      i_high = diag ? j : _i+1;
+      for (i = i_ ; i < i_high ; i++) {
+         // Retrieve value of the exponential from cache.
+         index = abs(dp[i]-dp[j]);
+         if (c[index] != c[index]) {
+            c[index] = exp(a+da+(b+db)*fastlog(index));
+         }
+         tmp  =  w[i]*w[j] * c[index];
+         if (abs(i-j) <= D) tmp -= k[BAND(i, j, n)];
+         *f  +=  tmp;
+         *g  +=  tmp * fastlog(index);
+      }
+   }
+   *f -= ksum;
+   *g -= kdsum;
+
+   return;
+
+}
+
+double
+ll_band(
+  const int    n,
+  const int    D,
+  const int    i_,
+  const int    _i,
+  const int    j_,
+  const int    _j,
+  const int    diag,
+  const int    *k,
+  const int    *dp,
+  const double *w,
+  const double *lg,
+  const double *off,
+        double *c
+){
+// SYNOPSIS:                                                            
+//   Same as 'll' for banded data. Counts are only stored for the cells 
+//   (i,j) with 'abs(i-j) <= D'. The other cells of the block (above or 
+//   below a TAD of at most 'D' bins) are all the cells further than 'D'
+//   from the columns of the block: their counts enter the likelihood   
+//   through their sums by column in 'off'.                             
+//                                                                      
+// ARGUMENTS:                                                           
+//   'D': number of diagonals (above the main one) in the band.         
+//   'k': raw hiC counts, the interaction between 'i' and 'j' being     
+//      at 'BAND(i, j, n)'.                                             
+//   'lg': log-gamma terms (same layout as 'k').                        
+//   'off': cumulative sums by column of the counts, of the counts      
+//      times the log of the distance, and of the log-gamma terms of    
+//      the cells above the band, followed by the same for the cells    
+//      below the band (6 arrays of 'n'+1 values).                      
+//   See the function 'll' for the other arguments.                     
+//                                                                      
+// RETURN:                                                              
+//   The maximum log-likelihood of a block of hiC data.                 
+//                                                                      
+
+   if ((i_ >= _i) || (j_ >= _j)) return 0.0;
+   if ((_i < i_+2) || (_j < j_+2)) return NAN;
+
+   // Sums of the cells out of the band (none in the diagonal block).
+   double ksum = 0.0;
+   double kdsum = 0.0;
+   double lgsum = 0.0;
+   if (!diag) {
+      const double *o = off + (_i < j_ ? 0 : 3*(n+1));
+      ksum  = o[_j+1] - o[j_];
+      kdsum = o[n+1+_j+1] - o[n+1+j_];
+      lgsum = o[2*(n+1)+_j+1] - o[2*(n+1)+j_];
+   }
+   // Size of the cache (largest distance in the block).
+   const int nc = (dp[_i] > dp[_j] ? dp[_i] : dp[_j]) -
+                  (dp[i_] < dp[j_] ? dp[i_] : dp[j_]) + 1;
+
+   int i;
+   int j;
+   int i_high;
+   int j_low = diag ? j_+1 : j_;
+   int j_high = _j+1;
+   int index;
+   int iter = 0;
+   double denom;
+   double oldgrad;
+   double f = INFINITY;
+   double g = INFINITY;
+   double a = 0.0;
+   double b = 0.0;
+   double da = 0.0;
+   double db = 0.0;
+   double dfda = 0.0;
+   double dfdb = 0.0;
+   double dgda = 0.0;
+   double dgdb = 0.0;
+   // See the comment about 'tmp' in 'fg'.
+   long double tmp;
+
+   fg_band(n, D, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, nc, ksum,
+           kdsum, c, &f, &g);
+
+   // Newton-Raphson until gradient function is less than TOLERANCE.
+   while ((oldgrad = f*f + g*g) > TOLERANCE && iter++ < MAXITER) {
+
+      for (index = 0 ; index < nc ; index++) c[index] = NAN;
+      // Compute the derivatives.
+      dfda = dfdb = dgda = dgdb = 0.0;
+
+      for (j = j_low ; j < j_high ; j++) {
+         i_high = diag ? j : _i+1;
+         for (i = i_ ; i < i_high ; i++) {
+            index = abs(dp[i]-dp[j]);
+            if (c[index] != c[index]) {
+               c[index] = exp(a+b*fastlog(index));
+            }
+            tmp   =   w[i]*w[j] * c[index];
+            dfda +=   tmp;
+            tmp  *=   fastlog(index);
+            dgda +=   tmp;
+            tmp  *=   fastlog(index);
+            dgdb +=   tmp;
+         }
+      }
+      dfdb = dgda;
+
+      denom = dfdb*dgda - dfda*dgdb;
+      da = (f*dgdb - g*dfdb) / denom;
+      db = (g*dfda - f*dgda) / denom;
+
+      fg_band(n, D, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, nc, ksum,
+              kdsum, c, &f, &g);
+
+      // Traceback if we are not going down the gradient.
+      for (i = 0 ; (i < 20) && (f*f + g*g > oldgrad) ; i++) {
+         da /= 2;
+         db /= 2;
+         fg_band(n, D, i_, _i, j_, _j, diag, k, dp, w, a, b, da, db, nc,
+                 ksum, kdsum, c, &f, &g);
+      }
+
+      // Update 'a' and 'b'.
+      a += da;
+      b += db;
+
+   }
+
+   if (iter >= MAXITER) {
+      // Something probably went wrong. Return NAN.
+      return NAN;
+   }
+
+   // Compute log-likelihood (the last call to 'fg_band' has set the
+   // cache to the right values).
+   double llik = 0.0;
+   for (j = j_low ; j < j_high ; j++) {
+      i_high = diag ? j : _i+1;
+      for (i = i_ ; i < i_high ; i++) {
+         index = abs(dp[i]-dp[j]);
+         llik += c[index];
+         if (abs(i-j) <= D)
+            llik += k[BAND(i, j, n)]*(a+b*fastlog(index)) -
+                    lg[BAND(i, j, n)];
+      }
+   }
+   llik += ksum*a + kdsum*b - lgsum;
+
+   return llik;
+
+}
+
+void *
+fill_DP_band(
+  void *arg
+){
+// SYNOPSIS:                                                            
+//   Same as 'fill_DP' for banded log-likelihoods. Instead of the list  
+//   of breakpoints of every end point, only the last breakpoint is     
+//   recorded (see 'DPwalk_band').                                      
+//                                                                      
+
+   dpbandworker_arg *myargs = (dpbandworker_arg *) arg;
+   const int n = myargs->n;
+   const int D = myargs->D;
+   const double *llikmat = (const double *) myargs->llikmat;
+   double *old_llik = (double *) myargs->old_llik;
+   double *new_llik = (double *) myargs->new_llik;
+   const int nbreaks = myargs->nbreaks;
+   int *back = (int *) myargs->back;
+
+   int i;
+   int i0;
+
+   while (1) {
+      pthread_mutex_lock(&tadbit_lock);
+      if (taskQ_i > n-1) {
+         // Task queue is empty. Exit loop and return
+         pthread_mutex_unlock(&tadbit_lock);
+         break;
+      }
+      // A task gives an end point 'j'.
+      int j = taskQ_i;
+      taskQ_i++;
+      pthread_mutex_unlock(&tadbit_lock);
+
+      new_llik[j] = -INFINITY;
+      int new_bkpt = -1;
+
+      // Cycle over start point 'i' (within the band).
+      i0 = 3 * nbreaks > j-D ? 3 * nbreaks : j-D;
+      for (i = i0 ; i < j-3 ; i++) {
+
+         // If NAN the following condition evaluates to false.
+         double tmp = old_llik[i-1] + llikmat[i+(j-i)*n];
+         if (tmp > new_llik[j]) {
+            new_llik[j] = tmp;
+            new_bkpt = i-1;
+         }
+      }
+
+      // If the log-lik is undefined, the breakpoints of 'j' are the ones
+      // of the previous number of breaks.
+      back[j] = new_llik[j] > -INFINITY ? new_bkpt : -2;
+   }
+
+   return NULL;
+
+}
+
+void
+DPwalk_band(
+  // input //
+  const double *llikmat,
+  const int n,
+  const int D,
+  const int MAXBREAKS,
+  int n_threads,
+  // output //
+  double *mllik,
+  int *back
+){
+// SYNOPSIS:                                                            
+//   Same as 'DPwalk' for banded log-likelihoods ('llikmat[i+(j-i)*n]'  
+//   is the log-likelihood of the slice from 'i' to 'j').               
+//                                                                      
+// PARAMETERS:                                                          
+//        -- output arguments --                                        
+//   '*mllik': maximum log-likelihood of the segmentations.             
+//   '*back': 'n' x 'MAXBREAKS' array with, for each number of breaks   
+//      and end point, the last breakpoint (-2 if it is the same as     
+//      with one break less). Breakpoints are obtained with             
+//      'DP_breakpoints'.                                               
+//                                                                      
+
+   int i;
+   int nbreaks;
+
+   double *new_llik = (double *) malloc(n * sizeof(double));
+   double *old_llik = (double *) malloc(n * sizeof(double));
+
+   for (i = 0 ; i < n*MAXBREAKS ; i++) back[i] = -2;
+
+   for (i = 0 ; i < MAXBREAKS ; i++) {
+      mllik[i] = NAN;
+   }
+
+   // Initialize 'old_llik' to the log-likelihood of segments starting
+   // at index 0.
+   for (i = 0 ; i < n ; i++) {
+      old_llik[i] = i <= D ? llikmat[i*n] : NAN;
+      new_llik[i] = -INFINITY;
+   }
+
+   int err = pthread_mutex_init(&tadbit_lock, NULL);
+   if (err) {
+      fprintf(stderr, "error initializing mutex (%d)\n", err);
+      free(new_llik);
+      free(old_llik);
+      return;
+   }
+
+   dpbandworker_arg arg = {
+      .n = n,
+      .D = D,
+      .llikmat = llikmat,
+      .old_llik = old_llik,
+      .new_llik = new_llik,
+      .nbreaks = 1,
+      .back = back,
+   };
+
+   pthread_t *tid = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
+
+   // Dynamic programming.
+   for (nbreaks = 1 ; nbreaks < MAXBREAKS ; nbreaks++) {
+
+      arg.nbreaks = nbreaks;
+      arg.back = back + nbreaks*n;
+      taskQ_i = 3 * nbreaks + 2;
+
+      for (i = 0 ; i < n_threads ; i++) tid[i] = 0;
+      for (i = 0 ; i < n_threads ; i++) {
+         err = pthread_create(&(tid[i]), NULL, &fill_DP_band, &arg);
+         if (err) {
+            fprintf(stderr, "error creating thread (%d)\n", err);
+            return;
+         }
+      }
+
+      // Wait for threads to return.
+      for (i = 0 ; i < n_threads ; i++) {
+         pthread_join(tid[i], NULL);
+      }
+
+      // Update full log-likelihoods.
+      mllik[nbreaks] = new_llik[n-1];
+
+      for (i = 0 ; i < n ; i++) {
+         old_llik[i] = new_llik[i];
+      }
+   }
+
+   free(tid);
+   free(new_llik);
+   free(old_llik);
+
+   return;
+
+}
+
+void
+DP_breakpoints(
+  const int *back,
+  const int n,
+  int nbreaks,
+  int *bkpts
+){
+// SYNOPSIS:                                                            
+//   Breakpoints of the segmentation with 'nbreaks' breaks found by     
+//   'DPwalk_band'.                                                     
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'bkpts' in place (1 if there is a breakpoint at that        
+//   location).                                                         
+//                                                                      
+
+   int i;
+   int j = n-1;
+
+   for (i = 0 ; i < n ; i++) bkpts[i] = 0;
+   for ( ; nbreaks > 0 ; nbreaks--) {
+      if (back[j+nbreaks*n] == -2) continue;
+      j = back[j+nbreaks*n];
+      bkpts[j] = 1;
+   }
+
+}
+
+void *
+fill_llikmat_band(
+   void *arg
+){
+// SYNOPSIS:                                                            
+//   Same as 'fill_llikmat' for banded data. The element (i,j) of       
+//   'llikmat' is at position 'i+(j-i)*n'.                              
+//                                                                      
+
+   llbandworker_arg *myargs = (llbandworker_arg *) arg;
+   const int n = myargs->n;
+   const int D = myargs->D;
+   const int m = myargs->m;
+   const int **k = (const int **) myargs->k;
+   const int *dp = (const int*) myargs->dp;
+   const double **w = (const double **) myargs->w;
+   const double **lg= (const double **) myargs->lg;
+   const double **off= (const double **) myargs->off;
+   const char *skip = (const char *) myargs->skip;
+   double *llikmat = myargs->llikmat;
+   const int verbose = myargs->verbose;
+   const int nD = n*(D+1);
+
+   int i;
+   int j;
+   int l;
+
+   double *c= (double *) malloc(_max_cache_index * sizeof(double));
+   for (i = 0 ; i < _max_cache_index ; i++) c[i] = 0.0;
+
+   int job_index;
+
+   // Break out of the loop when task queue is empty.
+   while (1) {
+
+      pthread_mutex_lock(&tadbit_lock);
+      while ((taskQ_i < nD) && (skip[taskQ_i] > 0)) {
+         // Fast forward to the next job.
+         taskQ_i++;
+      }
+      if (taskQ_i >= nD) {
+         // Task queue is empty. Exit loop and return
+         pthread_mutex_unlock(&tadbit_lock);
+         break;
+      }
+      job_index = taskQ_i;
+      taskQ_i++;
+      pthread_mutex_unlock(&tadbit_lock);
+
+      // Compute the log-likelihood of slice '(i,j)'.
+      i = job_index % n;
+      j = i + job_index / n;
+
+      // Make sure that slices have minimum width 3.
+      int cornered = (i == 1) || (i == 2) || (j == n-2) || (j == n-3);
+      int slice_too_thin = (j-i) < 2;
+      if (cornered || slice_too_thin) continue;
+
+      // Distinct parts of the array, no lock needed.
+      llikmat[job_index] = 0.0;
+      for (l = 0 ; l < m ; l++) {
+         llikmat[job_index] +=
+            ll_band(n, D,   0, i-1, i, j, 0, k[l], dp, w[l], lg[l], off[l],
+                    c) / 2 +
+            ll_band(n, D,   i,   j, i, j, 1, k[l], dp, w[l], lg[l], off[l],
+                    c) +
+            ll_band(n, D, j+1, n-1, i, j, 0, k[l], dp, w[l], lg[l], off[l],
+                    c) / 2;
+      }
+
+      n_processed++;
+      if (verbose) {
+         fprintf(stderr, "computing likelihood (%0.f%% done)\r",
+            99 * n_processed / (float) n_to_process);
+      }
+   }
+
+   free(c);
+   return NULL;
+
+}
+
+void
+allocate_band_job(
+  char *skip,
+  const int i,
+  const int j,
+  const int n,
+  const int D
+){
+// SYNOPSIS:                                                            
+//   Create a thread job for the slice ('i', 'j') if it is in the       
+//   upper triangular part of the band.                                 
+//                                                                      
+
+   if ((i >= 0) && (i < j) && (j < n) && (j-i <= D)) skip[i+(j-i)*n] = 0;
+
+}
+
+void
+allocate_new_jobs_band(
+  char *skip,
+  const int *back,
+  const int nlevels,
+  const int nbreaks_opt,
+  const int n,
+  const int D
+){
+// SYNOPSIS:                                                            
+//   Same as 'allocate_new_jobs' for banded data, breakpoints being     
+//   given by 'DPwalk_band' for 'nlevels' numbers of breaks.            
+//                                                                      
+
+   int i;
+   int j;
+   int i0;
+   int j0;
+   int shift;
+   char *starts = (char*) malloc(n* sizeof(char));
+   char *ends = (char*) malloc(n* sizeof(char));
+   int *bkpts = (int *) malloc(n * sizeof(int));
+   for (i = 0 ; i < n ; i++) {
+      starts[i] = 0;
+      ends[i] = 0;
+   }
+
+   for (shift = -10 ; shift < 11 ; shift++) {
+      if (shift+nbreaks_opt < 0) continue;
+      if (shift+nbreaks_opt > nlevels-1) break;
+      DP_breakpoints(back, n, shift+nbreaks_opt, bkpts);
+      for (i0 = 0, j0 = 0 ; j0 < n ; j0++) {
+         if (bkpts[j0]) {
+
+            // Jobs for splitting the TAD.
+            for (j = i0 ; j < j0 ; j++)
+               allocate_band_job(skip, i0, j, n, D);
+            for (i = i0 ; i < j0 ; i++)
+               allocate_band_job(skip, i, j0, n, D);
+
+            starts[i0] = 1;
+            ends[j0] = 1;
+            i0 = j0+1;
+         }
+      }
+   }
+
+   // Jobs for merging the TADs.
+   for (i = 0 ; i < n ; i++)
+   for (j = i+1 ; j < n && j-i < 500 ; j++)
+      if (starts[i] && ends[j])
+         allocate_band_job(skip, i, j, n, D);
+
+   free(starts);
+   free(ends);
+   free(bkpts);
+
+}
+
+void
+tadbit_band
+(
+  // input //
+  int **obs,
+  int **offobs,
+  const int *noff,
+  char *remove,
+  int N,
+  int D,
+  const int m,
+  int n_threads,
+  const int verbose,
+  int max_tad_size,
+  const int nbrks,
+  const int do_not_use_heuristic,
+  // output //
+  tadbit_output *seg
+)
+// SYNOPSIS:                                                            
+//   Same as 'tadbit' for banded data.                                  
+//                                                                      
+// ARGUMENTS:                                                           
+//   'obs': (m) arrays with the 'D'+1 first diagonals of the matrices,  
+//      without the removed rows/columns (the interaction between 'i'   
+//      and 'i+d' is at 'obs[k][i+d*n]', 'n' being the number of rows   
+//      not removed). Data are supposed to be symmetric.                
+//   'offobs': (m) arrays with the interactions further than 'D' (in    
+//      the same referential), as triplets of row, column and count     
+//      of the upper triangular part of the matrices.                   
+//   'noff': (m) number of triplets in each array of 'offobs'.          
+//   'remove': (N) rows/columns removed.                                
+//   'N': number of rows/columns of the matrices.                       
+//   'D': number of diagonals (above the main one) in 'obs'.            
+//                                                                      
+// SIDE-EFFECTS:                                                        
+//   Update 'seg'. Only the breakpoints of the optimal segmentation     
+//   are returned (in 'bkpts'), and 'llikmat' is not returned.          
+//                                                                      
+{
+
+   // Get thread number if set to 0 (max).
+   if (n_threads < 1) {
+      #ifdef _SC_NPROCESSORS_ONLN
+         n_threads = (int) sysconf(_SC_NPROCESSORS_ONLN);
+      #else
+         n_threads = 1;
+      #endif
+   }
+
+   int n = N;
+   int err;
+
+   int i;
+   int j;
+   int d;
+   int k;
+   int l;
+   int i0;
+
+   for (i = 0 ; i < N ; i++) {
+      n -= remove[i];
+   }
+
+   fastlog_init(16);
+
+   // Exit if there are too few rows/columns after removal.
+   if (n < 6) {
+      // Signal failure.
+      seg->maxbreaks = -1;
+      free(remove);
+      return;
+   }
+
+   // Only the first diagonals are read (the layout does not change).
+   if (D > n-1) D = n-1;
+   if (max_tad_size > D) max_tad_size = D;
+
+   const int MAXBREAKS = n/5;
+   const int nD = n*(D+1);
+
+   _max_cache_index = N+1;
+   int *dp = (int *) malloc(n * sizeof(int));
+   for (i0 = 0, j = 0 ; j < N ; j++) {
+      if (!remove[j]) {
+         dp[i0] = j;
+         i0++;
+      }
+   }
+   double **log_gamma = (double **) malloc(m * sizeof(double *));
+   for (k = 0 ; k < m ; k++) {
+      log_gamma[k] = (double *) malloc(nD * sizeof(double));
+      for (l = 0 ; l < nD ; l++) log_gamma[k][l] = lgamma(obs[k][l]+1);
+   }
+
+   // Compute row/column sums (identical by symmetry), and the sums by
+   // column of the interactions out of the band, above and below it
+   // (see 'll_band'), then made cumulative.
+   double **rowsums = (double **) malloc(m * sizeof(double *));
+   double **offsums = (double **) malloc(m * sizeof(double *));
+   for (k = 0 ; k < m ; k++) {
+      rowsums[k] = (double *) malloc(n * sizeof(double));
+      for (i = 0 ; i < n ; i++) {
+         rowsums[k][i] = 0.0;
+         for (j = i-D > 0 ? i-D : 0 ; j < n && j <= i+D ; j++)
+            rowsums[k][i] += obs[k][BAND(i, j, n)];
+      }
+      offsums[k] = (double *) malloc(6*(n+1) * sizeof(double));
+      for (l = 0 ; l < 6*(n+1) ; l++) offsums[k][l] = 0.0;
+      for (l = 0 ; l < noff[k] ; l++) {
+         i = offobs[k][3*l];
+         j = offobs[k][3*l+1];
+         d = offobs[k][3*l+2];
+         if (j-i <= D) continue;
+         rowsums[k][i] += d;
+         rowsums[k][j] += d;
+         double kd = d * fastlog(abs(dp[j]-dp[i]));
+         double lgd = lgamma(d+1);
+         // Above the band in column 'j', below the band in column 'i'.
+         offsums[k][j+1] += d;
+         offsums[k][n+1+j+1] += kd;
+         offsums[k][2*(n+1)+j+1] += lgd;
+         offsums[k][3*(n+1)+i+1] += d;
+         offsums[k][4*(n+1)+i+1] += kd;
+         offsums[k][5*(n+1)+i+1] += lgd;
+      }
+      for (l = 0 ; l < 6 ; l++)
+      for (i = 0 ; i < n ; i++)
+         offsums[k][l*(n+1)+i+1] += offsums[k][l*(n+1)+i];
+   }
+
+   double *mllik = (double *) malloc(MAXBREAKS * sizeof(double));
+   int *back = (int *) malloc(MAXBREAKS*n * sizeof(int));
+   int *bkpts = (int *) malloc(n * sizeof(int));
+   double *llikmat = (double *) malloc(nD * sizeof(double));
+   for (i = 0 ; i < nD ; i++)
+      llikmat[i] = NAN;
+
+   // 'skip' will contain only 0 or 1 and can be stored as 'char'.
+   char *skip = (char *) malloc(nD * sizeof(char));
+   for (i = 0 ; i < nD ; i++) skip[i] = 1;
+
+   if (do_not_use_heuristic) {
+      for (d = 1 ; d <= max_tad_size ; d++)
+      for (i = 0 ; i < n-d ; i++)
+         skip[i+d*n] = 0;
+   }
+   else {
+      if (verbose) {
+         fprintf(stderr, "running pre-heuristic\n");
+      }
+
+      // 'S[i+d*n]' is the weighted sum of reads within the triangle
+      // defined by ('i','i+d') in the band.
+      double *S = (double *) malloc(nD * sizeof(double));
+      for (i = 0 ; i < nD ; i++) S[i] = 0.0;
+      for (d = 1 ; d <= D ; d++) {
+      for (i = 0 ; i < n-d ; i++) {
+         double weighted_value = 0.0;
+         for (l = 0 ; l < m ; l++) {
+            weighted_value += obs[l][i+d*n]/(rowsums[l][i]*rowsums[l][i+d]);
+         }
+         S[i+d*n] = S[i+(d-1)*n] + S[i+1+(d-1)*n] -
+            (d > 1 ? S[i+1+(d-2)*n] : 0.0) + weighted_value;
+      }
+      }
+
+      double *heur_score = (double *) malloc(nD * sizeof(double));
+      for (i = 0 ; i < nD ; i++) heur_score[i] = NAN;
+      for (d = 1 ; d <= D ; d++)
+      for (i = 0 ; i < n-d ; i++)
+         heur_score[i+d*n] = log(S[i+d*n]);
+
+      // Use dynamic programming to find approximate break points.
+      DPwalk_band(heur_score, n, D, MAXBREAKS, n_threads, mllik, back);
+
+      free(heur_score);
+      free(S);
+
+      // Create a thread job for each approximate TAD.
+      for (j = 1 ; j < MAXBREAKS ; j++) {
+         DP_breakpoints(back, n, j, bkpts);
+         i0 = 0;
+         for (i = 0 ; i < n ; i++) {
+            if (bkpts[i]) {
+               for (d = i-2 ; d < i+3 ; d++)
+               for (l = i0-2 ; l < i0+3 ; l++)
+                  allocate_band_job(skip, l, d, n, D);
+               i0 = i+1;
+            }
+         }
+      }
+
+      // Allocate estimation of the log likelihood for all small
+      // TADs (less than 3 bins).
+      for (j = 6 ; j < n ; j++)
+      for (i = j-6 ; i < j-3 ; i++)
+         allocate_band_job(skip, i, j, n, D);
+
+      // Allocate jobs at the ends of the chromosomes/units because
+      // these regions are a bit noisier.
+      for (j = 1 ; j < 51 ; j++)
+      for (i = 0 ; i < j-3 ; i++)
+         allocate_band_job(skip, i, j, n, D);
+      for (j = n-51 ; j < n ; j++)
+      for (i = n-51 ; i < j-3 ; i++)
+         if (i > 0) allocate_band_job(skip, i, j, n, D);
+
+   } // End of pre-heuristic.
+
+
+   // Allocate 'tid'.
+   pthread_t *tid = (pthread_t *) malloc(n_threads * sizeof(pthread_t));
+
+   llbandworker_arg arg = {
+      .n = n,
+      .D = D,
+      .m = m,
+      .k = (const int **) obs,
+      .dp = dp,
+      .w = (const double **) rowsums,
+      .lg = (const double **) log_gamma,
+      .off = (const double **) offsums,
+      .skip = skip,
+      .llikmat = llikmat,
+      .verbose = verbose,
+   };
+
+   err = pthread_mutex_init(&tadbit_lock, NULL);
+   if (err) {
+      fprintf(stderr, "error initializing mutex (%d)\n", err);
+      // Signal failure.
+      seg->maxbreaks = -1;
+      return;
+   }
+
+   int n_params;
+   int nbreaks_opt = 0;
+   // Number of breaks computed by the last dynamic programming.
+   int nlevels = 0;
+   double AIC = -INFINITY;
+   double newAIC = -DBL_MAX;
+
+   while (newAIC > AIC) {
+
+      if (verbose) {
+         fprintf(stderr, "starting new cycle\n");
+      }
+
+      AIC = newAIC;
+
+      // Initialize task queue.
+      n_to_process = 0;
+      for (i = 0 ; i < nD ; i++) {
+         // Skip all computation done in previous cycles.
+         if (!isnan(llikmat[i])) skip[i] = 1;
+         n_to_process += (1-skip[i]);
+      }
+      n_processed = 0;
+      taskQ_i = 0;
+
+      // Instantiate threads and start running jobs.
+      for (i = 0 ; i < n_threads ; i++) tid[i] = 0;
+      for (i = 0 ; i < n_threads ; i++) {
+         err = pthread_create(&(tid[i]), NULL, &fill_llikmat_band, &arg);
+         if (err) {
+            fprintf(stderr, "error creating thread (%d)\n", err);
+            seg->maxbreaks = -1;
+            return;
+         }
+      }
+
+      // Wait for threads to return.
+      for (i = 0 ; i < n_threads ; i++) {
+         pthread_join(tid[i], NULL);
+      }
+      if (verbose) {
+         fprintf(stderr, "computing likelihood (100%% done)\n");
+      }
+
+      // The breakpoints are found by dynamic programming.
+      nlevels = nbreaks_opt ? nbreaks_opt + 11 : MAXBREAKS;
+      if (nlevels > MAXBREAKS) nlevels = MAXBREAKS;
+      DPwalk_band(llikmat, n, D, nlevels, n_threads, mllik, back);
+
+      // Get optimal number of breaks by AIC.
+      newAIC = -INFINITY;
+      for (nbreaks_opt = 1 ; nbreaks_opt < MAXBREAKS ; nbreaks_opt++) {
+         n_params = nbreaks_opt + m*(8 + nbreaks_opt*6);
+         if (newAIC > mllik[nbreaks_opt] - n_params) break;
+         newAIC = mllik[nbreaks_opt] - n_params;
+      }
+      nbreaks_opt -= 1;
+
+      allocate_new_jobs_band(skip, back, nlevels, nbreaks_opt, n, D);
+
+   }
+
+   AIC = newAIC;
+
+   pthread_mutex_destroy(&tadbit_lock);
+   free(skip);
+   free(tid);
+
+   nbreaks_opt = nbrks ? (int) nbrks - 1 : nbreaks_opt;
+   if (nbreaks_opt > MAXBREAKS-1) nbreaks_opt = MAXBREAKS-1;
+   if (nbreaks_opt > nlevels-1) {
+      nlevels = nbreaks_opt+1;
+      DPwalk_band(llikmat, n, D, nlevels, n_threads, mllik, back);
+   }
+   DP_breakpoints(back, n, nbreaks_opt, bkpts);
+   free(back);
+
+   // Compute breakpoint confidence by penalized dynamic progamming.
+   double *llikmatcpy = (double *) malloc (nD * sizeof(double));
+   double *mllikcpy = (double *) malloc((nbreaks_opt+1) * sizeof(double));
+   int *backcpy = (int *) malloc(n*(nbreaks_opt+1) * sizeof(int));
+   int *bkptscpy = (int *) malloc(n * sizeof(int));
+   int *passages = (int *) malloc(n * sizeof(int));
+   for (i = 0 ; i < n ; i++) bkptscpy[i] = bkpts[i];
+   for (i = 0 ; i < nD ; i++) llikmatcpy[i] = llikmat[i];
+   for (i = 0 ; i < n ; i++) passages[i] = 0;
+
+   for (l = 0 ; l < 10 ; l++) {
+      i = 0;
+      for (j = 0 ; j < n ; j++) {
+         if (bkptscpy[j]) {
+            // Same penalty as in 'tadbit'.
+            if (j-i <= D) llikmatcpy[i+(j-i)*n] -= m*6;
+            passages[j] += bkpts[j];
+            i = j+1;
+         }
+      }
+      if (i < n && n-1-i <= D) llikmatcpy[i+(n-1-i)*n] -= m*6;
+      DPwalk_band(llikmatcpy, n, D, nbreaks_opt+1, n_threads, mllikcpy,
+                  backcpy);
+      DP_breakpoints(backcpy, n, nbreaks_opt, bkptscpy);
+   }
+   free(llikmatcpy);
+   free(mllikcpy);
+   free(backcpy);
+   free(bkptscpy);
+   free(llikmat);
+
+   // Resize output to match original.
+   int *resized_bkpts = (int *) malloc(N * sizeof(int));
+   int *resized_passages = (int *) malloc(N * sizeof(int));
+   for (i = 0 ; i < N ; i++) {
+      resized_bkpts[i] = 0;
+      resized_passages[i] = 0;
+   }
+   for (l = 0, i = 0 ; i < N ; i++) {
+      if (remove[i]) continue;
+      resized_passages[i] = passages[l];
+      resized_bkpts[i] = bkpts[l];
+      l++;
+   }
+
+   free(passages);
+   free(bkpts);
+
+   for (k = 0 ; k < m ; k++) {
+      free(log_gamma[k]);
+      free(rowsums[k]);
+      free(offsums[k]);
+   }
+   free(log_gamma);
+   free(rowsums);
+   free(offsums);
+   fastlog_free();
+   free(dp);
+   free(remove);
+
+   // Update output struct.
+   seg->m = m;
+   seg->maxbreaks = MAXBREAKS;
+   seg->nbreaks_opt = nbreaks_opt;
+   seg->passages = resized_passages;
+   seg->llikmat = NULL;
+   seg->mllik = mllik;
+   seg->bkpts = resized_bkpts;
+
+   return;
+
+}
@@ -40,6 +40,32 @@ typedef struct {
 
 
 
+typedef struct {
+   const int n;
+   const int D;
+   const int m;
+   const int **k;
+   const int *dp;
+   const double **w;
+   const double **lg;
+   const double **off;
+   const char *skip;
+   double *llikmat;
+   const int verbose;
+} llbandworker_arg;
+
+typedef struct {
+   const int n;
+   const int D;
+   const double *llikmat;
+   double *old_llik;
+   double *new_llik;
+   int nbreaks;
+   int *back;
+} dpbandworker_arg;
+
+
+
 // 'tadbit' output struct.
 typedef struct {
    int m;
@@ -71,6 +97,26 @@ tadbit(
 );
 
 
+void
+tadbit_band(
+  /* input */
+  int **obs,
+  int **offobs,
+  const int *noff,
+  char *remove,
+  int N,
+  int D,
+  const int m,
+  int n_threads,
+  const int verbose,
+  int max_tad_size,
+  const int nbrks,
+  const int do_not_use_heuristic,
+  /* output */
+  tadbit_output *seg
+);
+
+
 void
 destroy_tadbit_output(
    tadbit_output *seg
@@ -113,10 +113,136 @@ static PyObject *_tadbit_wrapper (PyObject *self, PyObject *args){
   return py_result;
 }
 
+/* The function doc string */
+PyDoc_STRVAR(_tadbit_band_wrapper__doc__,
+"Run tadbit_band function in tadbit.c.\n\
+    :argument obs: a python list of buffers of int (e.g. NumPy arrays of int32), with the diagonals of each matrix (see tadbit_band).\n\
+    :argument off: a python list of buffers of int, with the row, column and value of the interactions further than band in each matrix.\n\
+    :argument remove: a python list of lists of booleans mapping positively columns to remove.\n\
+    :argument 0 n: number of rows or columns in the matrix\n\
+    :argument 0 band: number of diagonals (above the main one) in each buffer\n\
+    :argument 0 m: number of matrices\n\
+    :argument 0 n_threads: number of threads to use\n\
+    :argument 0 verbose: whether to display more/less information about process\n\
+    :argument 0 max_tad_size: an integer defining maximum size of TAD (at most band).\n\
+    :argument 1 do_not_use_heuristic: whether to use or not some heuristics\n\
+    :returns: a python list as _tadbit_wrapper, without log-likelihood matrix, and only with the breakpoints of the optimal segmentation\n");
+
+
+/* The wrapper to the banded C function */
+static PyObject *_tadbit_band_wrapper (PyObject *self, PyObject *args){
+  PyObject *py_obs;
+  PyObject *py_off;
+  PyObject *py_remove;
+  int n;
+  int band;
+  int m;
+  int n_threads;
+  int verbose;
+  int max_tad_size;
+  int nbks;
+  int do_not_use_heuristic;
+
+  if (!PyArg_ParseTuple(args, "OOOiiiiiiii:tadbit_band", &py_obs, &py_off,
+			&py_remove, &n, &band, &m, &n_threads,
+			&verbose, &max_tad_size, &nbks, &do_not_use_heuristic))
+    return NULL;
+
+  int i, j;
+  char *remove = (char *) malloc (n * sizeof(char));
+  int nkept = n;
+  for (j = 0 ; j < n ; j++){
+    remove[j] = PyInt_AS_LONG(PyTuple_GET_ITEM(py_remove, j)); // automatic casting into char
+    nkept -= remove[j];
+  }
+
+  // interactions are read directly from the buffers (no copy)
+  int **obs = malloc(m * sizeof(int*));
+  int **off = malloc(m * sizeof(int*));
+  int *noff = malloc(m * sizeof(int));
+  for (i = 0 ; i < m ; i++){
+    const void *buffer;
+    const void *offbuffer;
+    Py_ssize_t len;
+    Py_ssize_t offlen;
+    if (PyObject_AsReadBuffer(PyList_GET_ITEM(py_obs, i), &buffer, &len) ||
+	len != (Py_ssize_t) nkept * (band + 1) * sizeof(int) ||
+	PyObject_AsReadBuffer(PyList_GET_ITEM(py_off, i), &offbuffer,
+			      &offlen) ||
+	offlen % (3 * sizeof(int))){
+      free(obs);
+      free(off);
+      free(noff);
+      free(remove);
+      if (!PyErr_Occurred())
+	PyErr_SetString(PyExc_ValueError,
+			"ERROR: wrong size of banded matrix\n");
+      return NULL;
+    }
+    obs[i] = (int *) buffer;
+    off[i] = (int *) offbuffer;
+    noff[i] = offlen / (3 * sizeof(int));
+  }
+
+  /* output */
+  tadbit_output *seg = (tadbit_output *) malloc(sizeof(tadbit_output));
+
+  // run tadbit
+  tadbit_band(obs, off, noff, remove, n, band, m, n_threads, verbose,
+	      max_tad_size, nbks, do_not_use_heuristic, seg);
+  free(obs);
+  free(off);
+  free(noff);
+
+  if (seg->maxbreaks < 0){
+    free(seg);
+    PyErr_SetString(PyExc_ValueError,
+		    "ERROR: too few rows/columns to segment\n");
+    return NULL;
+  }
+
+  PyObject * py_bkpts;
+  PyObject * py_mllik;
+  PyObject * py_result;
+  PyObject * py_passages;
+
+  // get bkpts of the optimal segmentation
+  py_bkpts = PyList_New(n);
+  for(i = 0 ; i < n; i++)
+    PyList_SetItem(py_bkpts, i, PyInt_FromLong(seg->bkpts[i]));
+
+  // get passages
+  py_passages = PyList_New(n);
+  for(i = 0 ; i < n; i++)
+    PyList_SetItem(py_passages, i, PyFloat_FromDouble(seg->passages[i]));
+
+  // get mllik
+  py_mllik = PyList_New(seg->maxbreaks);
+  for(i = 0 ; i < seg->maxbreaks ; i++)
+    PyList_SetItem(py_mllik, i, PyFloat_FromDouble(seg->mllik[i]));
+
+  // group results into a python list
+  py_result = PyList_New(6);
+
+  Py_INCREF(Py_None);
+  PyList_SetItem(py_result, 0, PyInt_FromLong(seg->maxbreaks));
+  PyList_SetItem(py_result, 1, PyInt_FromLong(seg->nbreaks_opt));
+  PyList_SetItem(py_result, 2, py_passages);
+  PyList_SetItem(py_result, 3, Py_None);
+  PyList_SetItem(py_result, 4, py_mllik);
+  PyList_SetItem(py_result, 5, py_bkpts);
+
+  destroy_tadbit_output(seg);
+
+  return py_result;
+}
+
 /* A list of all the methods defined by this module. */
 /* The {NULL, NULL} entry indicates the end of the method definitions */
 static PyMethodDef tadbit_py_methods[] = {
 	{"_tadbit_wrapper",  _tadbit_wrapper, METH_VARARGS, _tadbit_wrapper__doc__},
+	{"_tadbit_band_wrapper",  _tadbit_band_wrapper, METH_VARARGS,
+	 _tadbit_band_wrapper__doc__},
 	{NULL, NULL}      /* sentinel */
 };
 
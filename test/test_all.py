@@ -10,19 +10,31 @@ matplotlib.use('Agg')
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
 from pytadbit                             import tadbit, batch_tadbit
+from pytadbit.tadbit                      import split_windows
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.imp.structuralmodels        import load_structuralmodels
 from pytadbit.imp.impmodel                import load_impmodel_from_cmm
 from pytadbit.eqv_rms_drms                import rmsdRMSD_wrapper
 from pytadbit.parsers.genome_parser       import parse_fasta
 from pytadbit.mapping.restriction_enzymes import map_re_sites, RESTRICTION_ENZYMES
+from pytadbit.mapping.restriction_enzymes import get_re_fragments, ligation_sites
 from pytadbit.parsers.hic_parser          import load_hic_data_from_reads, read_matrix
 from pytadbit.mapping.analyze             import hic_map, plot_distance_vs_interactions
 from pytadbit.mapping.analyze             import insert_sizes, plot_iterative_mapping
 from pytadbit.mapping.analyze             import correlate_matrices, eig_correlate_matrices
+from pytadbit.mapping.reads_stats         import reads_stats
 from pytadbit.mapping.filter              import filter_reads, apply_filter
+from pytadbit.mapping                     import filter as filter_module
+from pytadbit.parsers.pairs_parser        import tsv_to_pairs, pairs_to_tsv
+from pytadbit.mapping.full_mapper         import full_mapping, transform_fastq
+from pytadbit.mapping.full_mapper         import split_read_re
+from pytadbit.utils.fastq_utils           import fastq_qc
+from pytadbit.utils.hyperloglog           import sketch_pairs
+from pytadbit.utils.normalize_hic         import expected
+from pytadbit.utils.file_handling         import magic_open
 
 from random                               import random, seed
+from numpy                                import load, array, float32, isnan
 from os                                   import system, path, chdir
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
@@ -81,6 +93,46 @@ class TestTadbit(unittest.TestCase):
         scores = [7.0, 7.0, 4.0, 4.0, 4.0, 4.0, 4.0, 7.0, None]
         self.assertEqual(exp1['start'], breaks)
         self.assertEqual(exp1['score'], scores)
+        # banded input, the band covering the whole matrix
+        self.assertEqual(tadbit(PATH + '/40Kb/chrT/chrT_A.tsv', banded=True,
+                                max_tad_size="max", verbose=False,
+                                no_heuristic=False, n_cpus='max'), exp1)
+        # band narrower than the matrix: same TADs as without band, as long as
+        # these are at most max_tad_size bins
+        for mts, fname in ((10, '/40Kb/chrT/chrT_A.tsv'),
+                           (20, '/20Kb/chrT/chrT_A.tsv')):
+            for no_heuristic in (True, False):
+                dense = tadbit(PATH + fname, max_tad_size=mts, verbose=False,
+                               no_heuristic=no_heuristic, n_cpus='max')
+                self.assertTrue(all(e - s < mts for s, e in
+                                    zip(dense['start'], dense['end'])))
+                self.assertEqual(tadbit(PATH + fname, banded=True,
+                                        max_tad_size=mts, verbose=False,
+                                        no_heuristic=no_heuristic,
+                                        n_cpus='max'), dense)
+        # windows covering the whole matrix
+        self.assertEqual(tadbit(PATH + '/40Kb/chrT/chrT_A.tsv', window=100,
+                                max_tad_size="max", verbose=False,
+                                no_heuristic=False, n_cpus='max'), exp1)
+        self.assertEqual(split_windows(100, 40, 10),
+                         [(0, 40), (30, 70), (60, 100)])
+        # windows smaller than the matrix: most boundaries of the whole matrix
+        # are found (within one bin)
+        for crm in 'ABCD':
+            fname = PATH + '/20Kb/chrT/chrT_%s.tsv' % crm
+            dense = tadbit(fname, max_tad_size=20, verbose=False,
+                           no_heuristic=False, n_cpus='max')['end'][:-1]
+            windowed = tadbit(fname, window=80, max_tad_size=20, verbose=False,
+                              no_heuristic=False, n_cpus=2)['end'][:-1]
+            found = [b for b in dense if any(abs(b - w) <= 1 for w in windowed)]
+            self.assertTrue(len(found) >= 0.8 * len(dense))
+        # TADs cut by the end of a window would be lost
+        self.assertRaises(Exception, tadbit, PATH + '/40Kb/chrT/chrT_A.tsv',
+                          window=30, overlap=5, max_tad_size=10, verbose=False)
+        topdom = tadbit(PATH + '/40Kb/chrT/chrT_A.tsv', use_topdom=True,
+                        verbose=False)
+        self.assertEqual(topdom['start'], [0, 17, 45])
+        self.assertEqual(topdom['score'], [-9, -7, -4])
 
         if CHKTIME:
             print '1', time() - t0
@@ -339,6 +391,31 @@ class TestTadbit(unittest.TestCase):
         hic_data = exp.hic_data[0]
         hic_data.find_compartments(label_compartments='cluster')
         self.assertEqual(len(hic_data.compartments[None]), 39)
+        # same compartments with parallel workers, eigenvectors in binary
+        firsts = hic_data.find_compartments(label_compartments='cluster',
+                                            saveev='.', binary=True, n_cpus=2)
+        self.assertEqual(len(hic_data.compartments[None]), 39)
+        evs = load('None_EigVect.npy')
+        self.assertEqual(evs.shape, (len(hic_data), 2))
+        self.assertTrue(abs(evs[:, 0] - array(firsts[None][0], dtype=float32)
+                            )[~isnan(evs[:, 0])].max() < 1e-6)
+        system('rm -f None_EigVect.npy')
+        # expected interactions by distance, dropped when bad columns change
+        self.assertEqual(expected(hic_data, bads=hic_data.bads,
+                                  per_chromosome=True)[None],
+                         hic_data.expected)
+        # also dropped when bad columns are changed in place, or cells changed
+        expc = hic_data.expected
+        hic_data.bads[0] = True
+        self.assertEqual(hic_data.expected, None)
+        hic_data.expected = expc
+        hic_data.bads[1] = hic_data.bads.pop(0)
+        self.assertEqual(hic_data.expected, None)
+        hic_data.expected = expc
+        hic_data[0, 0] = hic_data[0, 0]
+        self.assertEqual(hic_data.expected, None)
+        hic_data.bads = {}
+        self.assertEqual(hic_data.expected, None)
         # self.assertEqual(round(hic_data.compartments[None][24]['dens'], 5),
         #                  0.75434)
         if CHKTIME:
@@ -674,6 +751,15 @@ class TestTadbit(unittest.TestCase):
         self.assertEqual(len(frags['chr2L']), 231)
         self.assertEqual(len(frags['chr2L'][230]), 3)
         self.assertEqual(frags['chr4'][10][5], 1017223)
+        # index of RE sites, cached to disk
+        index = get_re_fragments('hindiii', ref_genome,
+                                 cache_dir=PATH + '/lala_cache/')
+        index = get_re_fragments('hindiii', ref_genome,
+                                 cache_dir=PATH + '/lala_cache/')
+        _, prev_re, next_re = index.fragments('chr4', [1017222, 1017223])
+        self.assertEqual(prev_re.tolist(), [frags['chr4'][10][4], 1017223])
+        self.assertEqual(next_re.tolist(), [1017223, frags['chr4'][10][6]])
+        system('rm -rf ' + PATH + '/lala_cache/')
         if CHKTIME:
             self.assertEqual(True, True)
             print '17', time() - t0
@@ -706,11 +792,70 @@ class TestTadbit(unittest.TestCase):
             parser(['test_read1.%s~' % (ali)], ['test_read2.%s~' % (ali)],
                    './lala1-%s~' % (ali), './lala2-%s~' % (ali), genome,
                    re_name='DPNII', mapper='GEM')
+            if ali == 'map':
+                # many small (compressed) temporary files to be merged
+                parser(['test_read1.map~'], ['test_read2.map~'],
+                       './lala1-map-tmp~', './lala2-map-tmp~', genome,
+                       re_name='DPNII', max_memory=0.05, compress_tmp=True)
+                self.assertEqual(open('lala1-map~').read(),
+                                 open('lala1-map-tmp~').read())
+                self.assertEqual(open('lala2-map~').read(),
+                                 open('lala2-map-tmp~').read())
+                # parsing in parallel
+                parser(['test_read1.map~'], ['test_read2.map~'],
+                       './lala1-map-tmp~', './lala2-map-tmp~', genome,
+                       re_name='DPNII', nthreads=2)
+                self.assertEqual(open('lala1-map~').read(),
+                                 open('lala1-map-tmp~').read())
+                self.assertEqual(open('lala2-map~').read(),
+                                 open('lala2-map-tmp~').read())
+                # same output as previous versions of the parser, with
+                # contacts of multiple-contact reads found in different files
+                map_dir = PATH + '/map_files/'
+                genome_map = parse_fasta(map_dir + 'genome.fa', verbose=False)
+                for kwargs in [{}, {'nthreads': 2},
+                               {'max_memory': 0.002, 'compress_tmp': True}]:
+                    parser([map_dir + 'reads1_frag_a.map',
+                            map_dir + 'reads1_frag_b.map',
+                            map_dir + 'reads1_full.map'],
+                           [map_dir + 'reads2.map'],
+                           './lala1-map-tmp~', './lala2-map-tmp~', genome_map,
+                           re_name='DPNII', **kwargs)
+                    self.assertEqual(open(map_dir + 'reads1_parsed.tsv').read(),
+                                     open('lala1-map-tmp~').read())
+                    self.assertEqual(open(map_dir + 'reads2_parsed.tsv').read(),
+                                     open('lala2-map-tmp~').read())
+                # genome and RE sites loaded from cache (chromosomes in the
+                # order of the FASTA file)
+                for _ in range(2):
+                    genome_cache = parse_fasta('test.fa~', verbose=False,
+                                               cache_dir='lala-cache~')
+                self.assertEqual(dict(genome_cache.items()), dict(genome))
+                parser(['test_read1.map~'], None, './lala1-map-tmp~', None,
+                       genome_cache, re_name='DPNII', cache_dir='lala-cache~')
+                # same output as without cache (chromosomes of the header in
+                # the order of the genome)
+                parser(['test_read1.map~'], None, './lala1-map-ref~', None,
+                       parse_fasta('test.fa~', verbose=False), re_name='DPNII')
+                self.assertEqual(open('lala1-map-ref~').read(),
+                                 open('lala1-map-tmp~').read())
 
             # GET INTERSECTION
             from pytadbit.mapping import get_intersection
             get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
                              'lala-%s~' % (ali))
+            # sorting compressed buckets in parallel
+            get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
+                             'lala-tmp~', nthreads=2, nbuckets=7,
+                             compress=True)
+            self.assertEqual(open('lala-%s~' % (ali)).read(),
+                             open('lala-tmp~').read())
+            # more buckets than files opened at once
+            get_intersection('lala1-%s~' % (ali), 'lala2-%s~' % (ali),
+                             'lala-tmp~', nbuckets=1100, max_files=16,
+                             compress=(ali=='map'))
+            self.assertEqual(open('lala-%s~' % (ali)).read(),
+                             open('lala-tmp~').read())
             # FILTER
             masked = filter_reads('lala-%s~' % (ali), verbose=False,
                                   fast=(ali=='map'))
@@ -731,6 +876,85 @@ class TestTadbit(unittest.TestCase):
                      reverse=True, verbose=False)
         self.assertEqual(len([True for l in open('lala-map-filt~')
                               if not l.startswith('#')]), 1000)
+        # filter and apply filters at once, in parallel
+        nvalid = apply_filter('lala-map~', 'lala-map-filt~', masked,
+                              verbose=False)
+        masked2, nvalid2 = filter_reads('lala-map~', output='lala-map-bis~',
+                                        verbose=False, outfile='lala-map-filt2~',
+                                        nthreads=2)
+        self.assertEqual(nvalid, nvalid2)
+        self.assertEqual(open('lala-map-filt~').read(),
+                         open('lala-map-filt2~').read())
+        # sharded apply
+        self.assertEqual(apply_filter('lala-map~', 'lala-map-filt6~', masked,
+                                      verbose=False, nthreads=2), nvalid)
+        self.assertEqual(open('lala-map-filt~').read(),
+                         open('lala-map-filt6~').read())
+        # hash collision of a read not filtered with a filtered read missing
+        # from the input: reads are compared one by one to the filters
+        filtered = set(l.strip() for k in masked
+                       for l in magic_open(masked[k]['fnam'], cpus=1))
+        unfiltered = (l.split('\t', 1)[0] for l in open('lala-map~')
+                      if not l.startswith('#'))
+        unfiltered = next(r for r in unfiltered if not r in filtered)
+        masked4 = dict((k, dict(v)) for k, v in masked.iteritems())
+        masked4[1]['fnam'] = 'lala-map-missing~'
+        out = open('lala-map-missing~', 'w')
+        out.writelines(magic_open(masked[1]['fnam'], cpus=1))
+        out.write('missing-read\n')
+        out.close()
+        hash_strings = filter_module.hash_strings
+        filter_module.hash_strings = lambda values: hash_strings(
+            ['missing-read' if v == unfiltered else v for v in values])
+        try:
+            for nthreads in (1, 2):
+                self.assertEqual(apply_filter('lala-map~', 'lala-map-filt7~',
+                                              masked4, verbose=False,
+                                              nthreads=nthreads), nvalid)
+                self.assertEqual(open('lala-map-filt~').read(),
+                                 open('lala-map-filt7~').read())
+        finally:
+            filter_module.hash_strings = hash_strings
+        for k in masked:
+            self.assertEqual(masked[k]['reads'], masked2[k]['reads'])
+        # IDs of filtered reads compressed by blocks (BGZF)
+        masked2 = filter_reads('lala-map~', output='lala-map-gz~',
+                               verbose=False, nthreads=2, compress=True)
+        self.assertEqual(apply_filter('lala-map~', 'lala-map-filt5~', masked2,
+                                      verbose=False), nvalid)
+        reader = magic_open(masked2[9]['fnam'], cpus=1)
+        first = reader.readline()
+        pos = reader.tell()
+        line = reader.readline()
+        reader.seek(0)
+        self.assertEqual(reader.readline(), first)
+        reader.seek(pos)
+        self.assertEqual(reader.readline(), line)
+        # duplicates do not depend on the order of the reads
+        lines = open('lala-map~').readlines()
+        reads = [l for l in lines if not l.startswith('#')]
+        out = open('lala-map-rev~', 'w')
+        out.writelines([l for l in lines if l.startswith('#')] + reads[::-1])
+        out.close()
+        masked2 = filter_reads('lala-map-rev~', verbose=False, nthreads=2,
+                               max_memory=1)
+        self.assertEqual(masked2[9]['reads'], masked[9]['reads'])
+        # binary format
+        tsv_to_pairs('lala-map~', 'lala-map-bin~')
+        masked3, nvalid3 = filter_reads('lala-map-bin~', verbose=False,
+                                        outfile='lala-map-filt3~')
+        pairs_to_tsv('lala-map-filt3~', 'lala-map-filt4~')
+        self.assertEqual(nvalid, nvalid3)
+        self.assertEqual(open('lala-map-filt2~').read(),
+                         open('lala-map-filt4~').read())
+        for k in masked:
+            self.assertEqual(masked[k]['reads'], masked3[k]['reads'])
+        # library complexity, sketches are the same from text or binary
+        sketch = sketch_pairs('lala-map~')
+        self.assertEqual(list(sketch.registers),
+                         list(sketch_pairs('lala-map-bin~').registers))
+        self.assertTrue(abs(sketch.count - sketch.cardinality()
+                            - masked[9]['reads']) < 100)
         d = plot_iterative_mapping('lala1-map~', 'lala2-map~')
         self.assertEqual(d[0][1], 6000)
 
@@ -750,6 +974,41 @@ class TestTadbit(unittest.TestCase):
         # slowest part of the all test:
         hic_data2 = read_matrix('lala-map.tsv~', resolution=10000)
         self.assertEqual(hic_data1, hic_data2)
+        # same with sparse storage
+        hic_data3 = load_hic_data_from_reads('lala-map~', resolution=10000,
+                                             sparse=True)
+        self.assertEqual(hic_data3, hic_data1)
+        self.assertEqual(hic_data3.sum(), hic_data1.sum())
+        self.assertEqual(hic_data3.cis_trans_ratio(diagonal=False),
+                         hic_data1.cis_trans_ratio(diagonal=False))
+        # binary format
+        tsv_to_pairs('lala-map~', 'lala-map-bin~')
+        self.assertEqual(load_hic_data_from_reads('lala-map-bin~',
+                                                  resolution=10000), hic_data1)
+        # genomic regions, using the index of the sorted reads
+        hic_data4 = load_hic_data_from_reads('lala-map~', resolution=10000,
+                                             region='chr1')
+        self.assertEqual(hic_data4.get_matrix(),
+                         hic_data1.get_matrix(focus='chr1'))
+        hic_data4 = load_hic_data_from_reads('lala-map~', resolution=10000,
+                                             region='chr1:100k-200k')
+        self.assertEqual(hic_data4.sum(), 140)
+        self.assertEqual(load_hic_data_from_reads(
+            'lala-map-bin~', resolution=10000, region='chr1:100k-200k'),
+                         hic_data4)
+        # several resolutions in one pass
+        hic_datas = load_hic_data_from_reads('lala-map~',
+                                             resolution=[10000, 50000])
+        self.assertEqual(hic_datas[10000], hic_data1)
+        self.assertEqual(hic_datas[50000],
+                         load_hic_data_from_reads('lala-map~',
+                                                  resolution=50000))
+        # vectorized ICE
+        hic_data2.normalize_hic(iterations=10, max_dev=0.00001, silent=True)
+        hic_data3.normalize_hic(iterations=10, max_dev=0.00001, silent=True,
+                                n_cpus=2)
+        self.assertEqual([round(hic_data2.bias[i], 8) for i in xrange(100)],
+                         [round(hic_data3.bias[i], 8) for i in xrange(100)])
         vals = plot_distance_vs_interactions(hic_data1)
         
         self.assertEqual([round(i, 2) if str(i)!='nan' else 0.0 for i in
@@ -758,6 +1017,12 @@ class TestTadbit(unittest.TestCase):
         
         a, b = insert_sizes('lala-map~')
         self.assertEqual([int(a),int(b)], [43, 1033])
+        # same from the statistics of the reads, computed in parallel
+        stats = reads_stats('lala-map~', nthreads=2)
+        self.assertEqual(insert_sizes(stats), [a, b])
+        self.assertEqual(
+            plot_distance_vs_interactions('lala-map~', resolution=10000),
+            plot_distance_vs_interactions(stats, resolution=10000))
 
         hic_data1 = read_matrix('20Kb/chrT/chrT_A.tsv', resolution=20000)
         hic_data2 = read_matrix('20Kb/chrT/chrT_B.tsv', resolution=20000)
@@ -803,6 +1068,79 @@ class TestTadbit(unittest.TestCase):
             self.assertEqual(True, True)
             print '20', time() - t0
 
+    def test_21_full_mapping_stream(self):
+        """
+        Iterative mapping with steps connected through pipes, using a fake
+        mapper
+        """
+        if ONLY and ONLY != '21':
+            return
+        if CHKTIME:
+            t0 = time()
+        # the fake mapper maps uniquely reads with an A or a C in the middle
+        out = open('lala-mapper~', 'w')
+        out.write('#!%s\n' % sys.executable)
+        out.write('''import sys
+args = sys.argv[1:]
+fhandler = open(args[args.index('-i') + 1])
+out = open(args[args.index('-o') + 1] + '.map', 'w')
+for head in fhandler:
+    seq = fhandler.next().strip()
+    _ = fhandler.next()
+    qal = fhandler.next().strip()
+    if seq[len(seq) / 2] in 'AC':
+        ali = '1\\tchr1:+:1:%d' % len(seq)
+    else:
+        ali = '0\\t-'
+    out.write('%s\\t%s\\t%s\\t%s\\n' % (head[1:].strip(), seq, qal, ali))
+out.close()
+''')
+        out.close()
+        system('chmod +x lala-mapper~')
+        seed(1)
+        out = open('lala.fastq', 'w')
+        for i in xrange(1000):
+            seq = ''.join('ACGT'[int(random() * 4)] for _ in xrange(60))
+            if random() > 0.5:
+                seq = seq[:25] + 'GATCGATC' + seq[33:]
+            out.write('@read%d\n%s\n+\n%s\n' % (i, seq, 'H' * 60))
+        out.close()
+        results = []
+        for stream in (False, True):
+            outfiles = full_mapping('lala-index~', 'lala.fastq',
+                                    'lala-map-%s~' % stream, r_enz='DpnII',
+                                    windows=((1, 20), (1, 40)), clean=True,
+                                    temp_dir='lala-tmp-%s~' % stream,
+                                    gem_binary=path.abspath('lala-mapper~'),
+                                    stream=stream, nthreads=1, get_nread=True)
+            results.append([(path.split(fnam)[-1], count, open(fnam).read())
+                            for fnam, count in outfiles])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual([count for _, count, _ in results[1]],
+                         [1000, 544, 282])
+        # reads split in parallel, by blocks
+        transform_fastq('lala.fastq', 'lala1~', r_enz='DpnII', verbose=False)
+        transform_fastq('lala.fastq', 'lala2~', r_enz='DpnII', verbose=False,
+                        nthreads=2, block_size=77)
+        self.assertEqual(open('lala1~').read(), open('lala2~').read())
+        # reads split at ligation sites of two enzymes (also hybrid ones)
+        self.assertEqual(split_read_re('A' * 20 + 'GATCAGCTT' + 'C' * 20,
+                                       'H' * 49,
+                                       [(l, len(l), s1, s2) for l, s1, s2 in
+                                        ligation_sites(['DpnII', 'HindIII'])]),
+                         [('A' * 20 + 'GATC', 'H' * 24, 1),
+                          ('AAGCTT' + 'C' * 20, 'H' * 26, 2)])
+        # quality and ligation sites on all reads, or a random sample
+        stats = fastq_qc('lala.fastq', r_enz='DpnII')
+        self.assertEqual(stats['nreads'], 1000)
+        self.assertEqual(stats['ligated'], 50.9)
+        stats = fastq_qc('lala.fastq', r_enz='DpnII', nreads=200)
+        self.assertTrue(stats['ligated_ci'][0] < 50.9 < stats['ligated_ci'][1])
+        system('rm -rf lala*')
+        if CHKTIME:
+            self.assertEqual(True, True)
+            print '21', time() - t0
+
 
 def generate_random_ali(ali='map'):
     # VARIABLES